@@ -0,0 +1,109 @@
+"""
+Gunicorn Configuration
+
+Loaded automatically by gunicorn from the working directory. Every
+setting can be overridden with an environment variable:
+
+GUNICORN_BIND - address to listen on (defaults to 0.0.0.0:$PORT)
+GUNICORN_WORKERS - worker processes (defaults to 2 * CPU cores + 1)
+GUNICORN_WORKER_CLASS - gthread (default), sync, gevent or uvicorn.workers.UvicornWorker
+GUNICORN_THREADS - threads per gthread worker
+GUNICORN_WORKER_CONNECTIONS - concurrent requests per gevent worker
+GUNICORN_PRELOAD - import the app once in the master and fork it (default true)
+GUNICORN_TIMEOUT, GUNICORN_GRACEFUL_TIMEOUT, GUNICORN_KEEPALIVE
+GUNICORN_MAX_REQUESTS, GUNICORN_MAX_REQUESTS_JITTER
+
+With preload_app the master builds the app before forking, so every worker
+starts with copies of its connection pool and change listener. post_fork
+gives each worker its own.
+"""
+import glob
+import os
+import sys
+
+
+def cpu_count() -> int:
+    """Returns the CPU cores this process may run on"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # pragma: no cover
+        return os.cpu_count() or 1
+
+
+def env_flag(name: str, default: str) -> bool:
+    """Reads a true/false environment variable"""
+    return os.getenv(name, default).lower() in ("true", "1", "yes")
+
+
+bind = os.getenv("GUNICORN_BIND", f"0.0.0.0:{os.getenv('PORT', '8080')}")
+workers = int(os.getenv("GUNICORN_WORKERS", str(2 * cpu_count() + 1)))
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "1000"))
+# uvicorn workers serve the ASGI entry point, every other class the Flask app
+wsgi_app = "service.asgi:app" if worker_class.startswith("uvicorn") else "service:app"
+preload_app = env_flag("GUNICORN_PRELOAD", "true")
+
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+# keep connections from a load balancer open between requests
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
+# recycle workers to bound memory growth, at staggered times so they never all restart at once
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "10000"))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", "1000"))
+# heartbeat files on a RAM disk, so a slow container filesystem does not stall workers
+if os.path.isdir("/dev/shm"):
+    worker_tmp_dir = "/dev/shm"
+
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
+
+
+######################################################################
+# Server hooks
+######################################################################
+def on_starting(server):  # pylint: disable=unused-argument
+    """Removes the metric files that workers of a previous run left behind"""
+    directory = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        for path in glob.glob(os.path.join(directory, "*.db")):
+            os.remove(path)
+
+
+def post_fork(server, worker):  # pylint: disable=unused-argument
+    """Gives a freshly forked worker its own database connections
+
+    Only needed when the app was preloaded: the pooled connections were
+    opened by the master and must not be shared between processes
+    """
+    if worker_class == "gevent":
+        patch_psycopg_for_gevent()
+    if "service" not in sys.modules:
+        return
+    # pylint: disable=import-outside-toplevel
+    from service import app, snapshot
+    from service.models import Promotion, db
+    with app.app_context():
+        # close=False leaves the master's connections open for the master
+        db.engine.dispose(close=False)
+        if Promotion.notifier:
+            Promotion.notifier.start(db.engine)
+    snapshot.store.invalidate()
+    worker.log.info("Worker %s reset its database connections", worker.pid)
+
+
+def child_exit(server, worker):  # pylint: disable=unused-argument
+    """Drops the live gauges of a worker that exited from the combined metrics"""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess  # pylint: disable=import-outside-toplevel
+        multiprocess.mark_process_dead(worker.pid)
+
+
+def patch_psycopg_for_gevent():
+    """Makes psycopg2 yield to other greenlets while it waits on the database"""
+    try:
+        from psycogreen.gevent import patch_psycopg  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        sys.stderr.write("psycogreen is not installed: database calls will block gevent workers\n")
+        return
+    patch_psycopg()
@@ -0,0 +1,257 @@
+"""
+Promotions API Benchmark
+
+Seeds promotions made by tests.factories.PromotionsFactory, drives the
+create, get, list, update and activate endpoints from several threads and
+reports the throughput and latency percentiles of every endpoint.
+
+Run it in-process against a throwaway SQLite database:
+  python -m scripts.benchmark --seed 1000 --requests 2000 --concurrency 8
+
+or against a running service (e.g. gunicorn in front of PostgreSQL):
+  python -m scripts.benchmark --url http://localhost:8000
+
+Save the results with --output and compare two commits with --compare:
+  python -m scripts.benchmark --output after.json --compare before.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+BASE_URL = "/api/promotions"
+ENDPOINTS = ["create", "get", "list", "update", "activate"]
+
+# the service and the test factories live at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+######################################################################
+# Clients
+######################################################################
+class InProcessClient:  # pylint: disable=too-few-public-methods
+    """Calls the Flask app directly, without a network or a server"""
+
+    def __init__(self, app):
+        self._app = app
+        self._local = threading.local()
+
+    def request(self, method: str, path: str, payload=None) -> tuple:
+        """Sends one request and returns its status code and JSON body"""
+        if not hasattr(self._local, "client"):
+            self._local.client = self._app.test_client()
+        response = self._local.client.open(path, method=method, json=payload)
+        return response.status_code, response.get_json(silent=True)
+
+
+class HttpClient:  # pylint: disable=too-few-public-methods
+    """Calls a running service over HTTP with one keep-alive session per thread"""
+
+    def __init__(self, url: str):
+        self._url = url.rstrip("/")
+        self._local = threading.local()
+
+    def request(self, method: str, path: str, payload=None) -> tuple:
+        """Sends one request and returns its status code and JSON body"""
+        import requests  # pylint: disable=import-outside-toplevel
+
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        response = self._local.session.request(method, self._url + path, json=payload, timeout=30)
+        try:
+            return response.status_code, response.json()
+        except ValueError:
+            return response.status_code, None
+
+
+def in_process_client(database: str) -> InProcessClient:
+    """Imports the service against the given database and wraps its app"""
+    os.environ["DATABASE_URI"] = database
+    # SQLite cannot check the version counter, which is expected here
+    warnings.filterwarnings("ignore", message=".*versioning cannot be verified")
+    # pylint: disable=import-outside-toplevel
+    from service import app
+
+    app.logger.setLevel(logging.ERROR)
+    return InProcessClient(app)
+
+
+######################################################################
+# Workload
+######################################################################
+def fake_promotion() -> dict:
+    """Returns the JSON body of a new Promotion made by the test factory"""
+    from tests.factories import PromotionsFactory  # pylint: disable=import-outside-toplevel
+
+    data = PromotionsFactory().serialize()
+    del data["id"]
+    return data
+
+
+def seed(client, count: int, chunk_size: int = 1000) -> list:
+    """Creates count promotions through the batch endpoint and returns their ids"""
+    ids = []
+    for start in range(0, count, chunk_size):
+        operations = [{"op": "create", "data": fake_promotion()}
+                      for _ in range(min(chunk_size, count - start))]
+        code, body = client.request("POST", f"{BASE_URL}/batch", {"operations": operations})
+        if code != 200:
+            raise RuntimeError(f"Seeding failed with status {code}: {body}")
+        ids.extend(result["id"] for result in body["results"] if result["status"] == 201)
+    return ids
+
+
+def make_call(endpoint: str, ids: list, page_size: int):
+    """Returns (method, path, payload, expected status) for one request to endpoint"""
+    promotion_id = random.choice(ids)
+    if endpoint == "create":
+        return "POST", BASE_URL, fake_promotion(), 201
+    if endpoint == "get":
+        return "GET", f"{BASE_URL}/{promotion_id}", None, 200
+    if endpoint == "list":
+        return "GET", f"{BASE_URL}?limit={page_size}", None, 200
+    if endpoint == "update":
+        data = fake_promotion()
+        data["amount"] = random.randint(1, 1000)
+        return "PUT", f"{BASE_URL}/{promotion_id}", data, 200
+    return "PUT", f"{BASE_URL}/{promotion_id}/activate", None, 200
+
+
+def run_endpoint(client, endpoint: str, ids: list, options) -> dict:
+    """Sends options.requests requests to one endpoint and summarizes them"""
+    calls = [make_call(endpoint, ids, options.page_size) for _ in range(options.requests)]
+
+    def timed(call):
+        method, path, payload, expected = call
+        start = time.perf_counter()
+        code, _ = client.request(method, path, payload)
+        return time.perf_counter() - start, code == expected
+
+    for call in calls[:options.warmup]:
+        timed(call)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=options.concurrency) as executor:
+        outcomes = list(executor.map(timed, calls))
+    elapsed = time.perf_counter() - started
+    return summarize([latency for latency, _ in outcomes],
+                     sum(1 for _, ok in outcomes if not ok), elapsed)
+
+
+def summarize(latencies: list, errors: int, elapsed: float) -> dict:
+    """Computes the throughput and latency percentiles (in milliseconds) of a run"""
+    cuts = statistics.quantiles(latencies, n=100, method="inclusive") if len(latencies) > 1 else latencies * 99
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "requests_per_second": round(len(latencies) / elapsed, 1),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 3),
+        "p50_ms": round(cuts[49] * 1000, 3),
+        "p95_ms": round(cuts[94] * 1000, 3),
+        "p99_ms": round(cuts[98] * 1000, 3),
+    }
+
+
+######################################################################
+# Reporting
+######################################################################
+def git_commit() -> str:
+    """Returns the commit being benchmarked, or None outside of a git checkout"""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_table(results: dict):
+    """Prints one line per endpoint"""
+    print(f"{'endpoint':<10}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for endpoint, result in results.items():
+        print(f"{endpoint:<10}{result['requests']:>10}{result['errors']:>8}{result['requests_per_second']:>10}"
+              f"{result['p50_ms']:>10}{result['p95_ms']:>10}{result['p99_ms']:>10}")
+
+
+def compare(results: dict, baseline_file: str, threshold: float) -> bool:
+    """Prints the change against a saved run and returns False if an endpoint regressed"""
+    with open(baseline_file, encoding="utf-8") as baseline_json:
+        baseline = json.load(baseline_json)["results"]
+    print(f"\nCompared with {baseline_file} (regression threshold {threshold}%):")
+    passed = True
+    for endpoint, result in results.items():
+        if endpoint not in baseline:
+            continue
+        before = baseline[endpoint]
+        p95 = 100.0 * (result["p95_ms"] - before["p95_ms"]) / before["p95_ms"]
+        rps = 100.0 * (result["requests_per_second"] - before["requests_per_second"]) / before["requests_per_second"]
+        regressed = p95 > threshold or -rps > threshold
+        passed = passed and not regressed
+        print(f"{endpoint:<10} p95 {p95:+7.1f}%  req/s {rps:+7.1f}%{'  REGRESSION' if regressed else ''}")
+    return passed
+
+
+def parse_args(argv=None):
+    """Reads the benchmark options from the command line"""
+    parser = argparse.ArgumentParser(description="Benchmark the Promotions REST API")
+    parser.add_argument("--url", help="benchmark a running service instead of the in-process app")
+    parser.add_argument("--database", help="database for the in-process app (default: a new SQLite file)")
+    parser.add_argument("--seed", type=int, default=1000, help="promotions to create before measuring")
+    parser.add_argument("--requests", type=int, default=1000, help="measured requests per endpoint")
+    parser.add_argument("--warmup", type=int, default=50, help="unmeasured requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent client threads")
+    parser.add_argument("--page-size", type=int, default=100, help="limit of the list requests")
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS), help="comma separated endpoints to run")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=10.0,
+                        help="percent change in p95 or req/s reported as a regression")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    """Runs the benchmark and returns the process exit code"""
+    options = parse_args(argv)
+    unknown = set(options.endpoints.split(",")) - set(ENDPOINTS)
+    if unknown:
+        print(f"Unknown endpoints: {', '.join(sorted(unknown))}", file=sys.stderr)
+        return 2
+    if options.url:
+        client, target = HttpClient(options.url), options.url
+    else:
+        target = options.database or "sqlite:///" + os.path.join(tempfile.mkdtemp(), "benchmark.db")
+        client = in_process_client(target)
+
+    random.seed(0)
+    ids = seed(client, options.seed)
+    print(f"Seeded {len(ids)} promotions into {target}")
+    results = {}
+    for endpoint in options.endpoints.split(","):
+        results[endpoint] = run_endpoint(client, endpoint, ids, options)
+    print_table(results)
+
+    report = {
+        "commit": git_commit(),
+        "target": target,
+        "python": platform.python_version(),
+        "options": {name: getattr(options, name) for name in ("seed", "requests", "warmup", "concurrency", "page_size")},
+        "results": results,
+    }
+    if options.output:
+        with open(options.output, "w", encoding="utf-8") as output:
+            json.dump(report, output, indent=2)
+    if options.compare and not compare(results, options.compare, options.threshold):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,127 @@
+"""
+Promotions Service Cold Start
+
+Starts the service in fresh Python processes and reports how long each one
+took to import the package, build the app and answer its first request
+(which creates the tables), plus the wall time of the whole process.
+
+Run it against a throwaway SQLite database:
+  python -m scripts.startup_time --runs 10
+
+Save the results with --output and compare two commits with --compare:
+  python -m scripts.startup_time --output after.json --compare before.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+PHASES = ["import", "create_app", "first_request", "total"]
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the service and the benchmark helpers live at the root of the repository
+sys.path.insert(0, ROOT)
+from scripts.benchmark import git_commit  # noqa: E402  pylint: disable=wrong-import-position
+
+# Runs in the measured process and prints the seconds spent in each phase
+PROBE = """
+import json, time
+started = time.perf_counter()
+import service
+imported = time.perf_counter()
+app = service.app
+built = time.perf_counter()
+assert app.test_client().get("/health").status_code == 200
+ready = time.perf_counter()
+print(json.dumps({"import": imported - started, "create_app": built - imported, "first_request": ready - built}))
+"""
+
+
+def measure(database: str) -> dict:
+    """Starts the service in a new process and returns the seconds spent in each phase"""
+    env = dict(os.environ, DATABASE_URI=database)
+    started = time.perf_counter()
+    completed = subprocess.run([sys.executable, "-c", PROBE], cwd=ROOT, env=env,
+                               capture_output=True, text=True, check=True)
+    phases = json.loads(completed.stdout.strip().splitlines()[-1])
+    phases["total"] = time.perf_counter() - started
+    return phases
+
+
+def summarize(runs: list) -> dict:
+    """Computes the median and the slowest time (in milliseconds) of every phase"""
+    return {
+        phase: {
+            "median_ms": round(statistics.median(run[phase] for run in runs) * 1000, 1),
+            "max_ms": round(max(run[phase] for run in runs) * 1000, 1),
+        }
+        for phase in PHASES
+    }
+
+
+def print_table(results: dict):
+    """Prints one line per phase"""
+    print(f"{'phase':<15}{'median ms':>12}{'max ms':>12}")
+    for phase, result in results.items():
+        print(f"{phase:<15}{result['median_ms']:>12}{result['max_ms']:>12}")
+
+
+def compare(results: dict, baseline_file: str, threshold: float) -> bool:
+    """Prints the change against a saved run and returns False if a phase got slower"""
+    with open(baseline_file, encoding="utf-8") as baseline_json:
+        baseline = json.load(baseline_json)["results"]
+    print(f"\nCompared with {baseline_file} (regression threshold {threshold}%):")
+    passed = True
+    for phase, result in results.items():
+        if phase not in baseline or not baseline[phase]["median_ms"]:
+            continue
+        change = 100.0 * (result["median_ms"] - baseline[phase]["median_ms"]) / baseline[phase]["median_ms"]
+        regressed = change > threshold
+        passed = passed and not regressed
+        print(f"{phase:<15} median {change:+7.1f}%{'  REGRESSION' if regressed else ''}")
+    return passed
+
+
+def parse_args(argv=None):
+    """Reads the options from the command line"""
+    parser = argparse.ArgumentParser(description="Measure the cold start of the Promotions service")
+    parser.add_argument("--runs", type=int, default=5, help="processes to start")
+    parser.add_argument("--database", help="database to start against (default: a new SQLite file per run)")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=10.0,
+                        help="percent change in a median reported as a regression")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    """Measures the cold starts and returns the process exit code"""
+    options = parse_args(argv)
+    runs = []
+    for _ in range(options.runs):
+        database = options.database or "sqlite:///" + os.path.join(tempfile.mkdtemp(), "startup.db")
+        runs.append(measure(database))
+    results = summarize(runs)
+    print_table(results)
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "runs": options.runs,
+        "results": results,
+    }
+    if options.output:
+        with open(options.output, "w", encoding="utf-8") as output:
+            json.dump(report, output, indent=2)
+    if options.compare and not compare(results, options.compare, options.threshold):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,48 +3,82 @@ Package: service
 Package for the application models and service routes
 This module creates and configures the Flask app and sets up the logging
 and SQL database
+
+create_app() builds the app. Importing the package does not: `service.app`
+is built the first time it is used, so tools that only need the models or
+the pricing engine skip the web stack. The database is not touched until
+the first request needs it either, so a worker boots even while the
+database is still starting.
 """
+import functools
+import logging
 import sys
-from flask import Flask
-from flask_restx import Api
-from service import config
-from service.common import log_handlers
-
-# Create Flask application
-app = Flask(__name__)
-app.config.from_object(config)
-
-######################################################################
-# Configure Swagger before initializing it
-######################################################################
-api = Api(app,
-          version='1.0.0',
-          title='Promotion REST API Service',
-          description='This is a Promotion server.',
-          default='promotions',
-          default_label='Promotion team operations',
-          doc='/apidocs',
-          prefix='/api')
-
-
-# Dependencies require we import the routes AFTER the Flask app is created
-# pylint: disable=wrong-import-position, wrong-import-order, cyclic-import
-from service import routes, models  # noqa: E402, E261
-# pylint: disable=wrong-import-position
-from service.common import error_handlers, cli_commands  # noqa: F401, E402
-
-# Set up logging for production
-log_handlers.init_logging(app, "gunicorn.error")
-
-app.logger.info(70 * "*")
-app.logger.info("  S E R V I C E   R U N N I N G  ".center(70, "*"))
-app.logger.info(70 * "*")
-
-try:
-    models.init_db(app)  # make our SQLAlchemy tables
-except Exception as error:  # pylint: disable=broad-except
-    app.logger.critical("%s: Cannot continue", error)
-    # gunicorn requires exit code 4 to stop spawning workers when they die
-    sys.exit(4)
-
-app.logger.info("Service initialized!")
+import time
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:  # pragma: no cover
+    from flask import Flask
+
+
+def create_app(config_object=None):
+    """Builds the Flask app with its routes, error handlers, CLI commands and extensions
+
+    Each call returns a new app; use service.app to share the one of this process
+    """
+    started = time.perf_counter()
+    # pylint: disable=import-outside-toplevel
+    from flask import Flask
+    from service import config
+
+    flask_app = Flask(__name__)
+    flask_app.config.from_object(config_object or config)
+
+    with flask_app.app_context():
+        # Dependencies require we import the routes AFTER the Flask app is created
+        # pylint: disable=cyclic-import, unused-import
+        from service import routes, models, snapshot, events, sweeper
+        from service.common import error_handlers, cli_commands, compression, log_handlers, metrics  # noqa: F401
+
+        routes.api.init_app(flask_app)
+        flask_app.register_blueprint(routes.site)
+        flask_app.register_blueprint(cli_commands.commands)
+        # Set up logging for production
+        log_handlers.init_logging(flask_app, "gunicorn.error")
+        models.bind_db(flask_app)
+        metrics.init_metrics(flask_app)
+        compression.init_compression(flask_app)
+        snapshot.init_snapshot(flask_app)
+        events.init_events(flask_app)
+        sweeper.init_sweeper(flask_app)
+        # the tables are created and change notifications started by the first request
+        flask_app.before_request(models.prepare_db)
+
+    metrics.record_startup("create_app", time.perf_counter() - started)
+    flask_app.logger.info(70 * "*")
+    flask_app.logger.info("  S E R V I C E   R U N N I N G  ".center(70, "*"))
+    flask_app.logger.info(70 * "*")
+    flask_app.logger.info("Service initialized in %.3f seconds!", time.perf_counter() - started)
+    return flask_app
+
+
+@functools.lru_cache(maxsize=None)
+def get_app():
+    """Returns the app of this process, building it on first use"""
+    try:
+        return create_app()
+    except Exception as error:  # pylint: disable=broad-except
+        # the app, and so its logger, could not be built: log through the server's
+        logging.getLogger("gunicorn.error").critical("%s: Cannot continue", error)
+        # gunicorn requires exit code 4 to stop spawning workers when they die
+        sys.exit(4)
+
+
+# Declared only: a module attribute that is never assigned is looked up through __getattr__
+app: "Flask"
+
+
+def __getattr__(name: str):
+    """Builds the app the first time service.app is used, e.g. by gunicorn service:app"""
+    if name == "app":
+        return get_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,403 @@
+"""
+ASGI Entry Point
+
+Serves the Promotion service to an ASGI server such as uvicorn. The read
+paths that checkout traffic hits hardest run on async SQLAlchemy sessions
+(asyncpg on PostgreSQL), so one worker process keeps hundreds of requests
+in flight while they wait on the database:
+
+GET /api/promotions/{id}
+GET /api/promotions/codes/{code}
+GET /api/products/{id}/promotions/active
+
+They share the in-process caches and the snapshot with the Flask resources
+and send the same bodies, ETags and compression. GET
+/api/promotions/changes/stream is served here too: its streams wait for
+changes on the event loop, so they hold no thread however long they stay
+open. Every other request is handed to the Flask app, which runs on a pool
+of ASGI_WSGI_THREADS threads. So are the rare reads that need an error
+response or an X-Fields mask, so those come out exactly as the Flask
+resources make them.
+
+Run it with:
+    gunicorn --worker-class uvicorn.workers.UvicornWorker service.asgi:app
+"""
+import asyncio
+import functools
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from flask_restx import inputs
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from werkzeug.http import quote_etag
+from werkzeug.wrappers import Request
+from service import app as flask_app, events, routes, snapshot
+from service.common.compression import compress_body
+from service.common.metrics import observe_request, serialization_timer
+from service.common.serialization import dumps
+from service.models import DatabaseConnectionError, DataValidationError, Promotion, PromotionChange, db
+
+# The async driver used in place of each synchronous one
+ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+CHANGE_STREAM_PATH = "/api/promotions/changes/stream"
+CHANGE_STREAM_HEADERS = [
+    ("Content-Type", "text/event-stream; charset=utf-8"),
+    ("Cache-Control", "no-cache, no-transform"),
+    ("X-Accel-Buffering", "no"),
+]
+
+
+def async_database_uri(uri: str) -> str:
+    """Returns a database URI with its driver switched to the async one"""
+    url = make_url(uri)
+    driver = ASYNC_DRIVERS.get(url.get_backend_name())
+    if driver:
+        url = url.set(drivername=driver)
+    return url.render_as_string(hide_password=False)
+
+
+def wsgi_environ(scope: dict) -> dict:
+    """Returns enough of the WSGI environ of an ASGI request for werkzeug to parse its query and headers"""
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "PATH_INFO": scope["path"],
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+    }
+    for name, value in scope["headers"]:
+        key = name.decode("latin-1").upper().replace("-", "_")
+        if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            key = "HTTP_" + key
+        value = value.decode("latin-1")
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+class PooledWsgiToAsgi(WsgiToAsgi):  # pylint: disable=too-few-public-methods
+    """Runs the WSGI app on a pool of threads
+
+    WsgiToAsgi runs it with sync_to_async(thread_sensitive=True), which puts
+    every request of the process on one shared thread
+    """
+
+    def __init__(self, wsgi_application, threads: int):
+        super().__init__(wsgi_application)
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix="asgi-wsgi")
+
+    async def __call__(self, scope, receive, send):
+        await PooledWsgiInstance(self.wsgi_application, self.executor)(scope, receive, send)
+
+
+class PooledWsgiInstance(WsgiToAsgiInstance):  # pylint: disable=too-few-public-methods
+    """One request handed to the WSGI app, run on a thread of the pool"""
+
+    def __init__(self, wsgi_application, executor: ThreadPoolExecutor):
+        super().__init__(wsgi_application)
+        self.executor = executor
+
+    async def run_wsgi_app(self, body):  # pylint: disable=invalid-overridden-method
+        run = sync_to_async(WsgiToAsgiInstance.run_wsgi_app.__wrapped__, thread_sensitive=False, executor=self.executor)
+        await run(self, body)
+
+
+class AsyncPromotionApp:
+    """ASGI app that answers the hot read paths itself and hands the rest to Flask
+
+    Each read handler returns (status, headers, body), or None to let the
+    Flask app answer the request instead
+    """
+
+    def __init__(self, wsgi_app):
+        self.flask_app = wsgi_app
+        self.wsgi = PooledWsgiToAsgi(wsgi_app, wsgi_app.config["ASGI_WSGI_THREADS"])
+        self.engine = None
+        self.sessions = None
+        self.routes = [
+            (re.compile(r"/api/promotions/(\d+)"), self.get_promotion, "promotion_resource"),
+            (re.compile(r"/api/promotions/codes/([^/]+)"), self.get_promotions_by_code, "promotion_code_resource"),
+            (re.compile(r"/api/products/(\d+)/promotions/active"), self.get_active_promotions,
+             "active_promotion_collection"),
+        ]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if self.is_change_stream(scope) and await self.stream_changes(scope, receive, send):
+            return
+        response, route = None, self.match(scope)
+        if route is not None:
+            if self.engine is None:
+                self.start()
+            started = time.perf_counter()
+            handler, argument, endpoint = route
+            if await self.prepare():
+                response = await handler(Request(wsgi_environ(scope)), argument)
+        if response is None:
+            await self.wsgi(scope, receive, send)
+            return
+        observe_request(endpoint, scope["method"], response[0], time.perf_counter() - started)
+        await send_response(send, *response)
+
+    def match(self, scope: dict):
+        """Returns the (handler, path argument, endpoint) of a request served here, if any"""
+        if scope["type"] != "http" or scope["method"] != "GET":
+            return None
+        mask_header = self.flask_app.config["RESTX_MASK_HEADER"].lower().encode("latin-1")
+        if any(name == mask_header for name, _ in scope["headers"]):
+            return None
+        for pattern, handler, endpoint in self.routes:
+            found = pattern.fullmatch(scope["path"])
+            if found:
+                return handler, found.group(1), endpoint
+        return None
+
+    @staticmethod
+    def is_change_stream(scope: dict) -> bool:
+        """Tells whether a request opens a stream of changes"""
+        return scope["type"] == "http" and scope["method"] == "GET" and scope["path"] == CHANGE_STREAM_PATH
+
+    ######################################################################
+    # Lifecycle
+    ######################################################################
+    def start(self):
+        """Creates the async engine of this worker process and listens for changes"""
+        config = self.flask_app.config
+        uri = config["ASYNC_DATABASE_URI"] or async_database_uri(config["SQLALCHEMY_DATABASE_URI"])
+        self.engine = create_async_engine(uri, **config["ASYNC_ENGINE_OPTIONS"])
+        self.sessions = async_sessionmaker(self.engine, expire_on_commit=False)
+        if Promotion.notifier:
+            with self.flask_app.app_context():
+                Promotion.notifier.start(db.engine)  # no-op unless we were forked
+
+    async def prepare(self) -> bool:
+        """Readies the database like the Flask app does before its first request
+
+        Returns False when the database cannot be reached, and the Flask app answers instead
+        """
+        if not Promotion.prepared:
+            try:
+                await asyncio.to_thread(self.in_app_context, Promotion.prepare)
+            except DatabaseConnectionError:
+                return False
+        return True
+
+    async def dispose(self):
+        """Closes the connections of the async engine"""
+        if self.engine is not None:
+            await self.engine.dispose()
+            self.engine = self.sessions = None
+
+    async def lifespan(self, receive, send):
+        """Starts and stops the engine with the ASGI server"""
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.start()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.dispose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    ######################################################################
+    # Read paths
+    ######################################################################
+    async def get_promotion(self, request: Request, promotion_id: str):
+        """Returns a single Promotion like GET /api/promotions/{id}"""
+        try:
+            field_names = routes.parse_fields(request.args.get("fields"))
+        except DataValidationError:
+            return None
+        promotion_id = int(promotion_id)
+        values = Promotion.cache.get(promotion_id)
+        if values is None:
+            generation = Promotion.cache.generation
+            statement = select(*Promotion.__table__.columns).where(Promotion.id == promotion_id)
+            async with self.sessions() as session:
+                row = (await session.execute(statement)).first()
+            if row is None:
+                return None
+            values = dict(row._mapping)  # pylint: disable=protected-access
+            Promotion.cache.set(promotion_id, values, generation)
+        promotion = SimpleNamespace(**values)
+        etag = routes.promotion_etag(promotion, field_names)
+        if request.if_none_match.contains_weak(etag):
+            return 304, [("ETag", quote_etag(etag))], b""
+        with serialization_timer("promotion_resource"):
+            body = dumps(routes.promotion_record(promotion, field_names))
+        return self.json_response(request, body, etag)
+
+    async def get_promotions_by_code(self, request: Request, code: str):
+        """Returns the Promotions with a promo code like GET /api/promotions/codes/{code}"""
+        try:
+            ignore_case = inputs.boolean(request.args.get("ignore_case", False))
+        except ValueError:
+            return None
+        key = Promotion.code_key(code, ignore_case)
+        rows = Promotion.cached_code(key)
+        if rows is None:
+            generations = Promotion.code_cache.generation, Promotion.missing_code_cache.generation
+            async with self.sessions() as session:
+                rows = tuple(await session.execute(Promotion.code_statement(code, ignore_case)))
+            Promotion.remember_code(key, rows, generations)
+        if not rows:
+            return None
+        with serialization_timer("promotion_code_resource"):
+            body = dumps([routes.promotion_record(row) for row in rows])
+        return self.json_response(request, body)
+
+    async def get_active_promotions(self, request: Request, product_id: str):
+        """Returns the active Promotions of a product like GET /api/products/{id}/promotions/active"""
+        try:
+            at = routes.parse_datetime(request.args["at"]) if request.args.get("at") else None  # pylint: disable=invalid-name
+        except DataValidationError:
+            return None
+        at = at or datetime.now(timezone.utc)  # pylint: disable=invalid-name
+        product_ids = [int(product_id)]
+        rows = None
+        if self.flask_app.config["SNAPSHOT_ENABLED"]:
+            current = snapshot.store.peek() or await asyncio.to_thread(self.in_app_context, snapshot.store.get)
+            if current.covers(at):
+                rows = current.active_for_products(product_ids, at)
+        if rows is None:
+            statement = select(*routes.RECORD_COLUMNS).where(*Promotion.active_criteria(product_ids, at))
+            async with self.sessions() as session:
+                rows = (await session.execute(statement.order_by(Promotion.id))).all()
+        with serialization_timer("active_promotion_collection"):
+            body = dumps([routes.promotion_record(row) for row in rows])
+        return self.json_response(request, body)
+
+    ######################################################################
+    # Change stream
+    ######################################################################
+    async def stream_changes(self, scope: dict, receive, send) -> bool:
+        """Streams the changes like GET /api/promotions/changes/stream, on the event loop
+
+        Returns False when the Flask app answers instead: bad arguments or no database
+        """
+        try:
+            since = change_stream_start(Request(wsgi_environ(scope)))
+        except ValueError:
+            return False
+        if self.engine is None:
+            self.start()
+        if not await self.prepare():
+            return False
+        started = time.perf_counter()
+        if since is None:
+            since = await asyncio.to_thread(self.in_app_context, PromotionChange.last_seq)
+        try:
+            events.hub.open()
+        except events.StreamLimitError as error:
+            observe_request("promotion_change_stream", "GET", 503, time.perf_counter() - started)
+            body = dumps({"message": str(error)})
+            await send_response(send, 503, [("Content-Type", "application/json"), ("Content-Length", str(len(body)))],
+                                body)
+            return True
+        try:
+            await send({"type": "http.response.start", "status": 200, "headers": encode_headers(CHANGE_STREAM_HEADERS)})
+            observe_request("promotion_change_stream", "GET", 200, time.perf_counter() - started)
+            await self.send_change_events(since, receive, send)
+        finally:
+            events.hub.close()
+        return True
+
+    async def send_change_events(self, since: int, receive, send):
+        """Sends the changes after since as Server-Sent Events until the stream ends or the client leaves"""
+        config = self.flask_app.config
+        deadline = time.monotonic() + config["EVENTS_MAX_DURATION"]
+        disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+        try:
+            await send_body(send, f"retry: {config['EVENTS_RETRY_MS']}\n\n")
+            while not disconnected.done():
+                generation = events.hub.generation
+                read = functools.partial(routes.read_change_events, since)
+                batch, has_more = await asyncio.to_thread(self.in_app_context, read)
+                if batch:
+                    since = batch[-1][0]
+                    await send_body(send, "".join(event for _, event in batch))
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                if not has_more:
+                    await self.wait_for_change(generation, min(config["EVENTS_HEARTBEAT"], remaining),
+                                               disconnected, send)
+        finally:
+            disconnected.cancel()
+        await send({"type": "http.response.body", "body": b""})
+
+    @staticmethod
+    async def wait_for_change(generation: int, timeout: float, disconnected, send):
+        """Waits for the next change, sending a keep-alive comment when none came in time"""
+        changed = asyncio.ensure_future(events.hub.wait_async(generation, timeout))
+        await asyncio.wait({changed, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+        if not changed.done():
+            changed.cancel()
+        elif not changed.result():
+            await send_body(send, ": keep-alive\n\n")
+
+    ######################################################################
+    # Helpers
+    ######################################################################
+    def in_app_context(self, func):
+        """Calls a function that uses the Flask-SQLAlchemy session, from a worker thread"""
+        with self.flask_app.app_context():
+            return func()
+
+    def json_response(self, request: Request, body: bytes, etag: str = None) -> tuple:
+        """Returns a 200 JSON response, compressed like the Flask app would"""
+        headers = [("Content-Type", "application/json"), ("Vary", "Accept-Encoding")]
+        config = self.flask_app.config
+        encoding = request.accept_encodings.best_match(self.flask_app.extensions["compression"])
+        compressed = encoding is not None and len(body) >= config["COMPRESSION_MIN_SIZE"]
+        if compressed:
+            body = compress_body(body, encoding, config)
+            headers.append(("Content-Encoding", encoding))
+        if etag:
+            # the compressed bytes differ, so the tag can only stay as a weak validator
+            headers.append(("ETag", quote_etag(etag, weak=compressed)))
+        headers.append(("Content-Length", str(len(body))))
+        return 200, headers, body
+
+
+def change_stream_start(request: Request):
+    """Returns the seq a change stream starts after: Last-Event-ID, else since, else None for now
+
+    Raises:
+        ValueError: when either one is not an integer
+    """
+    values = [int(value) for value in (request.headers.get("Last-Event-ID"), request.args.get("since"))
+              if value is not None]
+    return values[0] if values else None
+
+
+def encode_headers(headers: list) -> list:
+    """Returns response headers the way ASGI sends them"""
+    return [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]
+
+
+async def send_response(send, status_code: int, headers: list, body: bytes):
+    """Sends a complete response to the ASGI server"""
+    await send({"type": "http.response.start", "status": status_code, "headers": encode_headers(headers)})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def send_body(send, text: str):
+    """Sends part of a streamed response"""
+    await send({"type": "http.response.body", "body": text.encode("utf-8"), "more_body": True})
+
+
+async def wait_for_disconnect(receive):
+    """Returns once the client has gone away"""
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+app = AsyncPromotionApp(flask_app)
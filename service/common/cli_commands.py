@@ -1,8 +1,15 @@
 """
 Flask CLI Command Extensions
+
+The commands are registered with the app through the commands blueprint
 """
-from service import app
-from service.models import db
+from datetime import datetime, timedelta, timezone
+import click
+from flask import Blueprint, current_app
+from service.models import db, Promotion
+from service.sweeper import sweeper
+
+commands = Blueprint("commands", __name__, cli_group=None)
 
 
 ######################################################################
@@ -10,7 +17,7 @@ from service.models import db
 # Usage:
 #   flask db-create
 ######################################################################
-@app.cli.command("db-create")
+@commands.cli.command("db-create")
 def db_create():
     """
     Recreates a local database. You probably should not use this on
@@ -19,3 +26,57 @@ def db_create():
     db.drop_all()
     db.create_all()
     db.session.commit()
+
+
+######################################################################
+# Command to bring an existing database up to date
+# Usage:
+#   flask db-migrate
+######################################################################
+@commands.cli.command("db-migrate")
+def db_migrate():
+    """
+    Creates any missing tables, columns and indexes without
+    touching existing data. Safe to run on production.
+    """
+    db.create_all()
+    Promotion.add_missing_columns()
+    Promotion.create_indexes()
+
+
+######################################################################
+# Command to deactivate the promotions that have ended
+# Usage:
+#   flask expire-promotions
+######################################################################
+@commands.cli.command("expire-promotions")
+@click.option("--batch-size", type=int, default=None, help="Promotions deactivated per transaction")
+def expire_promotions(batch_size):
+    """
+    Deactivates every site-wide promotion whose end date has
+    passed. Safe to run from cron on any number of hosts.
+    """
+    Promotion.prepare()
+    expired = sweeper.sweep(batch_size or current_app.config["SWEEPER_BATCH_SIZE"])
+    click.echo(f"Deactivated {len(expired)} promotions that ended")
+
+
+######################################################################
+# Command to move the promotions that ended long ago to the archive
+# Usage:
+#   flask archive-promotions
+######################################################################
+@commands.cli.command("archive-promotions")
+@click.option("--older-than-days", type=int, default=None, help="Archive promotions that ended this many days ago")
+@click.option("--batch-size", type=int, default=None, help="Promotions moved per transaction")
+def archive_promotions(older_than_days, batch_size):
+    """
+    Moves the promotions that ended long ago to the archive table
+    in small batches. They can still be read by id.
+    """
+    config = current_app.config
+    days = config["ARCHIVE_AFTER_DAYS"] if older_than_days is None else older_than_days
+    Promotion.prepare()
+    before = datetime.now(timezone.utc) - timedelta(days=days)
+    archived = Promotion.archive_ended(before, batch_size or config["ARCHIVE_BATCH_SIZE"])
+    click.echo(f"Archived {len(archived)} promotions that ended before {before:%Y-%m-%d}")
@@ -0,0 +1,117 @@
+"""
+Response Compression
+
+Compresses response bodies with br, zstd or gzip, whichever the client
+prefers in Accept-Encoding among the algorithms that are configured and
+installed. Streamed responses are compressed chunk by chunk as they are
+generated, so they keep streaming.
+"""
+import zlib
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+COMPRESSIBLE_TYPES = {
+    "application/json", "application/x-ndjson", "application/xml",
+    "application/javascript", "image/svg+xml",
+}
+
+
+def gzip_compressor(level: int) -> tuple:
+    """Returns the (compress, finish) functions of a gzip stream"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress, compressor.flush
+
+
+def brotli_compressor(level: int) -> tuple:
+    """Returns the (compress, finish) functions of a brotli stream"""
+    compressor = brotli.Compressor(quality=level)
+    return compressor.process, compressor.finish
+
+
+def zstd_compressor(level: int) -> tuple:
+    """Returns the (compress, finish) functions of a zstandard stream"""
+    compressor = zstandard.ZstdCompressor(level=level).compressobj()
+    return compressor.compress, compressor.flush
+
+
+# content-coding -> (compressor factory, level setting), for the installed libraries
+COMPRESSORS = {"gzip": (gzip_compressor, "COMPRESSION_GZIP_LEVEL")}
+if brotli is not None:
+    COMPRESSORS["br"] = (brotli_compressor, "COMPRESSION_BROTLI_LEVEL")
+if zstandard is not None:
+    COMPRESSORS["zstd"] = (zstd_compressor, "COMPRESSION_ZSTD_LEVEL")
+
+
+def init_compression(app):
+    """Compresses the responses of the app"""
+    names = [name.strip() for name in app.config["COMPRESSION_ALGORITHMS"].split(",")]
+    app.extensions["compression"] = [name for name in names if name in COMPRESSORS]
+    app.after_request(compress_response)
+
+
+def is_compressible(response) -> bool:
+    """Tells whether a response has a body that is worth compressing"""
+    if response.status_code not in (200, 201) or request.method == "HEAD":
+        return False  # partial content cannot be compressed as a whole
+    if "Content-Encoding" in response.headers or "no-transform" in response.cache_control:
+        return False
+    mimetype = response.mimetype or ""
+    return mimetype.startswith("text/") or mimetype in COMPRESSIBLE_TYPES
+
+
+def compress_response(response):
+    """Compresses a response with the best content-coding the client accepts"""
+    if not is_compressible(response):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = request.accept_encodings.best_match(current_app.extensions["compression"])
+    if encoding is None:
+        return response
+    if not response.is_streamed and response.calculate_content_length() < current_app.config["COMPRESSION_MIN_SIZE"]:
+        return response
+
+    if response.is_streamed:
+        factory, level_setting = COMPRESSORS[encoding]
+        compress, finish = factory(current_app.config[level_setting])
+        response.response = compressed_chunks(response.response, compress, finish)
+        response.direct_passthrough = False
+        response.headers.pop("Content-Length", None)
+    else:
+        response.set_data(compress_body(response.get_data(), encoding, current_app.config))
+    response.headers["Content-Encoding"] = encoding
+    # the compressed bytes differ, so the tag can only stay as a weak validator
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def compress_body(data: bytes, encoding: str, config) -> bytes:
+    """Compresses a whole body with a content-coding at its configured level"""
+    factory, level_setting = COMPRESSORS[encoding]
+    compress, finish = factory(config[level_setting])
+    return compress(data) + finish()
+
+
+def compressed_chunks(chunks, compress, finish):
+    """Compresses a stream of chunks, passing compressed output on as soon as there is some"""
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            data = compress(chunk)
+            if data:
+                yield data
+        yield finish()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
@@ -17,8 +17,10 @@
 """
 Module: error_handlers
 """
-from service.models import DataValidationError
-from service import app, api
+from flask import current_app as app, jsonify
+from sqlalchemy.orm.exc import StaleDataError
+from service.models import DatabaseConnectionError, DataValidationError, db
+from service.routes import api, site
 from . import status
 
 
@@ -35,3 +37,35 @@ def request_validation_error(error):
         'error': 'Bad Request',
         'message': message
     }, status.HTTP_400_BAD_REQUEST
+
+
+@api.errorhandler(StaleDataError)
+def concurrent_update_error(error):
+    """ Handles a Promotion that changed between reading and writing it """
+    message = str(error)
+    app.logger.warning(message)
+    db.session.rollback()
+    return {
+        'status_code': status.HTTP_412_PRECONDITION_FAILED,
+        'error': 'Precondition Failed',
+        'message': 'The Promotion was modified by someone else, fetch it again and retry'
+    }, status.HTTP_412_PRECONDITION_FAILED
+
+
+@api.errorhandler(DatabaseConnectionError)
+def database_connection_error(error):
+    """ Handles a database that cannot be reached """
+    message = str(error)
+    app.logger.critical(message)
+    return {
+        'status_code': status.HTTP_503_SERVICE_UNAVAILABLE,
+        'error': 'Service Unavailable',
+        'message': message
+    }, status.HTTP_503_SERVICE_UNAVAILABLE
+
+
+@site.app_errorhandler(DatabaseConnectionError)
+def database_connection_error_page(error):
+    """ Handles a database that cannot be reached outside of the REST API """
+    body, code = database_connection_error(error)
+    return jsonify(body), code
@@ -0,0 +1,176 @@
+"""
+Prometheus Metrics
+
+Records request counts and latency per flask-restx resource and method,
+the number and duration of database queries of each request, and the
+time spent serializing Promotions, and serves them at /metrics.
+
+How long the process took to build the app and to prepare the database
+is exported too, to keep an eye on cold starts.
+
+Under gunicorn, point PROMETHEUS_MULTIPROC_DIR at an empty directory
+before the workers start so that every worker's samples are combined.
+"""
+import os
+import time
+from flask import Response, g, has_request_context, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest, multiprocess
+)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from service.common.db_pool import pool_stats
+from service.models import Promotion
+
+REQUEST_COUNT = Counter(
+    "promotions_http_requests_total", "HTTP requests handled",
+    ["endpoint", "method", "status"]
+)
+REQUEST_LATENCY = Histogram(
+    "promotions_http_request_duration_seconds", "Time spent handling an HTTP request",
+    ["endpoint", "method"]
+)
+DB_QUERIES = Histogram(
+    "promotions_db_queries_per_request", "Database queries issued by one HTTP request",
+    ["endpoint", "method"], buckets=(0, 1, 2, 3, 5, 10, 25, 50, 100)
+)
+DB_TIME = Histogram(
+    "promotions_db_duration_seconds_per_request", "Time one HTTP request spent in database queries",
+    ["endpoint", "method"]
+)
+SERIALIZATION_TIME = Histogram(
+    "promotions_serialization_duration_seconds", "Time spent serializing Promotions for a response",
+    ["endpoint"]
+)
+
+STARTUP_TIME = Gauge(
+    "promotions_startup_seconds", "Time this process spent building the app and preparing the database",
+    ["phase"], multiprocess_mode="liveall"
+)
+# Seconds spent in each startup phase of this process
+startup_times = {}
+
+# Per-process counters kept by the cache and the pool, summed over live workers
+CACHE_EVENTS = Gauge(
+    "promotions_cache_events", "Promotion cache hits, misses, evictions and expirations",
+    ["event"], multiprocess_mode="livesum"
+)
+CACHE_SIZE = Gauge("promotions_cache_size", "Promotions held in the cache", multiprocess_mode="livesum")
+POOL_CHECKOUTS = Gauge(
+    "promotions_db_pool_checkouts", "Database connection checkouts", multiprocess_mode="livesum"
+)
+POOL_TIMEOUTS = Gauge(
+    "promotions_db_pool_timeouts", "Database connection checkouts that timed out", multiprocess_mode="livesum"
+)
+POOL_WAIT = Gauge(
+    "promotions_db_pool_wait_seconds", "Total time spent waiting for a database connection",
+    multiprocess_mode="livesum"
+)
+
+
+def init_metrics(app):
+    """Instruments the app and adds the /metrics endpoint"""
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    app.add_url_rule("/metrics", "metrics", metrics)
+    if not event.contains(Engine, "before_cursor_execute", start_query):
+        event.listen(Engine, "before_cursor_execute", start_query)
+        event.listen(Engine, "after_cursor_execute", finish_query)
+
+
+def record_startup(phase: str, seconds: float):
+    """Records how long a startup phase of this process took"""
+    startup_times[phase] = round(seconds, 6)
+    STARTUP_TIME.labels(phase=phase).set(seconds)
+
+
+def startup_stats() -> dict:
+    """Returns the seconds spent in each startup phase of this process so far"""
+    if Promotion.prepared and "prepare_db" not in startup_times:
+        record_startup("prepare_db", Promotion.prepare_seconds)
+    return dict(startup_times)
+
+
+def endpoint_label() -> str:
+    """Returns the flask-restx resource that handled the current request"""
+    return request.endpoint or "unmatched"
+
+
+def serialization_timer(endpoint: str = None):
+    """Returns a context manager that times serializing the current response"""
+    return SERIALIZATION_TIME.labels(endpoint=endpoint or endpoint_label()).time()
+
+
+def observe_request(endpoint: str, method: str, status_code: int, seconds: float):
+    """Records a request answered outside of Flask, such as by the ASGI read paths"""
+    REQUEST_COUNT.labels(endpoint, method, status_code).inc()
+    REQUEST_LATENCY.labels(endpoint, method).observe(seconds)
+
+
+######################################################################
+# Request hooks
+######################################################################
+def start_request():
+    """Starts the clock and the query counters of a request"""
+    g.metrics_start = time.perf_counter()
+    g.db_queries = 0
+    g.db_seconds = 0.0
+
+
+def finish_request(response):
+    """Records the latency and database use of a finished request"""
+    if "metrics_start" not in g or request.endpoint == "metrics":
+        return response
+    endpoint, method = endpoint_label(), request.method
+    REQUEST_COUNT.labels(endpoint, method, response.status_code).inc()
+    REQUEST_LATENCY.labels(endpoint, method).observe(time.perf_counter() - g.metrics_start)
+    DB_QUERIES.labels(endpoint, method).observe(g.db_queries)
+    DB_TIME.labels(endpoint, method).observe(g.db_seconds)
+    update_process_gauges()
+    return response
+
+
+######################################################################
+# SQLAlchemy hooks
+######################################################################
+def start_query(conn, cursor, statement, parameters, context, executemany):  # pylint: disable=unused-argument
+    """Notes when a query starts, on its execution context so a query that fails leaves nothing behind"""
+    if context is not None:
+        context.metrics_query_start = time.perf_counter()
+
+
+def finish_query(conn, cursor, statement, parameters, context, executemany):  # pylint: disable=unused-argument
+    """Adds a finished query to the counters of the current request"""
+    started = getattr(context, "metrics_query_start", None)
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    if has_request_context() and "db_queries" in g:
+        g.db_queries += 1
+        g.db_seconds += elapsed
+
+
+######################################################################
+# /metrics endpoint
+######################################################################
+def metrics():
+    """Serves the metrics of every worker in the Prometheus text format"""
+    update_process_gauges()
+    registry = REGISTRY
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+def update_process_gauges():
+    """Copies the cache and pool counters, and the database preparation time, of this process into the gauges"""
+    startup_stats()
+    cache = Promotion.cache.stats()
+    for name in ("hits", "misses", "evictions", "expirations"):
+        CACHE_EVENTS.labels(event=name).set(cache[name])
+    CACHE_SIZE.set(cache["size"])
+    pool = pool_stats.stats()
+    POOL_CHECKOUTS.set(pool["checkouts"])
+    POOL_TIMEOUTS.set(pool["timeouts"])
+    POOL_WAIT.set(pool["wait_seconds_total"])
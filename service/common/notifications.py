@@ -0,0 +1,108 @@
+"""
+Change Notifications
+
+Shares committed Promotion changes between worker processes with
+PostgreSQL LISTEN/NOTIFY, so every gunicorn worker can drop the
+cache entries that another worker made stale
+"""
+import json
+import logging
+import os
+import select
+import socket
+import threading
+import time
+from sqlalchemy import text
+
+logger = logging.getLogger("flask.app")
+
+# NOTIFY payloads must stay under 8000 bytes, larger batches are sent without ids
+MAX_PAYLOAD_SIZE = 7000
+POLL_TIMEOUT = 5.0
+RECONNECT_DELAY = 2.0
+
+
+def origin() -> str:
+    """Identifies this process among all the workers of every host"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class ChangeNotifier:
+    """Publishes change events with NOTIFY and relays the events of other processes
+
+    The callback is called as callback(action, ids) from a background
+    thread. ids is None when the exact rows are unknown, which happens
+    for oversized batches and after the listener had to reconnect.
+    """
+
+    def __init__(self, channel: str, callback):
+        self.channel = channel
+        self.callback = callback
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def publish(self, session, changes: list):
+        """Sends one NOTIFY per change as part of the session's transaction
+
+        PostgreSQL only delivers the notifications if the transaction commits
+        """
+        for action, ids in changes:
+            payload = json.dumps({"origin": origin(), "action": action, "ids": ids})
+            if len(payload) > MAX_PAYLOAD_SIZE:
+                payload = json.dumps({"origin": origin(), "action": action, "ids": None})
+            session.execute(text("SELECT pg_notify(:channel, :payload)"),
+                            {"channel": self.channel, "payload": payload})
+
+    def start(self, engine):
+        """Starts listening in this process, unless a listener is already running
+
+        Safe to call again after a fork: the child gets its own listener
+        """
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        listener = threading.Thread(target=self._listen, args=(engine,),
+                                    name="promotion-change-listener", daemon=True)
+        listener.start()
+
+    def stop(self):
+        """Stops the listener of this process within POLL_TIMEOUT seconds"""
+        with self._lock:
+            self._pid = None
+
+    def _listen(self, engine):
+        """Keeps a LISTEN connection open, reconnecting whenever it drops"""
+        while self._pid == os.getpid():
+            try:
+                self._listen_on_connection(engine)
+            except Exception as error:  # pylint: disable=broad-except
+                logger.warning("Change listener disconnected: %s", error)
+            time.sleep(RECONNECT_DELAY)
+
+    def _listen_on_connection(self, engine):
+        """Listens on one dedicated connection until it fails"""
+        connection = engine.raw_connection()
+        connection.detach()  # never hand this connection back to the pool
+        try:
+            dbapi_connection = connection.dbapi_connection
+            dbapi_connection.autocommit = True
+            dbapi_connection.cursor().execute(f'LISTEN "{self.channel}"')
+            logger.info("Listening for promotion changes on %s", self.channel)
+            # anything published while we were not listening is lost
+            self.callback("reset", None)
+            while self._pid == os.getpid():
+                if select.select([dbapi_connection], [], [], POLL_TIMEOUT) == ([], [], []):
+                    continue
+                dbapi_connection.poll()
+                while dbapi_connection.notifies:
+                    self._handle(dbapi_connection.notifies.pop(0).payload)
+        finally:
+            connection.close()
+
+    def _handle(self, payload: str):
+        """Relays a notification from another process to the callback"""
+        message = json.loads(payload)
+        if message["origin"] == origin():
+            return  # our own changes were already dispatched locally
+        self.callback(message["action"], message["ids"])
@@ -2,6 +2,7 @@
 Global Configuration for Application
 """
 import os
+from service.common.db_pool import TimedQueuePool
 
 # Get configuration from environment
 DATABASE_URI = os.getenv(
@@ -12,5 +13,118 @@ DATABASE_URI = os.getenv(
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Set DB_PGBOUNCER=true when connecting through PgBouncer in transaction pooling
+# mode: no session-level state (startup options, LISTEN) is used on connections
+DB_PGBOUNCER = os.getenv("DB_PGBOUNCER", "false").lower() in ("true", "1", "yes")
+# Milliseconds a statement may run before PostgreSQL cancels it (0 disables it)
+DB_STATEMENT_TIMEOUT = int(os.getenv("DB_STATEMENT_TIMEOUT", "0"))
+
+# Connection pool of the SQLAlchemy engine, tune per gunicorn worker so that
+# workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) stays below max_connections
+SQLALCHEMY_ENGINE_OPTIONS = {}
+if DATABASE_URI.startswith("postgresql"):
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        "poolclass": TimedQueuePool,
+        "pool_size": int(os.getenv("DB_POOL_SIZE", "5")),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "10")),
+        "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", "30")),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+        "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "true").lower() in ("true", "1", "yes"),
+        "connect_args": {},
+    }
+    if DB_STATEMENT_TIMEOUT and not DB_PGBOUNCER:
+        # PgBouncer rejects startup options, set the timeout on the role instead
+        SQLALCHEMY_ENGINE_OPTIONS["connect_args"]["options"] = f"-c statement_timeout={DB_STATEMENT_TIMEOUT}"
+
+# Async engine of the ASGI read paths (service.asgi), derived from DATABASE_URI by
+# switching to the asyncpg (or aiosqlite) driver unless set explicitly
+ASYNC_DATABASE_URI = os.getenv("ASYNC_DATABASE_URI", "")
+ASYNC_ENGINE_OPTIONS = {}
+if DATABASE_URI.startswith("postgresql"):
+    ASYNC_ENGINE_OPTIONS = {
+        "pool_size": int(os.getenv("ASYNC_DB_POOL_SIZE", "20")),
+        "max_overflow": int(os.getenv("ASYNC_DB_MAX_OVERFLOW", "20")),
+        "pool_timeout": SQLALCHEMY_ENGINE_OPTIONS["pool_timeout"],
+        "pool_recycle": SQLALCHEMY_ENGINE_OPTIONS["pool_recycle"],
+        "pool_pre_ping": SQLALCHEMY_ENGINE_OPTIONS["pool_pre_ping"],
+        "connect_args": {},
+    }
+    if DB_PGBOUNCER:
+        # transaction pooling cannot keep the prepared statements asyncpg caches per connection
+        ASYNC_ENGINE_OPTIONS["connect_args"].update(statement_cache_size=0, prepared_statement_cache_size=0)
+    elif DB_STATEMENT_TIMEOUT:
+        ASYNC_ENGINE_OPTIONS["connect_args"]["server_settings"] = {"statement_timeout": str(DB_STATEMENT_TIMEOUT)}
+# Threads of the ASGI app that run the requests it hands to the Flask app
+ASGI_WSGI_THREADS = int(os.getenv("ASGI_WSGI_THREADS", "8"))
+
+# Keyset pagination for list endpoints
+DEFAULT_PAGE_SIZE = int(os.getenv("DEFAULT_PAGE_SIZE", "100"))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "1000"))
+
+# Most ids GET /promotions?ids= resolves in one query
+BATCH_GET_MAX_IDS = int(os.getenv("BATCH_GET_MAX_IDS", "500"))
+
+# Number of rows fetched per round-trip when streaming an export
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+
+# Limits for the bulk create/update/delete endpoint
+BATCH_MAX_OPERATIONS = int(os.getenv("BATCH_MAX_OPERATIONS", "50000"))
+BATCH_CHUNK_SIZE = int(os.getenv("BATCH_CHUNK_SIZE", "1000"))
+
+# Largest cart that POST /promotions/evaluate prices in one call
+PRICING_MAX_LINES = int(os.getenv("PRICING_MAX_LINES", "10000"))
+
+# In-memory snapshot of the unexpired promotions used by the checkout-time lookups,
+# fully rebuilt at least every SNAPSHOT_MAX_AGE seconds in case a change was missed
+SNAPSHOT_ENABLED = os.getenv("SNAPSHOT_ENABLED", "true").lower() in ("true", "1", "yes")
+SNAPSHOT_MAX_AGE = float(os.getenv("SNAPSHOT_MAX_AGE", "300"))
+
+# In-process cache of single Promotion lookups (size 0 disables it)
+CACHE_MAX_SIZE = int(os.getenv("CACHE_MAX_SIZE", "10000"))
+CACHE_TTL = float(os.getenv("CACHE_TTL", "60"))
+
+# In-process caches of promo code lookups: found codes, and unknown codes for a shorter time
+CODE_CACHE_MAX_SIZE = int(os.getenv("CODE_CACHE_MAX_SIZE", "10000"))
+CODE_CACHE_TTL = float(os.getenv("CODE_CACHE_TTL", "60"))
+CODE_NEGATIVE_CACHE_TTL = float(os.getenv("CODE_NEGATIVE_CACHE_TTL", "5"))
+
+# PostgreSQL NOTIFY channel used to tell other workers about changes (empty disables it)
+CHANGE_NOTIFY_CHANNEL = os.getenv("CHANGE_NOTIFY_CHANNEL", "promotion_changes")
+if DB_PGBOUNCER:
+    CHANGE_NOTIFY_CHANNEL = ""  # LISTEN needs a session that transaction pooling does not keep
+
+# Server-Sent Events streams of changes: each one holds a worker thread (or greenlet), so keep
+# EVENTS_MAX_STREAMS below GUNICORN_THREADS unless the workers are gevent. The ASGI app of
+# uvicorn workers serves the streams on its event loop, without holding any thread
+EVENTS_MAX_STREAMS = int(os.getenv("EVENTS_MAX_STREAMS", "2"))
+EVENTS_BATCH_SIZE = int(os.getenv("EVENTS_BATCH_SIZE", "100"))
+# comment sent while no change arrives, so proxies keep the connection open
+EVENTS_HEARTBEAT = float(os.getenv("EVENTS_HEARTBEAT", "15"))
+# streams end after this long and the client resumes with Last-Event-ID, which frees the worker
+EVENTS_MAX_DURATION = float(os.getenv("EVENTS_MAX_DURATION", "300"))
+EVENTS_RETRY_MS = int(os.getenv("EVENTS_RETRY_MS", "1000"))
+
+# Deactivation of site-wide promotions whose end_date has passed: run `flask expire-promotions`
+# from cron, or set SWEEPER_ENABLED so every worker sweeps as soon as a promotion ends
+SWEEPER_ENABLED = os.getenv("SWEEPER_ENABLED", "false").lower() in ("true", "1", "yes")
+SWEEPER_BATCH_SIZE = int(os.getenv("SWEEPER_BATCH_SIZE", "1000"))
+# the heap holds the next SWEEPER_HEAP_SIZE end dates and is reloaded at least every SWEEPER_MAX_SLEEP seconds
+SWEEPER_HEAP_SIZE = int(os.getenv("SWEEPER_HEAP_SIZE", "1000"))
+SWEEPER_MAX_SLEEP = float(os.getenv("SWEEPER_MAX_SLEEP", "60"))
+
+# `flask archive-promotions` moves promotions that ended more than ARCHIVE_AFTER_DAYS days ago
+# out of the promotion table, ARCHIVE_BATCH_SIZE rows per transaction
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "90"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "1000"))
+
+# Response compression negotiated with Accept-Encoding, in order of preference
+# (br and zstd are only offered when the brotli and zstandard packages are installed)
+COMPRESSION_ALGORITHMS = os.getenv("COMPRESSION_ALGORITHMS", "br,zstd,gzip")
+# Bodies smaller than this many bytes are sent uncompressed (streams are always compressed)
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", "6"))
+COMPRESSION_BROTLI_LEVEL = int(os.getenv("COMPRESSION_BROTLI_LEVEL", "4"))
+COMPRESSION_ZSTD_LEVEL = int(os.getenv("COMPRESSION_ZSTD_LEVEL", "3"))
+
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "s3cr3t-key-shhhh")
@@ -0,0 +1,97 @@
+"""
+Promotion Change Events
+
+Wakes the Server-Sent Events streams of this process whenever a
+Promotion change is committed, here or (through LISTEN/NOTIFY) in
+another worker.
+
+The hub only counts changes, it never queues them: each stream reads the
+change log itself from the last seq it sent. A slow client therefore
+holds no buffer in the server, it just reads a bigger batch the next time
+it catches up, and a client that reconnects with Last-Event-ID resumes
+exactly where it stopped.
+"""
+import asyncio
+import logging
+import threading
+from service.models import change_subscribers
+
+logger = logging.getLogger("flask.app")
+
+
+class StreamLimitError(Exception):
+    """Raised when this process already serves as many streams as it may"""
+
+
+class ChangeHub:
+    """Lets the streams of this process wait for the next committed change"""
+
+    def __init__(self, max_streams: int = 0):
+        self.max_streams = max_streams
+        self.generation = 0
+        self.streams = 0
+        self.rejected = 0
+        self._condition = threading.Condition()
+        self._waiters = set()
+
+    def on_change(self, action: str, promotion_ids):  # pylint: disable=unused-argument
+        """Wakes every waiting stream (subscribed to committed Promotion changes)"""
+        with self._condition:
+            self.generation += 1
+            self._condition.notify_all()
+            waiters = list(self._waiters)
+        for loop, woken in waiters:
+            loop.call_soon_threadsafe(woken.set)
+
+    def wait(self, generation: int, timeout: float) -> bool:
+        """Waits until a change arrives after generation, returning False on timeout"""
+        with self._condition:
+            return self._condition.wait_for(lambda: self.generation != generation, timeout)
+
+    async def wait_async(self, generation: int, timeout: float) -> bool:
+        """Waits like wait() on the event loop, so the streams of the ASGI app hold no thread"""
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._condition:
+            if self.generation != generation:
+                return True
+            self._waiters.add(waiter)
+        try:
+            await asyncio.wait_for(waiter[1].wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self._condition:
+                self._waiters.discard(waiter)
+
+    def open(self):
+        """Counts a new stream in
+
+        Raises:
+            StreamLimitError: when max_streams streams are already open
+        """
+        with self._condition:
+            if self.streams >= self.max_streams:
+                self.rejected += 1
+                raise StreamLimitError(f"This worker already serves {self.max_streams} change streams")
+            self.streams += 1
+
+    def close(self):
+        """Counts a stream out"""
+        with self._condition:
+            self.streams -= 1
+
+    def stats(self) -> dict:
+        """Returns the number of open and rejected streams"""
+        return {"streams": self.streams, "max_streams": self.max_streams, "rejected": self.rejected}
+
+
+# The hub shared by every thread of this process
+hub = ChangeHub()
+
+
+def init_events(app):
+    """Configures the hub and subscribes it to committed changes"""
+    hub.max_streams = app.config["EVENTS_MAX_STREAMS"]
+    if hub.on_change not in change_subscribers:
+        change_subscribers.append(hub.on_change)
@@ -6,6 +6,8 @@ All of the models are stored in this module
 Models
 ------
 Promotion - A representation of a special promotion/sale that is running against product
+PromotionChange - One committed change to a Promotion in the append-only change log
+PromotionArchive - A Promotion that ended long ago, moved out of the promotion table
 
 Attributes:
 -----------
@@ -18,13 +20,23 @@ start_date (timestamp)= start date of promotion
 end_date (timestamp)= end date of promotion
 is_site_wide (bool)= status whether promotion is site-wide
 product_id (int) = id of the product
+version (int) = row version, bumped on every update
 """
 
 import logging
+import threading
+import time
 from enum import Enum
-from datetime import datetime
-from flask import Flask
+from datetime import datetime, timezone
+from flask import Flask, request
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import bindparam, delete, event, insert, or_, text, update
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.schema import CreateColumn, CreateIndex
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
+from service.common.cache import TTLCache
+from service.common.notifications import ChangeNotifier
 
 
 logger = logging.getLogger("flask.app")
@@ -32,6 +44,18 @@ logger = logging.getLogger("flask.app")
 # Create the SQLAlchemy object to be initialized later in init_db()
 db = SQLAlchemy()
 
+# Key in Session.info holding the changes to announce once the transaction commits
+PENDING_CHANGES = "promotion_changes"
+
+# Key in app.extensions holding the database URI the engine was built for
+DATABASE_URI_KEY = "promotions_database_uri"
+
+# PostgreSQL advisory lock that each transaction writing to the change log holds until it commits
+CHANGE_LOG_LOCK = 0x50524f4d
+
+# Callables told about every committed change as callback(action, promotion_ids)
+change_subscribers = []
+
 
 # Function to initialize the database
 def init_db(app):
@@ -39,10 +63,60 @@ def init_db(app):
     Promotion.init_db(app)
 
 
+def bind_db(app):
+    """ Connects the models to the app without touching the database """
+    Promotion.bind(app)
+
+
+def prepare_db():
+    """ Readies the database before the first request of this process
+
+    /metrics is left out, so it can still be scraped while the database is down
+    """
+    if request.endpoint != "metrics":
+        Promotion.prepare()
+
+
+def as_utc(value: datetime) -> datetime:
+    """Converts an aware datetime to the naive UTC form stored in the database"""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def record_change(action: str, promotion_ids):
+    """Remembers a change so it is announced when the current transaction commits"""
+    db.session.info.setdefault(PENDING_CHANGES, []).append((action, [int(i) for i in promotion_ids]))
+
+
+def chunked(items: list, size: int):
+    """Yields successive slices of items that are at most size long"""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
 class DataValidationError(Exception):
     """ Used for an data validation errors when deserializing """
 
 
+def text_field(data: dict, name: str, max_length: int, nullable: bool = False):
+    """Returns a string field of a posted Promotion after checking it fits its column"""
+    value = data[name]
+    if value is None and nullable:
+        return None
+    if not isinstance(value, str) or len(value) > max_length:
+        raise DataValidationError(f"Invalid Promotion: {name} must be a string of at most {max_length} characters")
+    return value
+
+
+def integer_field(data: dict, name: str) -> int:
+    """Returns an integer field of a posted Promotion, which may also be posted as a string of digits"""
+    value = data[name]
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise DataValidationError(f"Invalid Promotion: {name} must be an integer")
+    return int(value)
+
+
 class DatabaseConnectionError(Exception):
     """Custom Exception when database connection fails"""
 
@@ -54,18 +128,47 @@ class PromoType(Enum):
     FIXED = 3		    # $X off
 
 
+# Columns that the list endpoint can filter on
+FILTERABLE_COLUMNS = ("title", "promo_code", "promo_type", "is_site_wide", "product_id")
+
+
 class Promotion(db.Model):
     """
     Class that represents a Promotion
     """
-    # pylint: disable=too-many-instance-attributes
+    # pylint: disable=too-many-instance-attributes, too-many-public-methods
 
     app = None
+    cache = TTLCache(max_size=0, ttl=0)
+    code_cache = TTLCache(max_size=0, ttl=0)
+    missing_code_cache = TTLCache(max_size=0, ttl=0)
+    notifier = None
+    prepared = False
+    prepare_seconds = None
+    prepare_lock = threading.Lock()
 
     ##################################################
     # Table Schema
     ##################################################
 
+    __table_args__ = (
+        db.Index("ix_promotion_promo_code", "promo_code"),
+        db.Index("ix_promotion_title", "title"),
+        db.Index("ix_promotion_product_window", "product_id", "start_date", "end_date"),
+        # leading with end_date lets "active at T" lookups skip a product's expired history
+        db.Index("ix_promotion_product_end", "product_id", "end_date"),
+        # partial index: only the (few) site-wide promotions are indexed
+        db.Index("ix_promotion_site_wide_window", "start_date", "end_date",
+                 postgresql_where=db.text("is_site_wide"), sqlite_where=db.text("is_site_wide")),
+        # the sweeper reads the next site-wide promotions to end straight off this one
+        db.Index("ix_promotion_site_wide_end", "end_date",
+                 postgresql_where=db.text("is_site_wide"), sqlite_where=db.text("is_site_wide")),
+        # the archive takes the promotions that ended first, in batches, straight off this one
+        db.Index("ix_promotion_end_date", "end_date"),
+        # archived promotions keep their ids, so SQLite must never hand them out again
+        {"sqlite_autoincrement": True},
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(63), nullable=False)
     promo_code = db.Column(db.String(63), nullable=True)
@@ -75,6 +178,10 @@ class Promotion(db.Model):
     end_date = db.Column(db.DateTime(), nullable=False)
     is_site_wide = db.Column(db.Boolean(), nullable=False, default=False)
     product_id = db.Column(db.Integer, nullable=False, default=1)
+    version = db.Column(db.Integer, nullable=False, server_default="1")
+
+    # SQLAlchemy bumps the version on every UPDATE it issues for a Promotion
+    __mapper_args__ = {"version_id_col": version}
 
     ##################################################
     # INSTANCE METHODS
@@ -90,6 +197,8 @@ class Promotion(db.Model):
         logger.info("Creating promotion %s", self.title)
         self.id = None  # pylint: disable=invalid-name
         db.session.add(self)
+        db.session.flush()
+        record_change("create", [self.id])
         db.session.commit()
 
     def update(self):
@@ -99,14 +208,20 @@ class Promotion(db.Model):
         if not self.id:
             raise DataValidationError("Promo id not provided.")
         logger.info("Saving %s", self.title)
+        record_change("update", [self.id])
         db.session.commit()
 
     def delete(self):
         """ Removes a Promotion from the data store """
         logger.info("Deleting promotion %s", self.title)
+        record_change("delete", [self.id])
         db.session.delete(self)
         db.session.commit()
 
+    def column_values(self) -> dict:
+        """Returns the raw column values of a Promotion keyed by column name"""
+        return {column.key: getattr(self, column.key) for column in self.__table__.columns}
+
     def serialize(self):
         """ Serializes a Promotion into a dictionary """
 
@@ -130,20 +245,23 @@ class Promotion(db.Model):
             data (dict): A dictionary containing the resource data
         """
         try:
-            self.title = data["title"]
-            self.promo_code = data["promo_code"]
+            self.title = text_field(data, "title", self.__table__.c.title.type.length)
+            self.promo_code = text_field(data, "promo_code", self.__table__.c.promo_code.type.length, nullable=True)
+            if data["promo_type"] not in PromoType.__members__:
+                raise DataValidationError(f"Invalid Promotion: unknown promo_type '{data['promo_type']}'")
             self.promo_type = data["promo_type"]
-            self.amount = data["amount"]
             self.start_date = datetime.fromisoformat(data["start_date"])
             self.end_date = datetime.fromisoformat(data["end_date"])
+            if not isinstance(data["is_site_wide"], bool):
+                raise DataValidationError("Invalid Promotion: is_site_wide must be true or false")
             self.is_site_wide = data["is_site_wide"]
-            self.product_id = data["product_id"]
-            self.amount = data["amount"]
+            self.product_id = integer_field(data, "product_id")
+            self.amount = integer_field(data, "amount")
         except KeyError as error:
             raise DataValidationError(
                 "Invalid Promotion: missing " + error.args[0]
             ) from error
-        except TypeError as error:
+        except (TypeError, ValueError) as error:
             raise DataValidationError(
                 "Invalid Promotion: body of request contained bad or no data - "
                 "Error message: " + str(error)
@@ -154,12 +272,14 @@ class Promotion(db.Model):
         "Turn status to True"
         logger.info("Set Valid status to True")
         self.is_site_wide = True
+        record_change("activate", [self.id])
         db.session.commit()
 
     def deactivate(self):
         "Turn status to False"
         logger.info("Set Valid status to False")
         self.is_site_wide = False
+        record_change("deactivate", [self.id])
         db.session.commit()
 
     ##################################################
@@ -168,13 +288,119 @@ class Promotion(db.Model):
 
     @classmethod
     def init_db(cls, app: Flask):
-        """ Initializes the database session """
+        """ Initializes the database session and creates the tables right away """
+        cls.bind(app)
+        app.app_context().push()
+        cls.prepare()
+
+    @classmethod
+    def bind(cls, app: Flask):
+        """ Connects the model to an app and sizes its caches, without connecting to the database """
         logger.info("Initializing database")
         cls.app = app
-        # This is where we initialize SQLAlchemy from the Flask app
-        db.init_app(app)
-        app.app_context().push()
-        db.create_all()  # make our sqlalchemy tables
+        uri = app.config["SQLALCHEMY_DATABASE_URI"]
+        # This is where we initialize SQLAlchemy from the Flask app, once: an app
+        # that already served requests no longer accepts the setup it does
+        if "sqlalchemy" not in app.extensions:
+            db.init_app(app)
+        elif app.extensions.get(DATABASE_URI_KEY) != uri:
+            cls.rebuild_engine(app)
+        app.extensions[DATABASE_URI_KEY] = uri
+        cls.cache = TTLCache(app.config["CACHE_MAX_SIZE"], app.config["CACHE_TTL"])
+        cls.code_cache = TTLCache(app.config["CODE_CACHE_MAX_SIZE"], app.config["CODE_CACHE_TTL"])
+        cls.missing_code_cache = TTLCache(app.config["CODE_CACHE_MAX_SIZE"], app.config["CODE_NEGATIVE_CACHE_TTL"])
+
+    @classmethod
+    def rebuild_engine(cls, app: Flask):
+        """ Points an app at the database its config names now, e.g. the test database
+
+        Only the engine setup of db.init_app is redone. Whatever was read from
+        the old database is dropped, and the tables are created and the change
+        listener started again by the next prepare()
+        """
+        logger.info("Switching to another database")
+        with app.app_context():
+            engines = db.engines  # the engines of this app, by bind key
+        for engine in engines.values():
+            engine.dispose()
+        options = dict(app.config["SQLALCHEMY_ENGINE_OPTIONS"], url=app.config["SQLALCHEMY_DATABASE_URI"])
+        options.setdefault("echo", app.config["SQLALCHEMY_ECHO"])
+        options.setdefault("echo_pool", app.config["SQLALCHEMY_ECHO"])
+        db._apply_driver_defaults(options, app)  # pylint: disable=protected-access
+        engines[None] = db._make_engine(None, options, app)  # pylint: disable=protected-access
+        with cls.prepare_lock:
+            if cls.notifier:
+                cls.notifier.stop()
+            cls.notifier = None
+            cls.prepared = False
+        cls.dispatch_changes("reset", None)
+
+    @classmethod
+    def prepare(cls):
+        """ Creates the tables and starts listening for changes, the first time it is called
+
+        Raises:
+            DatabaseConnectionError: when the database cannot be reached
+        """
+        if cls.prepared:
+            return
+        with cls.prepare_lock:
+            if cls.prepared:
+                return
+            started = time.perf_counter()
+            try:
+                db.create_all()  # make our sqlalchemy tables
+            except OperationalError as error:
+                raise DatabaseConnectionError(f"Cannot reach the database: {error.orig}") from error
+            channel = cls.app.config["CHANGE_NOTIFY_CHANNEL"]
+            if channel and db.engine.dialect.name == "postgresql":
+                cls.notifier = ChangeNotifier(channel, cls.dispatch_changes)
+                cls.notifier.start(db.engine)
+            cls.prepare_seconds = time.perf_counter() - started
+            cls.prepared = True
+            logger.info("Database prepared in %.3f seconds", cls.prepare_seconds)
+
+    @classmethod
+    def dispatch_changes(cls, action: str, promotion_ids):
+        """Drops stale cache entries and tells every subscriber about a committed change
+
+        Args:
+            action (str): create, update, delete, activate, deactivate or archive
+            promotion_ids (list): the ids that changed, or None if they are unknown
+        """
+        if promotion_ids is None:
+            cls.cache.clear()
+        else:
+            for promotion_id in promotion_ids:
+                cls.cache.invalidate(promotion_id)
+        # a change may add, remove or rename any code
+        cls.code_cache.clear()
+        cls.missing_code_cache.clear()
+        for callback in change_subscribers:
+            try:
+                callback(action, promotion_ids)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Promotion change subscriber %s failed", callback)
+
+    @classmethod
+    def add_missing_columns(cls):
+        """ Adds columns introduced by newer releases to an existing promotion table """
+        existing = {column["name"] for column in db.inspect(db.engine).get_columns(cls.__tablename__)}
+        with db.engine.begin() as connection:
+            for column in cls.__table__.columns:
+                if column.name not in existing:
+                    logger.info("Adding promotion column %s", column.name)
+                    ddl = CreateColumn(column).compile(dialect=db.engine.dialect)
+                    connection.execute(text(f"ALTER TABLE {cls.__tablename__} ADD COLUMN {ddl}"))
+
+    @classmethod
+    def create_indexes(cls):
+        """ Creates any indexes that are missing from an existing promotion table """
+        logger.info("Creating missing promotion indexes")
+        # IF NOT EXISTS also covers expression indexes, which are not reflected on every backend
+        with db.engine.begin() as connection:
+            for index in cls.__table__.indexes:
+                connection.execute(CreateIndex(index, if_not_exists=True))
 
     @classmethod
     def all(cls):
@@ -183,15 +409,301 @@ class Promotion(db.Model):
         return cls.query.all()
 
     @classmethod
-    def find(cls, promotion_id: int):
+    def create_many(cls, promotions: list, chunk_size: int) -> list:
+        """Creates many Promotions with one multi-row INSERT and commit per chunk
+
+        Args:
+            promotions (list): the Promotions to add to the database
+            chunk_size (int): the number of Promotions written per transaction
+
+        Returns:
+            the ids assigned to the Promotions in the order they were given
+        """
+        logger.info("Creating %s promotions in chunks of %s", len(promotions), chunk_size)
+        ids = []
+        for chunk in chunked(promotions, chunk_size):
+            for promotion in chunk:
+                promotion.id = None
+            db.session.add_all(chunk)
+            db.session.flush()
+            chunk_ids = [promotion.id for promotion in chunk]
+            record_change("create", chunk_ids)
+            db.session.commit()
+            ids.extend(chunk_ids)
+        return ids
+
+    @classmethod
+    def update_many(cls, promotions: list, chunk_size: int) -> set:
+        """Updates many Promotions with one executemany UPDATE and commit per chunk
+
+        Args:
+            promotions (list): Promotions carrying the id and new values of each row
+            chunk_size (int): the number of Promotions written per transaction
+
+        Returns:
+            the ids of the Promotions that existed and were updated
+        """
+        logger.info("Updating %s promotions in chunks of %s", len(promotions), chunk_size)
+        updated = set()
+        for chunk in chunked(promotions, chunk_size):
+            ids = [promotion.id for promotion in chunk]
+            found = set(db.session.scalars(db.select(cls.id).where(cls.id.in_(ids))))
+            rows = [
+                {f"new_{key}": value for key, value in promotion.column_values().items()}
+                for promotion in chunk if promotion.id in found
+            ]
+            if rows:
+                db.session.execute(cls.bulk_update_statement(), rows)
+                record_change("update", found)
+            db.session.commit()
+            updated |= found
+        return updated
+
+    @classmethod
+    def bulk_update_statement(cls):
+        """Returns an executemany-friendly UPDATE that sets every column and bumps the version
+
+        Each parameter set supplies new_<column> for every column, including new_id
+        """
+        table = cls.__table__
+        values = {
+            column.key: bindparam(f"new_{column.key}")
+            for column in table.columns if column.key not in ("id", "version")
+        }
+        values["version"] = table.c.version + 1
+        return update(table).where(table.c.id == bindparam("new_id")).values(values)
+
+    @classmethod
+    def delete_many(cls, promotion_ids: list, chunk_size: int) -> set:
+        """Deletes many Promotions with one DELETE ... WHERE id IN and commit per chunk
+
+        Archived Promotions with the ids are deleted from the archive as well
+
+        Args:
+            promotion_ids (list): the ids of the Promotions to remove
+            chunk_size (int): the number of Promotions removed per transaction
+
+        Returns:
+            the ids of the Promotions that existed and were deleted
+        """
+        logger.info("Deleting %s promotions in chunks of %s", len(promotion_ids), chunk_size)
+        deleted = set()
+        for chunk in chunked(promotion_ids, chunk_size):
+            statement = delete(cls).where(cls.id.in_(chunk)).returning(cls.id)
+            chunk_deleted = set(db.session.scalars(statement)) | PromotionArchive.remove(chunk)
+            if chunk_deleted:
+                record_change("delete", chunk_deleted)
+            db.session.commit()
+            deleted |= chunk_deleted
+        return deleted
+
+    @classmethod
+    def expire_ended(cls, now: datetime, batch_size: int) -> list:
+        """Deactivates the site-wide Promotions that ended before now
+
+        Each batch is one set-based UPDATE and commit that bumps the versions
+        and records a deactivate change, so caches, snapshots and change
+        streams see it like any other deactivation
+
+        Args:
+            now (datetime): the Promotions with an end_date before this have ended
+            batch_size (int): the number of Promotions deactivated per transaction
+
+        Returns:
+            the ids of the Promotions that were deactivated
+        """
+        now = as_utc(now)
+        logger.info("Deactivating promotions that ended before %s", now)
+        expired = []
+        while True:
+            ended = (
+                db.select(cls.id)
+                .where(cls.is_site_wide, cls.end_date < now)
+                .order_by(cls.end_date)
+                .limit(batch_size)
+                .scalar_subquery()
+            )
+            statement = (
+                update(cls)
+                .where(cls.id.in_(ended), cls.is_site_wide)
+                .values(is_site_wide=False, version=cls.version + 1)
+                .returning(cls.id)
+                .execution_options(synchronize_session=False)
+            )
+            ids = list(db.session.scalars(statement))
+            if ids:
+                record_change("deactivate", ids)
+            db.session.commit()
+            expired.extend(ids)
+            if len(ids) < batch_size:
+                return expired
+
+    @classmethod
+    def archive_ended(cls, before: datetime, batch_size: int) -> list:
+        """Moves the Promotions that ended before a point in time to the archive
+
+        Each batch is one DELETE ... RETURNING and one INSERT in a short
+        transaction, so rows are only locked while their batch moves and
+        the table stays writable. An archive change is recorded for each
+
+        Args:
+            before (datetime): the Promotions with an end_date before this are moved
+            batch_size (int): the number of Promotions moved per transaction
+
+        Returns:
+            the ids of the Promotions that were archived
+        """
+        before = as_utc(before)
+        logger.info("Archiving promotions that ended before %s", before)
+        archived = []
+        while True:
+            ended = db.select(cls.id).where(cls.end_date < before).order_by(cls.end_date).limit(batch_size)
+            table = cls.__table__
+            statement = delete(table).where(table.c.id.in_(ended.scalar_subquery())).returning(*table.columns)
+            result = db.session.execute(statement)
+            rows = [dict(row._mapping) for row in result]  # pylint: disable=protected-access, not-an-iterable
+            ids = [row["id"] for row in rows]
+            if rows:
+                archived_at = datetime.utcnow()
+                db.session.execute(insert(PromotionArchive), [dict(row, archived_at=archived_at) for row in rows])
+                record_change("archive", ids)
+            db.session.commit()
+            archived.extend(ids)
+            if len(ids) < batch_size:
+                return archived
+
+    @classmethod
+    def upcoming_expiries(cls, limit: int, promotion_ids: list = None) -> list:
+        """Returns (end_date, id) of the site-wide Promotions that end soonest
+
+        Args:
+            limit (int): the maximum number of Promotions to return
+            promotion_ids (list): only consider these Promotions
+        """
+        statement = db.select(cls.end_date, cls.id).where(cls.is_site_wide)
+        if promotion_ids is not None:
+            statement = statement.where(cls.id.in_(promotion_ids))
+        rows = db.session.execute(statement.order_by(cls.end_date).limit(limit))
+        return [tuple(row) for row in rows]  # pylint: disable=not-an-iterable
+
+    @classmethod
+    def stream_all(cls, batch_size: int):
+        """Yields every Promotion ordered by id without loading the whole table
+
+        Rows are fetched batch_size at a time through a server-side cursor,
+        so memory use stays bounded by the batch rather than the table
+
+        Args:
+            batch_size (int): the number of rows to fetch per round-trip
+        """
+        logger.info("Streaming all Promotions in batches of %s ...", batch_size)
+        statement = db.select(cls).order_by(cls.id).execution_options(yield_per=batch_size)
+        yield from db.session.scalars(statement)  # pylint: disable=not-an-iterable
+
+    @classmethod
+    def record_columns(cls, names) -> list:
+        """Returns the columns to select for a record made of the named fields
+
+        id and version always come first because page cursors and ETags need them
+
+        Args:
+            names (list): the column names the record is built from
+        """
+        columns = [cls.id, cls.version]
+        columns.extend(getattr(cls, name) for name in names if name not in ("id", "version"))
+        return columns
+
+    @classmethod
+    def paginate(cls, limit: int, after_id: int = None, query=None, columns: list = None) -> list:
+        """Returns one page of Promotions ordered by id using keyset pagination
+
+        One extra row past the limit is fetched so callers can tell whether
+        another page follows without issuing a COUNT query
+
+        Args:
+            limit (int): the maximum number of Promotions in the page
+            after_id (int): only return Promotions with an id greater than this
+            query: an optional filtered query to paginate (defaults to all)
+            columns (list): return rows of just these columns instead of Promotions
+        """
+        logger.info("Processing page of %s promotions after id %s ...", limit, after_id)
+        if query is None:
+            query = cls.query
+        if columns is not None:
+            query = query.with_entities(*columns)
+        if after_id is not None:
+            query = query.filter(cls.id > after_id)
+        return query.order_by(cls.id).limit(limit + 1).all()
+
+    @classmethod
+    def find(cls, promotion_id: int, use_cache: bool = True):
         """ Finds a Promotion by it's ID
 
+        Rows are served from the in-process cache when possible, without
+        a database round-trip. Writers should pass use_cache=False so the
+        version they check and update is the committed one. Archived
+        Promotions are read-only, so only readers get them back.
+
         Args:
             promotion_id (int): the id of the Promotions
+            use_cache (bool): whether a cached copy may be returned
 
         """
         logger.info("Processing lookup for promotion id %s ...", promotion_id)
-        return cls.query.get(promotion_id)
+        try:
+            promotion_id = int(promotion_id)
+        except (TypeError, ValueError):
+            return None
+        if cls.notifier:
+            cls.notifier.start(db.engine)  # no-op unless we were forked
+        values = cls.cache.get(promotion_id) if use_cache else None
+        in_session = identity_key(cls, promotion_id) in db.session.identity_map
+        if values is not None and not in_session:
+            promotion = cls(**values)
+            make_transient_to_detached(promotion)
+            return db.session.merge(promotion, load=False)
+        generation = cls.cache.generation
+        promotion = db.session.get(cls, promotion_id, populate_existing=not use_cache)
+        if promotion is None and use_cache:
+            promotion = PromotionArchive.find(promotion_id)
+        if promotion is not None:
+            cls.cache.set(promotion_id, promotion.column_values(), generation)
+        return promotion
+
+    @classmethod
+    def find_many(cls, promotion_ids: list) -> dict:
+        """Finds the Promotions with any of the ids, keyed by id
+
+        Cached rows are used like find() uses them, and all the others are
+        read with a single WHERE id IN (...) query, falling back to the
+        archive for the ids that are not in the promotion table, and cached
+
+        Args:
+            promotion_ids (list): the ids of the Promotions
+        """
+        logger.info("Processing lookup for %s promotion ids ...", len(promotion_ids))
+        if cls.notifier:
+            cls.notifier.start(db.engine)  # no-op unless we were forked
+        found = {}
+        for promotion_id in promotion_ids:
+            values = cls.cache.get(promotion_id)
+            if values is not None and identity_key(cls, promotion_id) not in db.session.identity_map:
+                promotion = cls(**values)
+                make_transient_to_detached(promotion)
+                found[promotion_id] = db.session.merge(promotion, load=False)
+        missing = [promotion_id for promotion_id in promotion_ids if promotion_id not in found]
+        if missing:
+            generation = cls.cache.generation
+            statement = db.select(cls).where(cls.id.in_(missing))
+            promotions = list(db.session.scalars(statement))
+            in_table = {promotion.id for promotion in promotions}
+            archived = [promotion_id for promotion_id in missing if promotion_id not in in_table]
+            if archived:
+                promotions.extend(PromotionArchive.find_many(archived))
+            for promotion in promotions:
+                cls.cache.set(promotion.id, promotion.column_values(), generation)
+                found[promotion.id] = promotion
+        return found
 
     @classmethod
     def find_or_404(cls, promotion_id: int):
@@ -230,6 +742,59 @@ class Promotion(db.Model):
         logger.info("Processing title query for %s ...", code)
         return cls.query.filter(cls.promo_code == code)
 
+    @classmethod
+    def lookup_code(cls, code: str, ignore_case: bool = False) -> tuple:
+        """Returns the rows of every column of the Promotions with a promo code, by id
+
+        Found codes are cached like single Promotions, and unknown codes are
+        remembered for CODE_NEGATIVE_CACHE_TTL seconds so repeated guesses
+        do not reach the database. Both caches are cleared on every change.
+
+        Args:
+            code (str): the promo code to look up
+            ignore_case (bool): match the code case-insensitively
+        """
+        key = cls.code_key(code, ignore_case)
+        rows = cls.cached_code(key)
+        if rows is not None:
+            return rows
+        logger.info("Processing code lookup for %s ...", code)
+        generations = cls.code_cache.generation, cls.missing_code_cache.generation
+        rows = tuple(db.session.execute(cls.code_statement(code, ignore_case)))
+        cls.remember_code(key, rows, generations)
+        return rows
+
+    @staticmethod
+    def code_key(code: str, ignore_case: bool = False) -> tuple:
+        """Returns the key of a promo code lookup in the code caches"""
+        return code.lower() if ignore_case else code, ignore_case
+
+    @classmethod
+    def cached_code(cls, key: tuple):
+        """Returns the cached rows of a code lookup, () for a known unknown code, or None on a miss"""
+        rows = cls.code_cache.get(key)
+        if rows is None and cls.missing_code_cache.get(key):
+            return ()
+        return rows
+
+    @classmethod
+    def code_statement(cls, code: str, ignore_case: bool = False):
+        """Returns the query of every column of the Promotions with a promo code, by id"""
+        condition = db.func.lower(cls.promo_code) == code.lower() if ignore_case else cls.promo_code == code
+        return db.select(*cls.__table__.columns).where(condition).order_by(cls.id)
+
+    @classmethod
+    def remember_code(cls, key: tuple, rows: tuple, generations: tuple):
+        """Caches the rows of a code lookup, or that the code is unknown when there are none
+
+        Args:
+            generations (tuple): the code_cache and missing_code_cache generations seen before reading
+        """
+        if rows:
+            cls.code_cache.set(key, rows, generations[0])
+        else:
+            cls.missing_code_cache.set(key, True, generations[1])
+
     @classmethod
     def find_by_type(cls, promo_type: PromoType) -> list:
         """Returns all Promotions by Promo code
@@ -237,3 +802,188 @@ class Promotion(db.Model):
         """
         logger.info("Processing title query for %s ...", promo_type.name)
         return cls.query.filter(cls.promo_type == promo_type)
+
+    @classmethod
+    def find_active(cls, product_id: int, at: datetime = None):  # pylint: disable=invalid-name
+        """Returns the Promotions that apply to a product at a point in time
+
+        A Promotion applies when its start_date <= at <= end_date and it
+        is either for the given product or site-wide
+
+        Args:
+            product_id (int): the id of the product
+            at (datetime): the point in time to check (defaults to now, in UTC)
+        """
+        return cls.find_active_for_products([product_id], at)
+
+    @classmethod
+    def find_active_for_products(cls, product_ids: list, at: datetime = None):  # pylint: disable=invalid-name
+        """Returns the Promotions that apply to any of the products at a point in time
+
+        One query serves a whole cart: the product window index finds the
+        Promotions of the products and the partial site-wide index the rest
+
+        Args:
+            product_ids (list): the ids of the products
+            at (datetime): the point in time to check (defaults to now, in UTC)
+        """
+        at = as_utc(at or datetime.now(timezone.utc))
+        logger.info("Processing active query for %s products at %s ...", len(product_ids), at)
+        return cls.query.filter(*cls.active_criteria(product_ids, at)).order_by(cls.id)
+
+    @classmethod
+    def active_criteria(cls, product_ids: list, at: datetime) -> tuple:  # pylint: disable=invalid-name
+        """Returns the filters of the Promotions that apply to any of the products at a time"""
+        at = as_utc(at)
+        return or_(cls.product_id.in_(product_ids), cls.is_site_wide), cls.start_date <= at, cls.end_date >= at
+
+    @classmethod
+    def find_by_filters(cls, **filters):
+        """Returns all Promotions that match every given filter
+
+        Filters that are None are ignored, so the remaining ones are
+        combined into a single query that the indexes can serve
+
+        Args:
+            filters: column values keyed by title, promo_code, promo_type,
+                is_site_wide or product_id
+        """
+        criteria = {name: value for name, value in filters.items() if value is not None}
+        unknown = set(criteria) - set(FILTERABLE_COLUMNS)
+        if unknown:
+            raise DataValidationError(f"Cannot filter promotions by {', '.join(sorted(unknown))}")
+        logger.info("Processing filter query for %s ...", criteria)
+        return cls.query.filter_by(**criteria)
+
+
+# Hash index for case-insensitive code lookups (a plain expression index outside PostgreSQL)
+db.Index("ix_promotion_promo_code_lower", db.func.lower(Promotion.promo_code), postgresql_using="hash")
+
+
+class PromotionArchive(db.Model):
+    """
+    Class that represents a Promotion that ended long ago
+
+    Archived Promotions are moved out of the promotion table so that it
+    only holds the working set. They keep their ids, and Promotion.find
+    still resolves them, read-only
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    title = db.Column(db.String(63), nullable=False)
+    promo_code = db.Column(db.String(63), nullable=True)
+    promo_type = db.Column(db.Enum(PromoType), nullable=False)
+    amount = db.Column(db.Integer, nullable=False)
+    start_date = db.Column(db.DateTime(), nullable=False)
+    end_date = db.Column(db.DateTime(), nullable=False)
+    is_site_wide = db.Column(db.Boolean(), nullable=False)
+    product_id = db.Column(db.Integer, nullable=False)
+    version = db.Column(db.Integer, nullable=False)
+    archived_at = db.Column(db.DateTime(), nullable=False)
+
+    def __repr__(self):
+        return f"<PromotionArchive {self.title} id=[{self.id}]>"
+
+    def as_promotion(self) -> Promotion:
+        """Returns the archived values as a Promotion that is not in the session"""
+        return Promotion(**{column.key: getattr(self, column.key) for column in Promotion.__table__.columns})
+
+    @classmethod
+    def find(cls, promotion_id: int):
+        """Returns the archived Promotion with the id as a Promotion, or None"""
+        logger.info("Processing archive lookup for promotion id %s ...", promotion_id)
+        archived = db.session.get(cls, promotion_id)
+        return archived.as_promotion() if archived is not None else None
+
+    @classmethod
+    def find_many(cls, promotion_ids: list) -> list:
+        """Returns the archived Promotions with any of the ids as Promotions"""
+        statement = db.select(cls).where(cls.id.in_(promotion_ids))
+        return [archived.as_promotion() for archived in db.session.scalars(statement)]  # pylint: disable=not-an-iterable
+
+    @classmethod
+    def remove(cls, promotion_ids: list) -> set:
+        """Deletes the archived Promotions with any of the ids in the current transaction and returns their ids"""
+        table = cls.__table__
+        statement = delete(table).where(table.c.id.in_(promotion_ids)).returning(table.c.id)
+        return set(db.session.scalars(statement))
+
+
+class PromotionChange(db.Model):
+    """
+    Class that represents one committed change to a Promotion
+
+    The change log is append-only: every create, update, delete, activate,
+    deactivate and archive adds a row in the transaction that makes the change, and
+    seq orders them so consumers can sync from the last one they saw
+    """
+
+    seq = db.Column(db.BigInteger().with_variant(db.Integer, "sqlite"), primary_key=True)
+    action = db.Column(db.String(15), nullable=False)
+    promotion_id = db.Column(db.Integer, nullable=False)
+    changed_at = db.Column(db.DateTime(), nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<PromotionChange {self.action} id=[{self.promotion_id}] seq=[{self.seq}]>"
+
+    @classmethod
+    def since(cls, seq: int, limit: int) -> list:
+        """Returns the changes after seq in order, each with the current state of its Promotion
+
+        One extra change past the limit is fetched so callers can tell whether
+        more follow. The Promotion is None once it has been deleted or archived
+
+        Args:
+            seq (int): only return changes with a greater seq
+            limit (int): the maximum number of changes to return
+        """
+        logger.info("Processing changes after seq %s ...", seq)
+        statement = (
+            db.select(cls, Promotion)
+            .outerjoin(Promotion, Promotion.id == cls.promotion_id)
+            .where(cls.seq > seq)
+            .order_by(cls.seq)
+            .limit(limit + 1)
+        )
+        return db.session.execute(statement).all()
+
+    @classmethod
+    def last_seq(cls) -> int:
+        """Returns the seq of the latest change, or 0 when there is none"""
+        return db.session.scalar(db.select(db.func.max(cls.seq))) or 0
+
+
+######################################################################
+# Announce committed changes
+######################################################################
+@event.listens_for(db.session, "before_commit")
+def publish_changes(session):
+    """Logs the pending changes and sends them to the other workers inside the transaction"""
+    changes = session.info.get(PENDING_CHANGES)
+    if not changes:
+        return
+    rows = [
+        {"action": action, "promotion_id": promotion_id}
+        for action, promotion_ids in changes for promotion_id in promotion_ids
+    ]
+    if session.get_bind().dialect.name == "postgresql":
+        # seq is taken on insert, so without this a later seq could commit first and a consumer
+        # that already read past it would never see the earlier one. SQLite has a single writer
+        session.execute(db.select(db.func.pg_advisory_xact_lock(CHANGE_LOG_LOCK)))
+    session.execute(insert(PromotionChange), rows)
+    if Promotion.notifier:
+        Promotion.notifier.publish(session, changes)
+
+
+@event.listens_for(db.session, "after_commit")
+def dispatch_changes(session):
+    """Announces the changes of a transaction that just committed"""
+    for action, promotion_ids in session.info.pop(PENDING_CHANGES, []):
+        Promotion.dispatch_changes(action, promotion_ids)
+
+
+@event.listens_for(db.session, "after_rollback")
+def discard_changes(session):
+    """Forgets the changes of a transaction that was rolled back"""
+    session.info.pop(PENDING_CHANGES, None)
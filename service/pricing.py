@@ -0,0 +1,143 @@
+"""
+Pricing Engine
+
+Works out what the active Promotions take off a cart. Every line gets the
+single Promotion that saves the most on it, chosen among the Promotions of
+its product and the site-wide BOGO and DISCOUNT Promotions. Then the best
+site-wide FIXED Promotion is taken off the cart total.
+
+How each type saves money on a line of quantity items at unit_price:
+  BOGO      every second item is free (quantity // 2 items)
+  DISCOUNT  amount percent of the line (at most 100 percent)
+  FIXED     amount off the line (never more than the line costs)
+
+When Promotions save the same, the one with the larger amount wins, then
+the one with the lowest id. Money is computed with Decimal and rounded
+half up to the cent.
+"""
+from collections import defaultdict
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+from itertools import chain
+from service.models import DataValidationError, PromoType
+
+CENT = Decimal("0.01")
+HUNDRED = Decimal(100)
+
+
+def to_money(value) -> Decimal:
+    """Rounds a Decimal to the cent"""
+    return value.quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def line_savings(promo_type: PromoType, amount: int, quantity: int, unit_price: Decimal) -> Decimal:
+    """Returns how much a Promotion takes off a line of a cart"""
+    subtotal = unit_price * quantity
+    if promo_type == PromoType.BOGO:
+        return unit_price * (quantity // 2)
+    if promo_type == PromoType.DISCOUNT:
+        return subtotal * min(Decimal(amount), HUNDRED) / HUNDRED
+    return min(Decimal(amount), subtotal)
+
+
+def parse_lines(lines) -> list:
+    """Validates the lines of a cart and returns them as (product_id, quantity, unit_price) tuples
+
+    Raises:
+        DataValidationError: when a line is missing a value or has a bad one
+    """
+    if not isinstance(lines, list) or not lines:
+        raise DataValidationError("Cart must contain a non-empty list of lines")
+    parsed = []
+    for position, line in enumerate(lines):
+        try:
+            product_id, quantity = line["product_id"], line["quantity"]
+            unit_price = Decimal(str(line["unit_price"]))
+        except (KeyError, TypeError, InvalidOperation) as error:
+            raise DataValidationError(f"Cart line {position} needs product_id, quantity and unit_price") from error
+        if not isinstance(product_id, int) or isinstance(product_id, bool):
+            raise DataValidationError(f"Cart line {position} has an invalid product_id: {product_id!r}")
+        if not isinstance(quantity, int) or isinstance(quantity, bool) or quantity < 1:
+            raise DataValidationError(f"Cart line {position} has an invalid quantity: {quantity!r}")
+        if not unit_price.is_finite() or unit_price < 0:
+            raise DataValidationError(f"Cart line {position} has an invalid unit_price: {unit_price}")
+        parsed.append((product_id, quantity, unit_price))
+    return parsed
+
+
+def evaluate_cart(lines: list, promotions) -> dict:
+    """Applies the best Promotions to the lines of a cart
+
+    Args:
+        lines (list): (product_id, quantity, unit_price) tuples
+        promotions: the active Promotions, or rows with their id, promo_code,
+            promo_type, amount, product_id and is_site_wide columns
+
+    Returns:
+        the priced lines, the site-wide FIXED Promotion applied to the
+        cart (or None) and the cart subtotal, discount and total
+    """
+    by_product = defaultdict(list)
+    line_wide, cart_wide = [], []
+    for promotion in promotions:
+        if not promotion.is_site_wide:
+            by_product[promotion.product_id].append(promotion)
+        elif promotion.promo_type == PromoType.FIXED:
+            cart_wide.append(promotion)
+        else:
+            line_wide.append(promotion)
+
+    # a type's Promotion with the largest amount always saves the most, so each
+    # product only needs to try one Promotion per type however many apply
+    candidates = {product_id: strongest_per_type(chain(by_product.get(product_id, ()), line_wide))
+                  for product_id in {line[0] for line in lines}}
+    priced = [price_line(*line, candidates[line[0]]) for line in lines]
+    subtotal = sum((line["subtotal"] for line in priced), Decimal(0))
+    discount = sum((line["discount"] for line in priced), Decimal(0))
+
+    cart_promotion = None
+    if cart_wide:
+        best = max(cart_wide, key=rank)
+        savings = to_money(min(Decimal(best.amount), subtotal - discount))
+        cart_promotion = {"promotion": best, "discount": savings}
+        discount += savings
+    return {
+        "lines": priced,
+        "cart_promotion": cart_promotion,
+        "subtotal": to_money(subtotal),
+        "discount": to_money(discount),
+        "total": to_money(subtotal - discount),
+    }
+
+
+def rank(promotion) -> tuple:
+    """Orders Promotions that save the same: the larger amount first, then the lowest id"""
+    return promotion.amount, -promotion.id
+
+
+def strongest_per_type(promotions) -> list:
+    """Returns the highest ranked Promotion of each type"""
+    strongest = {}
+    for promotion in promotions:
+        current = strongest.get(promotion.promo_type)
+        if current is None or rank(promotion) > rank(current):
+            strongest[promotion.promo_type] = promotion
+    return list(strongest.values())
+
+
+def price_line(product_id: int, quantity: int, unit_price: Decimal, candidates: list) -> dict:
+    """Prices one line with whichever candidate Promotion saves the most"""
+    best, best_savings = None, Decimal(0)
+    for promotion in candidates:
+        savings = to_money(line_savings(promotion.promo_type, promotion.amount, quantity, unit_price))
+        if savings > best_savings or (savings == best_savings and best and rank(promotion) > rank(best)):
+            best, best_savings = promotion, savings
+    subtotal = to_money(unit_price * quantity)
+    return {
+        "product_id": product_id,
+        "quantity": quantity,
+        "unit_price": unit_price,
+        "subtotal": subtotal,
+        "discount": best_savings,
+        "total": subtotal - best_savings,
+        "promotion": best,
+    }
@@ -5,29 +5,62 @@ The promotions service is a representation of the promotion that can be used by
 Promotion Service with Swagger and Flask RESTX
 Paths:
 ------
-GET /api/promotions - Returns a list all of the Promotions
+GET /api/promotions - Returns a page of Promotions (use limit and cursor to page through)
 GET /api/promotions/{id} - Returns the Promotion with a given id number
+GET /api/promotions/codes/{code} - Returns the Promotions with a promo code
+GET /api/promotions/export - Streams every Promotion as NDJSON or CSV
+GET /api/promotions/changes - Returns the changes made after a seq of the change log
+GET /api/promotions/changes/stream - Pushes the changes as Server-Sent Events
+POST /api/promotions/batch - Creates, updates and deletes many Promotions at once
+POST /api/promotions/evaluate - Applies the best active Promotions to a cart
+GET /api/products/{id}/promotions/active - Returns the Promotions that apply to a product now
 POST /api/promotions - Creates a new Promotion record in the database
 PUT /api/promotions/{id} - Updates a Promotion record in the database
 DELETE /api/promotions/{id} - Deletes a Promotion record in the database
 PUT /api/promotions/{id}/activate - Activates a Promotion
 DELETE /api/promotions/{id}/activate - Deactivates a Promotion
 """
+# pylint: disable=too-many-lines
 
-from flask import request, jsonify, make_response
+import base64
+import binascii
+import csv
+import hashlib
+import json
+import time
+from datetime import datetime, timezone
+from operator import attrgetter
+from flask import current_app as app, request, jsonify, make_response, stream_with_context, Blueprint, Response
 
-from flask_restx import fields, reqparse, Resource
+from flask_restx import Api, fields, inputs, reqparse, Resource
+from sqlalchemy.exc import SQLAlchemyError
+from werkzeug.http import quote_etag
+from service import events, pricing, snapshot, sweeper
 from service.common import status  # HTTP Status Codes
-from service.models import Promotion, PromoType
+from service.common.db_pool import pool_stats
+from service.common.metrics import serialization_timer, startup_stats
+from service.common.serialization import dumps, fast_marshal_with
+from service.models import Promotion, PromotionChange, PromoType, DataValidationError, FILTERABLE_COLUMNS, chunked, db
 
-# Import Flask application
-from . import app, api
+######################################################################
+# Configure Swagger before initializing it
+######################################################################
+api = Api(version='1.0.0',
+          title='Promotion REST API Service',
+          description='This is a Promotion server.',
+          default='promotions',
+          default_label='Promotion team operations',
+          doc='/apidocs',
+          prefix='/api')
+
+# The pages outside of the REST API, registered on each app by create_app
+site = Blueprint("site", __name__)
 
 
 ######################################################################
 # GET INDEX
 ######################################################################
-@app.route("/")
+@site.route("/")
 def index():
     """ Root URL response """
     return app.send_static_file("index.html")
@@ -61,9 +94,127 @@ promotion_model = api.inherit(
     }
 )
 
+batch_operation_model = api.model('BatchOperation', {
+    'op': fields.String(required=True, enum=['create', 'update', 'delete'],
+                        description='The operation to apply'),
+    'id': fields.Integer(description='The id of the Promotion to update or delete'),
+    'data': fields.Nested(create_model, description='The Promotion to create or the new values to update')
+    })
+
+batch_model = api.model('Batch', {
+    'operations': fields.List(fields.Nested(batch_operation_model), required=True,
+                              description='The operations to apply')
+    })
+
+cart_line_model = api.model('CartLine', {
+    'product_id': fields.Integer(required=True, description='The product in the cart'),
+    'quantity': fields.Integer(required=True, min=1, description='How many of the product are in the cart'),
+    'unit_price': fields.Fixed(decimals=2, required=True, description='The price of one item'),
+    })
+
+cart_model = api.model('Cart', {
+    'lines': fields.List(fields.Nested(cart_line_model), required=True, description='The lines of the cart'),
+    'at': fields.DateTime(description='The point in time to price the cart at (defaults to now)'),
+    })
+
+priced_line_model = api.inherit('PricedCartLine', cart_line_model, {
+    'subtotal': fields.Fixed(decimals=2, description='The price of the line before promotions'),
+    'discount': fields.Fixed(decimals=2, description='What the promotion takes off the line'),
+    'total': fields.Fixed(decimals=2, description='The price of the line after the promotion'),
+    'promotion_id': fields.String(description='The promotion applied to the line, if any'),
+    'promo_code': fields.String(description='The code of the applied promotion'),
+    'promo_type': fields.String(enum=PromoType._member_names_,  # pylint: disable=W0212
+                                description='The type of the applied promotion'),
+    })
+
+cart_promotion_model = api.model('CartPromotion', {
+    'promotion_id': fields.String(description='The site-wide FIXED promotion taken off the cart total'),
+    'promo_code': fields.String(description='The code of the promotion'),
+    'discount': fields.Fixed(decimals=2, description='What the promotion takes off the cart'),
+    })
+
+evaluation_model = api.model('CartEvaluation', {
+    'lines': fields.List(fields.Nested(priced_line_model), description='The priced lines, in cart order'),
+    'cart_promotion': fields.Nested(cart_promotion_model, allow_null=True,
+                                    description='The site-wide promotion applied to the whole cart'),
+    'subtotal': fields.Fixed(decimals=2, description='The price of the cart before promotions'),
+    'discount': fields.Fixed(decimals=2, description='What the promotions take off the cart'),
+    'total': fields.Fixed(decimals=2, description='The price of the cart after promotions'),
+    'at': fields.DateTime(description='The point in time the cart was priced at'),
+    })
+
+change_model = api.model('PromotionChange', {
+    'seq': fields.Integer(description='The position of the change in the change log'),
+    'action': fields.String(enum=['create', 'update', 'delete', 'activate', 'deactivate', 'archive'],
+                            description='What was done to the Promotion'),
+    'promotion_id': fields.String(description='The Promotion that changed'),
+    'changed_at': fields.DateTime(description='When the change was committed'),
+    'promotion': fields.Nested(promotion_model, allow_null=True,
+                               description='The current Promotion, or null once it was deleted or archived'),
+    })
+
+change_page_model = api.model('PromotionChanges', {
+    'changes': fields.List(fields.Nested(change_model), description='The changes after since, oldest first'),
+    'next_since': fields.Integer(description='The since to pass to fetch the changes that follow'),
+    'high_water_mark': fields.Integer(description='The seq of the latest change in the log'),
+    'has_more': fields.Boolean(description='Whether more changes follow next_since'),
+    })
+
 promotion_args = reqparse.RequestParser()
 promotion_args.add_argument('title', type=str, location='args', required=False, help='List Promotions by title')
 promotion_args.add_argument('promo_code', type=str, location='args', required=False, help='List Promotions by code')
+promotion_args.add_argument('promo_type', type=str, location='args', required=False,
+                            choices=PromoType._member_names_,  # pylint: disable=W0212
+                            help='List Promotions by type')
+promotion_args.add_argument('is_site_wide', type=inputs.boolean, location='args', required=False,
+                            help='List Promotions by site-wide status')
+promotion_args.add_argument('product_id', type=int, location='args', required=False,
+                            help='List Promotions by product id')
+promotion_args.add_argument('limit', type=int, location='args', required=False,
+                            help='Maximum number of Promotions per page')
+promotion_args.add_argument('cursor', type=str, location='args', required=False,
+                            help='Opaque cursor returned by the previous page')
+promotion_args.add_argument('fields', type=str, location='args', required=False,
+                            help='Comma separated fields to return (defaults to all)')
+promotion_args.add_argument('ids', type=str, location='args', required=False,
+                            help='Comma separated ids of the Promotions to fetch in one call')
+
+fields_args = reqparse.RequestParser()
+fields_args.add_argument('fields', type=str, location='args', required=False,
+                         help='Comma separated fields to return (defaults to all)')
+
+export_args = reqparse.RequestParser()
+export_args.add_argument('format', type=str, location='args', required=False, default='ndjson',
+                         choices=('ndjson', 'csv'), help='Export format: ndjson or csv')
+
+change_args = reqparse.RequestParser()
+change_args.add_argument('since', type=int, location='args', required=False, default=0,
+                         help='Return the changes after this seq (defaults to the start of the log)')
+change_args.add_argument('limit', type=int, location='args', required=False,
+                         help='Maximum number of changes to return')
+
+stream_args = reqparse.RequestParser()
+stream_args.add_argument('since', type=int, location='args', required=False,
+                         help='Stream the changes after this seq (defaults to the changes from now on)')
+stream_args.add_argument('Last-Event-ID', type=int, location='headers', required=False,
+                         help='Resume after this seq; sent by EventSource when it reconnects')
+
+# How each field of promotion_model is read from a Promotion or a row of its columns
+RECORD_FIELDS = {name: attrgetter(name) for name in ("id", *create_model)}
+RECORD_FIELDS["id"] = lambda promotion: str(promotion.id)
+RECORD_FIELDS["promo_type"] = lambda promotion: promotion.promo_type.name
+RECORD_COLUMNS = Promotion.record_columns(RECORD_FIELDS)
+# The columns the pricing engine needs
+PRICING_COLUMNS = [Promotion.id, Promotion.promo_code, Promotion.promo_type, Promotion.amount,
+                   Promotion.product_id, Promotion.is_site_wide]
+
+code_args = reqparse.RequestParser()
+code_args.add_argument('ignore_case', type=inputs.boolean, location='args', required=False, default=False,
+                       help='Match the code case-insensitively')
+
+active_args = reqparse.RequestParser()
+active_args.add_argument('at', type=str, location='args', required=False,
+                         help='ISO 8601 point in time to check (defaults to now)')
 
 ######################################################################
 #  PATH: /promotions/{id}
@@ -85,21 +236,34 @@ class PromotionResource(Resource):
     # RETRIEVE A PROMOTION
     # ------------------------------------------------------------------
     @api.doc('get_promotions')
+    @api.expect(fields_args)
+    @api.response(304, 'Promotion not modified since the If-None-Match ETag')
+    @api.response(400, 'A requested field does not exist')
     @api.response(404, 'Promotion not found')
-    @api.marshal_with(promotion_model)
+    @fast_marshal_with(api, promotion_model)
     def get(self, promotion_id):
         """
         Retrieve a single Promotion
 
-        This endpoint will return a Promotion based on its id
+        This endpoint will return a Promotion based on its id. The
+        response carries an ETag; send it back in If-None-Match to get
+        an empty 304 Not Modified while the Promotion is unchanged.
+        Pass `fields` to only return some of the fields.
         """
         app.logger.info("Request for promotion with id: %s", promotion_id)
+        field_names = parse_fields(fields_args.parse_args()["fields"])
         promotion = Promotion.find(promotion_id)
         if not promotion:
             abort(status.HTTP_404_NOT_FOUND,
                   f"Promotion with id '{promotion_id}' was not found.")
+        etag = promotion_etag(promotion, field_names)
+        if request.if_none_match.contains_weak(etag):
+            app.logger.info("Promotion with id [%s] not modified.", promotion_id)
+            return not_modified(etag)
         app.logger.info("Returning promotion: %s", promotion.title)
-        return promotion.serialize(), status.HTTP_200_OK
+        with serialization_timer():
+            result = promotion_record(promotion, field_names)
+        return result, status.HTTP_200_OK, {"ETag": quote_etag(etag)}
 
     # ------------------------------------------------------------------
     # UPDATE AN EXISTING PROMOTION
@@ -107,25 +271,29 @@ class PromotionResource(Resource):
     @api.doc('update_promotions')
     @api.response(400, 'The posted Promotion data was not valid')
     @api.response(404, 'Promotion not found')
+    @api.response(412, 'The Promotion was modified since the If-Match ETag')
     @api.expect(promotion_model)
-    @api.marshal_with(promotion_model)
+    @fast_marshal_with(api, promotion_model)
     def put(self, promotion_id):
         """
         Update a Promotion
-        This endpoint will update a Promotion based on the body that is posted
+        This endpoint will update a Promotion based on the body that is posted.
+        Send the Promotion's ETag in If-Match to only update it if nobody
+        else changed it in the meantime.
         """
         app.logger.info(
             "Request to update promotion with id: %s", promotion_id)
-        promotion = Promotion.find(promotion_id)
+        promotion = Promotion.find(promotion_id, use_cache=False)
         if not promotion:
             abort(status.HTTP_404_NOT_FOUND,
                   f"Promotion with id '{promotion_id}' was not found.")
+        check_if_match(promotion)
         app.logger.debug('Payload = %s', api.payload)
         data = api.payload  # Update from the json in the body of the request
         promotion.deserialize(data)
         promotion.id = promotion_id
         promotion.update()
-        return promotion.serialize(), status.HTTP_200_OK
+        return promotion_record(promotion), status.HTTP_200_OK, {"ETag": quote_etag(promotion_etag(promotion))}
 
     # ------------------------------------------------------------------
     # DELETE A PROMOTION
@@ -135,15 +303,18 @@ class PromotionResource(Resource):
     def delete(self, promotion_id):
         """
         Delete a Promotion
-        This endpoint will delete a Promotion based the id specified in the path
+        This endpoint will delete a Promotion based the id specified in the path,
+        from the archive too if it has been archived
         """
         app.logger.info(
             "Request to delete a promotion with id: %s", promotion_id)
-        promotion = Promotion.find(promotion_id)
+        promotion = Promotion.find(promotion_id, use_cache=False)
         if promotion:
             promotion.delete()
             app.logger.info(
                 "Promotion with ID [%s] delete complete.", promotion_id)
+        elif Promotion.delete_many([promotion_id], chunk_size=1):
+            app.logger.info("Archived promotion with ID [%s] delete complete.", promotion_id)
         return '', status.HTTP_204_NO_CONTENT
 
 ######################################################################
@@ -160,32 +331,55 @@ class PromotionCollection(Resource):
     # ------------------------------------------------------------------
     @api.doc('list_promotions')
     @api.expect(promotion_args, validate=True)
-    @api.marshal_list_with(promotion_model)
+    @api.response(304, 'Page not modified since the If-None-Match ETag')
+    @api.response(400, 'A requested field does not exist')
+    @fast_marshal_with(api, promotion_model, as_list=True)
     def get(self):
         """
-        Returns a list of all of the Promotions
-        This endpoint will return all Promotions unless a query
-        parameter (title or promotion code) is specified
+        Returns a page of the Promotions
+        This endpoint will return all Promotions unless query
+        parameters (title, promo_code, promo_type, is_site_wide or
+        product_id) are specified, in which case only Promotions that
+        match all of them are returned. Results are ordered by id and
+        split into pages of at most `limit` Promotions; when more remain,
+        the `Link` and `X-Next-Cursor` headers point at the next page.
+        Each page carries an ETag that changes whenever a Promotion on it
+        is added, changed or removed; send it back in If-None-Match to get
+        an empty 304 Not Modified. Pass `fields` to only read and return
+        some of the fields.
+        Pass `ids` instead of the filters to fetch those Promotions in the
+        order given; ids that do not exist are listed in `X-Missing-Ids`.
         """
         app.logger.info("Request for promotion list")
-        promotions = []
+        args = promotion_args.parse_args()
+        field_names = parse_fields(args["fields"])
+        if args["ids"] is not None:
+            return promotions_by_ids(args, field_names)
+        filters = {name: args[name] for name in FILTERABLE_COLUMNS}
+        if filters["promo_type"]:
+            filters["promo_type"] = PromoType[filters["promo_type"]]
+        app.logger.info("Filtering by query for: %s", filters)
+        query = Promotion.find_by_filters(**filters)
 
-        title = request.args.get("title")
-        promo_code = request.args.get("promo_code")
+        limit = page_size(args["limit"])
+        after_id = decode_cursor(args["cursor"]) if args["cursor"] else None
+        promotions = Promotion.paginate(limit, after_id, query, columns=Promotion.record_columns(field_names))
 
-        if title:
-            app.logger.info("Filtering by query for title: %s", title)
-            promotions = Promotion.find_by_title(title)
-        elif promo_code:
-            app.logger.info("Filtering by query for promotion code: %s", promo_code)
-            promotions = Promotion.find_by_code(promo_code)
-        else:
-            app.logger.info('Returning unfiltered list.')
-            promotions = Promotion.all()
+        headers = {}
+        if len(promotions) > limit:
+            promotions = promotions[:limit]
+            headers = next_page_headers(promotions[-1].id, limit)
+
+        etag = collection_etag(promotions)
+        if request.if_none_match.contains_weak(etag):
+            app.logger.info("Promotion list not modified.")
+            return not_modified(etag)
+        headers["ETag"] = quote_etag(etag)
 
-        results = [promotion.serialize() for promotion in promotions]
+        with serialization_timer():
+            results = [promotion_record(row, field_names) for row in promotions]
         app.logger.info('[%s] Promotions returned', len(results))
-        return results, status.HTTP_200_OK
+        return results, status.HTTP_200_OK, headers
 
     # ------------------------------------------------------------------
     # ADD A NEW PROMOTION
@@ -193,7 +387,7 @@ class PromotionCollection(Resource):
     @api.doc('create_promotions')
     @api.response(400, 'The posted data was not valid')
     @api.expect(create_model)
-    @api.marshal_with(promotion_model, code=201)
+    @fast_marshal_with(api, promotion_model, code=201)
     def post(self):
         """
         Creates a Promotion
@@ -208,7 +402,205 @@ class PromotionCollection(Resource):
         app.logger.info('Promotion with new id [%s] created!', promotion.id)
         location_url = api.url_for(
             PromotionResource, promotion_id=promotion.id, _external=True)
-        return promotion.serialize(), status.HTTP_201_CREATED, {'Location': location_url}
+        headers = {'Location': location_url, 'ETag': quote_etag(promotion_etag(promotion))}
+        return promotion_record(promotion), status.HTTP_201_CREATED, headers
+
+
+######################################################################
+#  PATH: /promotions/codes/{code}
+######################################################################
+@api.route('/promotions/codes/<code>')
+@api.param('code', 'The promo code')
+class PromotionCodeResource(Resource):
+    """ Resolves promo codes at checkout """
+
+    # ------------------------------------------------------------------
+    # LOOK UP A PROMO CODE
+    # ------------------------------------------------------------------
+    @api.doc('get_promotions_by_code')
+    @api.expect(code_args)
+    @api.response(404, 'No Promotion has the code')
+    @fast_marshal_with(api, promotion_model, as_list=True)
+    def get(self, code):
+        """
+        Retrieve the Promotions with a promo code
+        This endpoint resolves a code with a single indexed lookup and
+        returns every Promotion that has it, ordered by id. Pass
+        ignore_case=true to match the code case-insensitively. Results,
+        including unknown codes, are cached in each worker.
+        """
+        args = code_args.parse_args()
+        app.logger.info("Request for promotions with code: %s", code)
+        rows = Promotion.lookup_code(code, args["ignore_case"])
+        if not rows:
+            abort(status.HTTP_404_NOT_FOUND, f"Promotion with code '{code}' was not found.")
+        with serialization_timer():
+            results = [promotion_record(row) for row in rows]
+        return results, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /promotions/export
+######################################################################
+@api.route('/promotions/export')
+class PromotionExport(Resource):
+    """ Streams the whole Promotions table to downstream systems """
+
+    # ------------------------------------------------------------------
+    # EXPORT ALL PROMOTIONS
+    # ------------------------------------------------------------------
+    @api.doc('export_promotions')
+    @api.expect(export_args)
+    @api.produces(['application/x-ndjson', 'text/csv'])
+    def get(self):
+        """
+        Exports all of the Promotions
+        This endpoint streams every Promotion, one per line, as NDJSON
+        (the default) or CSV. Rows are read from the database in batches
+        so the response starts immediately and memory use stays flat.
+        """
+        args = export_args.parse_args()
+        app.logger.info("Request to export promotions as %s", args["format"])
+        promotions = Promotion.stream_all(app.config["EXPORT_BATCH_SIZE"])
+        if args["format"] == "csv":
+            rows, mimetype = csv_lines(promotions), "text/csv"
+        else:
+            rows, mimetype = ndjson_lines(promotions), "application/x-ndjson"
+        return Response(stream_with_context(rows), mimetype=mimetype, status=status.HTTP_200_OK)
+
+
+######################################################################
+#  PATH: /promotions/changes
+######################################################################
+@api.route('/promotions/changes')
+class PromotionChangeCollection(Resource):
+    """ Reads the change log of the Promotions """
+
+    # ------------------------------------------------------------------
+    # LIST THE CHANGES SINCE A SEQ
+    # ------------------------------------------------------------------
+    @api.doc('list_promotion_changes')
+    @api.expect(change_args, validate=True)
+    @api.response(400, 'since or limit was not valid')
+    @fast_marshal_with(api, change_page_model)
+    def get(self):
+        """
+        Returns the changes made after a point in the change log
+        Every create, update, delete, activate, deactivate and archive is
+        logged with an increasing seq. Each change carries the current state
+        of its Promotion, or null once it was deleted or archived. Pass
+        the returned `next_since` back as `since` to read on; a consumer
+        is in sync when it reaches `high_water_mark`.
+        """
+        args = change_args.parse_args()
+        since = args["since"]
+        if since < 0:
+            abort(status.HTTP_400_BAD_REQUEST, "since must not be negative.")
+        limit = page_size(args["limit"])
+        app.logger.info("Request for up to %s promotion changes after %s", limit, since)
+        rows = PromotionChange.since(since, limit)
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        with serialization_timer():
+            changes = [change_record(change, promotion) for change, promotion in rows]
+        result = {
+            "changes": changes,
+            "next_since": changes[-1]["seq"] if changes else since,
+            "high_water_mark": PromotionChange.last_seq(),
+            "has_more": has_more,
+        }
+        app.logger.info("[%s] Promotion changes returned", len(changes))
+        return result, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /promotions/changes/stream
+######################################################################
+@api.route('/promotions/changes/stream')
+class PromotionChangeStream(Resource):
+    """ Pushes the changes of the Promotions as they are committed """
+
+    # ------------------------------------------------------------------
+    # STREAM THE CHANGES
+    # ------------------------------------------------------------------
+    @api.doc('stream_promotion_changes')
+    @api.expect(stream_args, validate=True)
+    @api.produces(['text/event-stream'])
+    @api.response(503, 'This worker already serves as many streams as it may')
+    def get(self):
+        """
+        Streams the changes of the Promotions as Server-Sent Events
+        Each change is sent as soon as it is committed, as an event named
+        after its action whose id is its seq and whose data is the change
+        as GET /promotions/changes returns it. Reconnecting clients resume
+        after the Last-Event-ID header, otherwise after `since`, otherwise
+        from now on. A stream ends after a while and the client reconnects.
+        """
+        args = stream_args.parse_args()
+        since = args["Last-Event-ID"]
+        if since is None:
+            since = args["since"]
+        if since is None:
+            since = PromotionChange.last_seq()
+        try:
+            events.hub.open()
+        except events.StreamLimitError as error:
+            abort(status.HTTP_503_SERVICE_UNAVAILABLE, str(error))
+        app.logger.info("Streaming promotion changes after %s", since)
+        response = Response(stream_with_context(change_events(since)), mimetype="text/event-stream",
+                            status=status.HTTP_200_OK)
+        response.call_on_close(events.hub.close)
+        # no-transform keeps the compression from holding events back
+        response.headers["Cache-Control"] = "no-cache, no-transform"
+        response.headers["X-Accel-Buffering"] = "no"
+        return response
+
+
+######################################################################
+#  PATH: /promotions/batch
+######################################################################
+@api.route('/promotions/batch')
+class PromotionBatch(Resource):
+    """ Applies many create, update and delete operations in one request """
+
+    # ------------------------------------------------------------------
+    # APPLY A BATCH OF OPERATIONS
+    # ------------------------------------------------------------------
+    @api.doc('batch_promotions')
+    @api.response(400, 'The posted batch was not valid')
+    @api.expect(batch_model)
+    def post(self):
+        """
+        Creates, updates and deletes Promotions in bulk
+        This endpoint applies every create, then every update, then every
+        delete in chunked transactions and returns one result per
+        operation, in the order the operations were posted
+        """
+        payload = api.payload
+        operations = payload.get("operations") if isinstance(payload, dict) else None
+        if not isinstance(operations, list):
+            abort(status.HTTP_400_BAD_REQUEST, "Batch must contain a list of operations.")
+        if len(operations) > app.config["BATCH_MAX_OPERATIONS"]:
+            abort(status.HTTP_400_BAD_REQUEST,
+                  f"Batch cannot contain more than {app.config['BATCH_MAX_OPERATIONS']} operations.")
+        app.logger.info("Request to apply a batch of %s operations", len(operations))
+
+        results = [None] * len(operations)
+        pending = {"create": [], "update": [], "delete": []}
+        for position, operation in enumerate(operations):
+            try:
+                op_name, target = parse_batch_operation(operation)
+                pending[op_name].append((position, target))
+            except DataValidationError as error:
+                op_name = operation.get("op") if isinstance(operation, dict) else None
+                results[position] = batch_result(position, op_name, status.HTTP_400_BAD_REQUEST, error=str(error))
+
+        chunk_size = app.config["BATCH_CHUNK_SIZE"]
+        apply_batch_chunks("create", pending["create"], results, chunk_size, apply_batch_creates)
+        apply_batch_chunks("update", pending["update"], results, chunk_size, apply_batch_updates)
+        apply_batch_chunks("delete", pending["delete"], results, chunk_size, apply_batch_deletes)
+        app.logger.info("Batch of %s operations complete.", len(operations))
+        return {"results": results}, status.HTTP_200_OK
 
 
 ######################################################################
@@ -224,6 +616,7 @@ class ActivateResource(Resource):
     # ------------------------------------------------------------------
     @api.doc('activate_promotion')
     @api.response(404, 'Promotion not found')
+    @api.response(412, 'The Promotion was modified since the If-Match ETag')
     def put(self, promotion_id):
         """
         Activates a Promotion
@@ -231,20 +624,22 @@ class ActivateResource(Resource):
         """
         app.logger.info(
             "Request to Activate a promotion with id: %s", promotion_id)
-        promotion = Promotion.find(promotion_id)
+        promotion = Promotion.find(promotion_id, use_cache=False)
         if not promotion:
             abort(status.HTTP_404_NOT_FOUND,
                   f"Promotion with id '{promotion_id}' was not found.")
+        check_if_match(promotion)
         promotion.activate()
         app.logger.info(
             "Promotion with ID [%s] activation complete.", promotion_id)
-        return promotion.serialize(), status.HTTP_200_OK
+        return promotion.serialize(), status.HTTP_200_OK, {"ETag": quote_etag(promotion_etag(promotion))}
 
     # ------------------------------------------------------------------
     # DEACTIVATE A PROMOTION
     # ------------------------------------------------------------------
     @api.doc('deactivate_promotion')
     @api.response(404, 'Promotion not found')
+    @api.response(412, 'The Promotion was modified since the If-Match ETag')
     def delete(self, promotion_id):
         """
         Deactivates a Promotion
@@ -252,25 +647,112 @@ class ActivateResource(Resource):
         """
         app.logger.info(
             "Request to Deactivate a promotion with id: %s", promotion_id)
-        promotion = Promotion.find(promotion_id)
+        promotion = Promotion.find(promotion_id, use_cache=False)
         if not promotion:
             abort(status.HTTP_404_NOT_FOUND,
                   f"Promotion with id '{promotion_id}' was not found.")
+        check_if_match(promotion)
         promotion.deactivate()
         app.logger.info(
             "Promotion with ID [%s] deactivation complete.", promotion_id)
-        return promotion.serialize(), status.HTTP_200_OK
+        return promotion.serialize(), status.HTTP_200_OK, {"ETag": quote_etag(promotion_etag(promotion))}
+
+
+######################################################################
+#  PATH: /products/{id}/promotions/active
+######################################################################
+@api.route('/products/<int:product_id>/promotions/active')
+@api.param('product_id', 'The Product identifier')
+class ActivePromotionCollection(Resource):
+    """ Looks up the Promotions that currently apply to a Product """
+
+    # ------------------------------------------------------------------
+    # LIST ACTIVE PROMOTIONS FOR A PRODUCT
+    # ------------------------------------------------------------------
+    @api.doc('list_active_promotions')
+    @api.expect(active_args)
+    @api.response(400, 'The at parameter was not a valid date')
+    @fast_marshal_with(api, promotion_model, as_list=True)
+    def get(self, product_id):
+        """
+        Returns the active Promotions for a Product
+        This endpoint will return every Promotion for the product, plus
+        every site-wide Promotion, whose date range includes the `at`
+        time (or now when `at` is not given)
+        """
+        args = active_args.parse_args()
+        at = parse_datetime(args["at"]) if args["at"] else None  # pylint: disable=invalid-name
+        app.logger.info("Request for active promotions for product %s at %s", product_id, at)
+        rows = active_promotions([product_id], at or datetime.now(timezone.utc), RECORD_COLUMNS)
+        with serialization_timer():
+            results = [promotion_record(row) for row in rows]
+        app.logger.info('[%s] Active promotions returned', len(results))
+        return results, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /promotions/evaluate
+######################################################################
+@api.route('/promotions/evaluate')
+class PromotionEvaluation(Resource):
+    """ Prices carts with the Promotions that apply to them """
+
+    # ------------------------------------------------------------------
+    # EVALUATE THE PROMOTIONS OF A CART
+    # ------------------------------------------------------------------
+    @api.doc('evaluate_promotions')
+    @api.response(400, 'The posted cart was not valid')
+    @api.expect(cart_model)
+    @fast_marshal_with(api, evaluation_model)
+    def post(self):
+        """
+        Applies the best Promotions to a cart
+        Each line gets the single active Promotion that saves the most on
+        it, among the Promotions of its product and the site-wide BOGO
+        and DISCOUNT ones. The best site-wide FIXED Promotion is then taken
+        off the cart total. All lines are resolved with one query.
+        """
+        payload = api.payload
+        if not isinstance(payload, dict):
+            abort(status.HTTP_400_BAD_REQUEST, "Cart must be a JSON object.")
+        lines = pricing.parse_lines(payload.get("lines"))
+        if len(lines) > app.config["PRICING_MAX_LINES"]:
+            abort(status.HTTP_400_BAD_REQUEST,
+                  f"Cart cannot contain more than {app.config['PRICING_MAX_LINES']} lines.")
+        at = parse_datetime(payload["at"]) if payload.get("at") else datetime.now(timezone.utc)  # pylint: disable=invalid-name
+        app.logger.info("Request to evaluate a cart of %s lines at %s", len(lines), at)
+        product_ids = list({product_id for product_id, _, _ in lines})
+        promotions = active_promotions(product_ids, at, PRICING_COLUMNS)
+        result = pricing.evaluate_cart(lines, promotions)
+        with serialization_timer():
+            record = evaluation_record(result, at)
+        app.logger.info("Cart of %s lines evaluated with %s off.", len(lines), record["discount"])
+        return record, status.HTTP_200_OK
+
 
 ############################################################
 # Health Endpoint
 ############################################################
 
 
-@app.route("/health")
+@site.route("/health")
 def health():
     """Performs a health check for Kubernetes"""
     return make_response(jsonify(dict(status="OK")), status.HTTP_200_OK)  # pylint: disable=R1735
 
+
+############################################################
+# Stats Endpoint
+############################################################
+@site.route("/stats")
+def stats():
+    """Returns the cache, pool, snapshot, event stream, sweeper and startup counters of this worker process"""
+    pool = dict(pool_stats.stats(), status=db.engine.pool.status())
+    codes = {"found": Promotion.code_cache.stats(), "missing": Promotion.missing_code_cache.stats()}
+    return make_response(jsonify(cache=Promotion.cache.stats(), codes=codes, pool=pool,
+                                 snapshot=snapshot.store.stats(), events=events.hub.stats(),
+                                 sweeper=sweeper.sweeper.stats(), startup=startup_stats()), status.HTTP_200_OK)
+
 ######################################################################
 #  UTILITY FUNCTIONS
 ######################################################################
@@ -280,3 +762,323 @@ def abort(error_code: int, message: str):
     """Logs errors before aborting"""
     app.logger.error(message)
     api.abort(error_code, message)
+
+
+def parse_datetime(value: str) -> datetime:
+    """Parses an ISO 8601 date and time from a request"""
+    if not isinstance(value, str):
+        raise DataValidationError(f"Invalid date: {value!r} is not a string")
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError as error:
+        raise DataValidationError(f"Invalid date: '{value}'") from error
+
+
+def promotion_etag(promotion, field_names: tuple = None) -> str:
+    """Returns the strong entity tag of the current version of a Promotion
+
+    A sparse representation gets its own tag, which If-Match does not accept
+    """
+    etag = f"{promotion.id}.{promotion.version}"
+    if field_names is not None and len(field_names) < len(RECORD_FIELDS):
+        etag += ":" + ",".join(field_names)
+    return etag
+
+
+def collection_etag(promotions: list) -> str:
+    """Returns an entity tag for a page built from the ids and versions on it
+
+    The query string is part of the tag because it shapes the page links
+    """
+    digest = hashlib.sha1(request.query_string, usedforsecurity=False)
+    for promotion in promotions:
+        digest.update(f"|{promotion.id}.{promotion.version}".encode("ascii"))
+    return digest.hexdigest()
+
+
+def check_if_match(promotion):
+    """Aborts with 412 Precondition Failed unless If-Match names the current version"""
+    if request.if_match and not request.if_match.contains(promotion_etag(promotion)):
+        abort(status.HTTP_412_PRECONDITION_FAILED,
+              f"Promotion with id '{promotion.id}' was modified by someone else.")
+
+
+def change_record(change, promotion) -> dict:
+    """Returns what marshalling a change and the current state of its Promotion with change_model gives"""
+    return {
+        "seq": change.seq,
+        "action": change.action,
+        "promotion_id": str(change.promotion_id),
+        "changed_at": change.changed_at,
+        "promotion": promotion_record(promotion) if promotion is not None else None,
+    }
+
+
+def promotion_record(promotion, field_names: tuple = None) -> dict:
+    """Returns what marshalling a Promotion, or a row of its columns, with promotion_model gives
+
+    Args:
+        promotion: a Promotion or a row that has at least the requested columns
+        field_names (tuple): the fields to include (defaults to all of them)
+    """
+    return {name: RECORD_FIELDS[name](promotion) for name in field_names or RECORD_FIELDS}
+
+
+def parse_fields(value: str) -> tuple:
+    """Returns the promotion_model fields named in a fields parameter, in model order"""
+    if not value:
+        return tuple(RECORD_FIELDS)
+    names = {name.strip() for name in value.split(",") if name.strip()}
+    unknown = names - set(RECORD_FIELDS)
+    if unknown or not names:
+        raise DataValidationError(f"Unknown fields: {', '.join(sorted(unknown)) or value}. "
+                                  f"Valid fields are {', '.join(RECORD_FIELDS)}")
+    return tuple(name for name in RECORD_FIELDS if name in names)
+
+
+def active_promotions(product_ids: list, at: datetime, columns: list) -> list:  # pylint: disable=invalid-name
+    """Returns the Promotions of the products, and the site-wide ones, active at a time
+
+    They come from the in-memory snapshot when it covers that time, otherwise
+    the given columns are read from the database
+    """
+    if app.config["SNAPSHOT_ENABLED"]:
+        current = snapshot.store.get()
+        if current.covers(at):
+            return current.active_for_products(product_ids, at)
+    return Promotion.find_active_for_products(product_ids, at).with_entities(*columns).all()
+
+
+def evaluation_record(result: dict, at: datetime) -> dict:  # pylint: disable=invalid-name
+    """Returns a priced cart shaped like evaluation_model"""
+    lines = []
+    for line in result["lines"]:
+        promotion = line["promotion"]
+        lines.append({
+            "product_id": line["product_id"],
+            "quantity": line["quantity"],
+            "unit_price": str(pricing.to_money(line["unit_price"])),
+            "subtotal": str(line["subtotal"]),
+            "discount": str(line["discount"]),
+            "total": str(line["total"]),
+            "promotion_id": str(promotion.id) if promotion else None,
+            "promo_code": promotion.promo_code if promotion else None,
+            "promo_type": promotion.promo_type.name if promotion else None,
+        })
+    cart_promotion = result["cart_promotion"]
+    if cart_promotion:
+        cart_promotion = {
+            "promotion_id": str(cart_promotion["promotion"].id),
+            "promo_code": cart_promotion["promotion"].promo_code,
+            "discount": str(cart_promotion["discount"]),
+        }
+    return {
+        "lines": lines,
+        "cart_promotion": cart_promotion,
+        "subtotal": str(result["subtotal"]),
+        "discount": str(result["discount"]),
+        "total": str(result["total"]),
+        "at": at,
+    }
+
+
+def not_modified(etag: str) -> tuple:
+    """Returns a 304 Not Modified response for an unchanged representation
+
+    The body is empty: the server never sends one with a 304
+    """
+    return None, status.HTTP_304_NOT_MODIFIED, {"ETag": quote_etag(etag)}
+
+
+def page_size(limit: int) -> int:
+    """Returns the requested page size capped at the configured maximum"""
+    if limit is None:
+        limit = app.config["DEFAULT_PAGE_SIZE"]
+    if limit < 1:
+        abort(status.HTTP_400_BAD_REQUEST, "limit must be a positive integer.")
+    return min(limit, app.config["MAX_PAGE_SIZE"])
+
+
+def encode_cursor(last_id: int) -> str:
+    """Encodes the id of the last Promotion on a page into an opaque cursor"""
+    return base64.urlsafe_b64encode(str(last_id).encode("ascii")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> int:
+    """Decodes an opaque cursor back into the id of the last Promotion seen"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        return int(base64.urlsafe_b64decode(padded.encode("ascii")).decode("ascii"))
+    except (binascii.Error, UnicodeError, ValueError) as error:
+        raise DataValidationError(f"Invalid cursor: '{cursor}'") from error
+
+
+def next_page_headers(last_id: int, limit: int) -> dict:
+    """Builds the Link and X-Next-Cursor headers that point at the next page"""
+    cursor = encode_cursor(last_id)
+    args = request.args.to_dict()
+    args.update(cursor=cursor, limit=limit)
+    next_url = api.url_for(PromotionCollection, _external=True, **args)
+    return {"Link": f'<{next_url}>; rel="next"', "X-Next-Cursor": cursor}
+
+
+def parse_ids(value: str) -> list:
+    """Returns the distinct Promotion ids of an ids parameter, in the order given"""
+    try:
+        ids = [int(promotion_id) for promotion_id in value.split(",") if promotion_id.strip()]
+    except ValueError as error:
+        raise DataValidationError(f"Invalid ids: '{value}'") from error
+    if not ids:
+        raise DataValidationError("ids must name at least one Promotion")
+    if len(ids) > app.config["BATCH_GET_MAX_IDS"]:
+        raise DataValidationError(f"Too many ids: at most {app.config['BATCH_GET_MAX_IDS']} may be fetched at once")
+    return list(dict.fromkeys(ids))
+
+
+def promotions_by_ids(args: dict, field_names: tuple) -> tuple:
+    """Answers GET /promotions?ids= with the Promotions found, in the requested order"""
+    mixed = [name for name in (*FILTERABLE_COLUMNS, "limit", "cursor") if args[name] is not None]
+    if mixed:
+        raise DataValidationError(f"ids cannot be combined with {', '.join(mixed)}")
+    ids = parse_ids(args["ids"])
+    found = Promotion.find_many(ids)
+    promotions = [found[promotion_id] for promotion_id in ids if promotion_id in found]
+    headers = {}
+    missing = [str(promotion_id) for promotion_id in ids if promotion_id not in found]
+    if missing:
+        headers["X-Missing-Ids"] = ",".join(missing)
+
+    etag = collection_etag(promotions)
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+    headers["ETag"] = quote_etag(etag)
+    with serialization_timer():
+        results = [promotion_record(promotion, field_names) for promotion in promotions]
+    app.logger.info("[%s] of %s requested Promotions returned", len(results), len(ids))
+    return results, status.HTTP_200_OK, headers
+
+
+class EchoBuffer:  # pylint: disable=too-few-public-methods
+    """File-like object that hands back whatever is written to it"""
+
+    def write(self, value):
+        """Returns the value instead of buffering it"""
+        return value
+
+
+def ndjson_lines(promotions):
+    """Yields each Promotion as a line of newline delimited JSON"""
+    for promotion in promotions:
+        yield json.dumps(promotion.serialize()) + "\n"
+
+
+def csv_lines(promotions):
+    """Yields a CSV header followed by one CSV line per Promotion"""
+    writer = csv.DictWriter(EchoBuffer(), fieldnames=["id", *create_model])
+    yield writer.writeheader()
+    for promotion in promotions:
+        yield writer.writerow(promotion.serialize())
+
+
+def change_events(since: int):
+    """Yields the changes after since as Server-Sent Events and then the next ones as they come
+
+    Changes are read from the change log in batches only when the client
+    has taken the previous ones, so a slow client holds nothing in memory
+    """
+    config = app.config
+    deadline = time.monotonic() + config["EVENTS_MAX_DURATION"]
+    yield f"retry: {config['EVENTS_RETRY_MS']}\n\n"
+    while True:
+        generation = events.hub.generation
+        batch, has_more = read_change_events(since)
+        for seq, event in batch:
+            since = seq
+            yield event
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        if not has_more and not events.hub.wait(generation, min(config["EVENTS_HEARTBEAT"], remaining)):
+            yield ": keep-alive\n\n"
+
+
+def read_change_events(since: int) -> tuple:
+    """Returns the next batch of changes after since as (seq, event) pairs, and whether more follow"""
+    size = app.config["EVENTS_BATCH_SIZE"]
+    rows = PromotionChange.since(since, size)
+    batch = [change_event(change, promotion) for change, promotion in rows[:size]]
+    db.session.remove()  # give the connection back while the client reads or we wait
+    return batch, len(rows) > size
+
+
+def change_event(change, promotion) -> tuple:
+    """Returns the seq of a change and the change as a Server-Sent Event"""
+    data = dumps(change_record(change, promotion)).decode("utf-8")
+    return change.seq, f"id: {change.seq}\nevent: {change.action}\ndata: {data}\n\n"
+
+
+def parse_batch_operation(operation: dict) -> tuple:
+    """Validates one batch operation and returns its name and target
+
+    The target is a Promotion for create and update, and an id for delete
+    """
+    if not isinstance(operation, dict):
+        raise DataValidationError("Invalid operation: must be an object")
+    op_name = operation.get("op")
+    if op_name not in ("create", "update", "delete"):
+        raise DataValidationError(f"Invalid operation: unknown op '{op_name}'")
+    promotion_id = operation.get("id")
+    if op_name != "create" and (not isinstance(promotion_id, int) or isinstance(promotion_id, bool)):
+        raise DataValidationError(f"Invalid operation: {op_name} requires an integer id")
+    if op_name == "delete":
+        return op_name, operation["id"]
+    promotion = Promotion().deserialize(operation.get("data"))
+    promotion.id = operation.get("id")
+    return op_name, promotion
+
+
+def batch_result(position: int, op_name: str, code: int, **extra) -> dict:
+    """Builds the result entry reported for one batch operation"""
+    return {"index": position, "op": op_name, "status": code, **extra}
+
+
+def apply_batch_chunks(op_name: str, operations: list, results: list, chunk_size: int, apply):
+    """Applies the operations of one kind chunk by chunk
+
+    A chunk the database rejects is rolled back and only its own
+    operations are reported as failed; the chunks before and after it
+    are still written
+    """
+    for chunk in chunked(operations, chunk_size):
+        try:
+            apply(chunk, results, chunk_size)
+        except SQLAlchemyError as error:
+            db.session.rollback()
+            app.logger.error("Batch chunk of %s %s operations failed: %s", len(chunk), op_name, error)
+            for position, target in chunk:
+                results[position] = batch_result(position, op_name, status.HTTP_500_INTERNAL_SERVER_ERROR,
+                                                 id=getattr(target, "id", target),
+                                                 error=f"The database rejected this chunk: {error.__class__.__name__}")
+
+
+def apply_batch_creates(creates: list, results: list, chunk_size: int):
+    """Creates the Promotions of a batch and records their new ids"""
+    ids = Promotion.create_many([promotion for _, promotion in creates], chunk_size)
+    for (position, _), promotion_id in zip(creates, ids):
+        results[position] = batch_result(position, "create", status.HTTP_201_CREATED, id=promotion_id)
+
+
+def apply_batch_updates(updates: list, results: list, chunk_size: int):
+    """Updates the Promotions of a batch and records which ones were found"""
+    updated = Promotion.update_many([promotion for _, promotion in updates], chunk_size)
+    for position, promotion in updates:
+        code = status.HTTP_200_OK if promotion.id in updated else status.HTTP_404_NOT_FOUND
+        results[position] = batch_result(position, "update", code, id=promotion.id)
+
+
+def apply_batch_deletes(deletes: list, results: list, chunk_size: int):
+    """Deletes the Promotions of a batch and records which ones were found"""
+    deleted = Promotion.delete_many([promotion_id for _, promotion_id in deletes], chunk_size)
+    for position, promotion_id in deletes:
+        code = status.HTTP_204_NO_CONTENT if promotion_id in deleted else status.HTTP_404_NOT_FOUND
+        results[position] = batch_result(position, "delete", code, id=promotion_id)
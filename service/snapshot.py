@@ -0,0 +1,245 @@
+"""
+Promotion Snapshot
+
+An immutable in-memory copy of every Promotion that has not ended yet,
+so checkout-time lookups of the Promotions active at a time need no
+database round-trip.
+
+Promotions are grouped by product (site-wide ones on their own) and kept
+sorted by start date together with the longest duration of the group.
+Promotions active at T must have started in [T - longest duration, T],
+so two binary searches find the only rows that have to be checked.
+
+Committed changes mark their ids dirty. The next lookup reloads just those
+rows, rebuilds the groups they belong to and swaps in a new snapshot, while
+other threads keep reading the old one. The whole snapshot is rebuilt at
+least every SNAPSHOT_MAX_AGE seconds, which bounds the staleness when a
+change notification is missed.
+"""
+import logging
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta, timezone
+from service.models import Promotion, as_utc, change_subscribers
+
+logger = logging.getLogger("flask.app")
+
+SNAPSHOT_FIELDS = ("id", "title", "promo_code", "promo_type", "amount",
+                   "start_date", "end_date", "is_site_wide", "product_id")
+
+
+class PromotionRecord:  # pylint: disable=too-few-public-methods
+    """The read-only values of one Promotion"""
+
+    __slots__ = SNAPSHOT_FIELDS
+
+    def __init__(self, *values):
+        for name, value in zip(SNAPSHOT_FIELDS, values):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Snapshot records are read-only")
+
+    def __repr__(self):
+        return f"<PromotionRecord {self.promo_code} id=[{self.id}]>"
+
+
+class IntervalIndex:  # pylint: disable=too-few-public-methods
+    """Promotions sorted by start date for finding the ones active at a time"""
+
+    __slots__ = ("records", "starts", "max_span")
+
+    def __init__(self, records):
+        self.records = sorted(records, key=lambda record: (record.start_date, record.id))
+        self.starts = [record.start_date for record in self.records]
+        self.max_span = max((record.end_date - record.start_date for record in self.records),
+                            default=timedelta(0))
+
+    def active_at(self, at: datetime) -> list:  # pylint: disable=invalid-name
+        """Returns the Promotions with start_date <= at <= end_date"""
+        high = bisect_right(self.starts, at)
+        try:
+            low = bisect_left(self.starts, at - self.max_span, 0, high)
+        except OverflowError:
+            low = 0
+        return [record for record in self.records[low:high] if record.end_date >= at]
+
+
+class Snapshot:
+    """Immutable view of the Promotions that had not ended at a point in time"""
+
+    def __init__(self, records: dict, since: datetime, by_product: dict, site_wide: IntervalIndex):
+        self.records = records
+        self.since = since
+        self.by_product = by_product
+        self.site_wide = site_wide
+
+    def __len__(self):
+        return len(self.records)
+
+    @classmethod
+    def build(cls, records: list, since: datetime) -> "Snapshot":
+        """Builds a snapshot of the records that end at or after since"""
+        records = {record.id: record for record in records if record.end_date >= since}
+        groups = {}
+        site_wide = []
+        for record in records.values():
+            if record.is_site_wide:
+                site_wide.append(record)
+            else:
+                groups.setdefault(record.product_id, []).append(record)
+        by_product = {product_id: IntervalIndex(group) for product_id, group in groups.items()}
+        return cls(records, since, by_product, IntervalIndex(site_wide))
+
+    def covers(self, at: datetime) -> bool:  # pylint: disable=invalid-name
+        """Tells whether the snapshot holds every Promotion active at a time"""
+        return as_utc(at) >= self.since
+
+    def active_for_products(self, product_ids, at: datetime) -> list:  # pylint: disable=invalid-name
+        """Returns the Promotions of the products, and the site-wide ones, active at a time, by id"""
+        at = as_utc(at)
+        found = self.site_wide.active_at(at)
+        for product_id in set(product_ids):
+            index = self.by_product.get(product_id)
+            if index is not None:
+                found.extend(index.active_at(at))
+        return sorted(found, key=lambda record: record.id)
+
+    def with_changes(self, changed_ids: set, records: list) -> "Snapshot":
+        """Returns a new snapshot with the changed ids replaced by their current records
+
+        Only the groups that lost or gained a Promotion are rebuilt
+
+        Args:
+            changed_ids (set): every id that changed, including deleted ones
+            records (list): the current records of the changed ids that still exist
+        """
+        merged = dict(self.records)
+        touched = set()
+        for promotion_id in changed_ids:
+            old = merged.pop(promotion_id, None)
+            if old is not None:
+                touched.add(None if old.is_site_wide else old.product_id)
+        for record in records:
+            if record.end_date >= self.since:
+                merged[record.id] = record
+                touched.add(None if record.is_site_wide else record.product_id)
+
+        by_product = dict(self.by_product)
+        site_wide = self.site_wide
+        for product_id in touched:
+            index = site_wide if product_id is None else by_product.get(product_id)
+            kept = [record for record in (index.records if index else []) if record.id not in changed_ids]
+            added = [record for record in records if record.id in merged and
+                     (record.is_site_wide if product_id is None else
+                      not record.is_site_wide and record.product_id == product_id)]
+            if product_id is None:
+                site_wide = IntervalIndex(kept + added)
+            elif kept or added:
+                by_product[product_id] = IntervalIndex(kept + added)
+            else:
+                by_product.pop(product_id, None)
+        return Snapshot(merged, self.since, by_product, site_wide)
+
+
+def load_records(since: datetime, ids=None) -> list:
+    """Reads the Promotions that end at or after since, optionally only some ids"""
+    query = Promotion.query.with_entities(*[getattr(Promotion, name) for name in SNAPSHOT_FIELDS])
+    query = query.filter(Promotion.end_date >= since)
+    if ids is not None:
+        query = query.filter(Promotion.id.in_(ids))
+    return [PromotionRecord(*row) for row in query]
+
+
+class SnapshotStore:  # pylint: disable=too-many-instance-attributes
+    """Holds the current snapshot and keeps it up to date with the committed changes"""
+
+    def __init__(self, max_age: float = 300.0):
+        self.max_age = max_age
+        self.full_builds = 0
+        self.incremental_updates = 0
+        self._snapshot = None
+        self._built_at = 0.0
+        self._dirty = set()
+        self._rebuild = True
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def on_change(self, action: str, promotion_ids):  # pylint: disable=unused-argument
+        """Marks changed Promotions for reloading (all of them when the ids are unknown)"""
+        with self._lock:
+            if promotion_ids is None:
+                self._rebuild = True
+            else:
+                self._dirty.update(promotion_ids)
+
+    def invalidate(self):
+        """Forces a full rebuild on the next lookup"""
+        self.on_change("reset", None)
+
+    def get(self) -> Snapshot:
+        """Returns an up to date snapshot, reloading what changed since the last one
+
+        When another thread is already refreshing, the previous snapshot is
+        returned rather than waiting for it
+        """
+        snapshot = self._snapshot
+        if snapshot is not None and not self._is_stale():
+            return snapshot
+        if not self._refresh_lock.acquire(blocking=snapshot is None):  # pylint: disable=consider-using-with
+            return snapshot
+        try:
+            return self._refresh()
+        finally:
+            self._refresh_lock.release()
+
+    def peek(self):
+        """Returns the current snapshot if it is up to date, or None when it needs a refresh
+
+        Unlike get() this never reads the database, so it is safe on an event loop
+        """
+        snapshot = self._snapshot
+        return None if snapshot is None or self._is_stale() else snapshot
+
+    def stats(self) -> dict:
+        """Returns the size, age and rebuild counters of the snapshot"""
+        snapshot = self._snapshot
+        return {
+            "size": len(snapshot) if snapshot else 0,
+            "age_seconds": round(time.monotonic() - self._built_at, 3) if snapshot else None,
+            "full_builds": self.full_builds,
+            "incremental_updates": self.incremental_updates,
+        }
+
+    def _is_stale(self) -> bool:
+        with self._lock:
+            return self._rebuild or bool(self._dirty) or time.monotonic() - self._built_at > self.max_age
+
+    def _refresh(self) -> Snapshot:
+        with self._lock:
+            rebuild = self._rebuild or self._snapshot is None or time.monotonic() - self._built_at > self.max_age
+            dirty, self._dirty, self._rebuild = self._dirty, set(), False
+        if rebuild:
+            since = datetime.now(timezone.utc).replace(tzinfo=None)
+            started = time.monotonic()
+            self._snapshot = Snapshot.build(load_records(since), since)
+            self._built_at = started
+            self.full_builds += 1
+            logger.info("Built a snapshot of %s promotions", len(self._snapshot))
+        elif dirty:
+            self._snapshot = self._snapshot.with_changes(dirty, load_records(self._snapshot.since, dirty))
+            self.incremental_updates += 1
+        return self._snapshot
+
+
+# The snapshot shared by every thread of this process
+store = SnapshotStore()
+
+
+def init_snapshot(app):
+    """Configures the snapshot and subscribes it to committed changes"""
+    store.max_age = app.config["SNAPSHOT_MAX_AGE"]
+    store.invalidate()
+    if store.on_change not in change_subscribers:
+        change_subscribers.append(store.on_change)
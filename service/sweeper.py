@@ -0,0 +1,147 @@
+"""
+Promotion Expiry Sweeper
+
+Deactivates site-wide Promotions once their end_date has passed, so
+they do not stay active forever after their window closed.
+
+`flask expire-promotions` runs one sweep, e.g. from cron. With
+SWEEPER_ENABLED every worker also runs an ExpirySweeper thread. It keeps
+a min-heap of the next end dates, so it sleeps until the soonest one
+instead of scanning the table. Committed changes push the end dates of
+the Promotions they touched onto the heap. Stale entries only cause a
+sweep that finds nothing, and the heap is reloaded at least every
+SWEEPER_MAX_SLEEP seconds in case a change notification was missed.
+Sweeps in several workers at once are safe: each Promotion is only
+deactivated by one of them.
+"""
+import heapq
+import logging
+import os
+import threading
+from datetime import datetime, timezone
+from service.models import Promotion, as_utc, change_subscribers
+
+logger = logging.getLogger("flask.app")
+
+
+class ExpirySweeper:  # pylint: disable=too-many-instance-attributes
+    """Sleeps until the next site-wide Promotion ends and then deactivates the ended ones"""
+
+    def __init__(self):
+        self.app = None
+        self.heap = []
+        self.sweeps = 0
+        self.expired = 0
+        self._pending = set()
+        self._reload = True
+        self._pid = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+
+    def on_change(self, action: str, promotion_ids):  # pylint: disable=unused-argument
+        """Schedules the changed Promotions (subscribed to committed Promotion changes)"""
+        with self._lock:
+            if promotion_ids is None:
+                self._reload = True
+            else:
+                self._pending.update(promotion_ids)
+        self._wake.set()
+
+    def start(self):
+        """Starts the sweeper thread of this process, unless it is already running
+
+        Safe to call on every request: after a fork the child starts its own
+        """
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._reload = True
+        thread = threading.Thread(target=self._run, name="promotion-expiry-sweeper", daemon=True)
+        thread.start()
+
+    def next_wakeup(self, now: datetime) -> float:
+        """Returns the seconds until the soonest scheduled end date, at most SWEEPER_MAX_SLEEP"""
+        max_sleep = self.app.config["SWEEPER_MAX_SLEEP"]
+        if not self.heap:
+            return max_sleep
+        # a Promotion is still active at its end_date, so it is swept just after it
+        return max(0.0, min(max_sleep, (self.heap[0][0] - now).total_seconds() + 0.001))
+
+    def schedule(self):
+        """Loads the end dates of the changed Promotions, or all the soonest ones, onto the heap"""
+        with self._lock:
+            reload, pending = self._reload, list(self._pending)
+            self._reload, self._pending = False, set()
+        size = self.app.config["SWEEPER_HEAP_SIZE"]
+        # entries of Promotions that changed again pile up while changes keep coming
+        if reload or len(self.heap) > 2 * size:
+            self.heap = Promotion.upcoming_expiries(size)
+            heapq.heapify(self.heap)
+        elif pending:
+            for entry in Promotion.upcoming_expiries(size, pending):
+                heapq.heappush(self.heap, entry)
+
+    def run_due(self, now: datetime) -> list:
+        """Sweeps when the soonest end date has passed and returns the ids deactivated"""
+        now = as_utc(now)
+        if not self.heap or self.heap[0][0] >= now:
+            return []
+        while self.heap and self.heap[0][0] < now:
+            heapq.heappop(self.heap)
+        expired = self.sweep(self.app.config["SWEEPER_BATCH_SIZE"], now)
+        if not self.heap:
+            # the heap only held the soonest SWEEPER_HEAP_SIZE entries: fetch the next ones
+            self.on_change("reset", None)
+        return expired
+
+    def sweep(self, batch_size: int, now: datetime = None) -> list:
+        """Deactivates every site-wide Promotion that has ended and returns their ids"""
+        expired = Promotion.expire_ended(now or datetime.now(timezone.utc), batch_size)
+        self.sweeps += 1
+        self.expired += len(expired)
+        if expired:
+            logger.info("Deactivated %s promotions that ended", len(expired))
+        return expired
+
+    def _run(self):
+        """Sweeps whenever a Promotion ends until the process exits"""
+        max_sleep = self.app.config["SWEEPER_MAX_SLEEP"]
+        while self._pid == os.getpid():
+            self._wake.clear()
+            wait = max_sleep
+            try:
+                with self.app.app_context():
+                    self.schedule()
+                    self.run_due(datetime.now(timezone.utc))
+                    wait = self.next_wakeup(as_utc(datetime.now(timezone.utc)))
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Promotion expiry sweep failed")
+            if not self._wake.wait(wait) and wait >= max_sleep:
+                self.on_change("reset", None)  # no change heard of for a while: reload in case one was missed
+
+    def stats(self) -> dict:
+        """Returns the size of the heap, the time until its next end date and the sweep counters"""
+        next_end = self.heap[0][0] if self.heap else None
+        now = as_utc(datetime.now(timezone.utc))
+        return {
+            "running": self._pid == os.getpid(),
+            "scheduled": len(self.heap),
+            "next_in_seconds": round((next_end - now).total_seconds(), 3) if next_end else None,
+            "sweeps": self.sweeps,
+            "expired": self.expired,
+        }
+
+
+# The sweeper of this process
+sweeper = ExpirySweeper()
+
+
+def init_sweeper(app):
+    """Subscribes the sweeper to committed changes and starts it with the first request if enabled"""
+    sweeper.app = app
+    if sweeper.on_change not in change_subscribers:
+        change_subscribers.append(sweeper.on_change)
+    if app.config["SWEEPER_ENABLED"]:
+        # started per process on first use, so preloading gunicorn workers fork no thread
+        app.before_request(sweeper.start)
@@ -0,0 +1,271 @@
+"""
+Test cases for the ASGI entry point
+
+Test cases can be run with:
+    nosetests
+    coverage report -m
+"""
+import asyncio
+import gzip
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from unittest import TestCase
+from unittest.mock import patch
+from service import app
+from service.asgi import AsyncPromotionApp, async_database_uri, wsgi_environ
+from service.common import status
+from service.events import hub
+from service.models import Promotion, db, init_db
+from tests.factories import PromotionsFactory
+
+BASE_URL = "/api/promotions"
+
+
+async def call_asgi(asgi_app, path: str, method: str = "GET", query: str = "", headers: dict = None) -> tuple:
+    """Sends one request through an ASGI app and returns its status, headers and body"""
+    scope = {
+        "type": "http", "http_version": "1.1", "method": method, "scheme": "http",
+        "path": path, "raw_path": path.encode(), "root_path": "", "query_string": query.encode(),
+        "headers": [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()],
+        "server": ("localhost", 80), "client": ("127.0.0.1", 12345),
+    }
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    try:
+        await asgi_app(scope, receive, send)
+    finally:
+        await asgi_app.dispose()
+    start = messages[0]
+    response_headers = {name.decode().lower(): value.decode() for name, value in start["headers"]}
+    body = b"".join(message.get("body", b"") for message in messages[1:])
+    return start["status"], response_headers, body
+
+
+######################################################################
+#  A S G I   T E S T   C A S E S
+######################################################################
+class TestAsgi(TestCase):
+    """ Tests the async read paths against the Flask resources """
+
+    @classmethod
+    def setUpClass(cls):
+        """ This runs once before the entire test suite """
+        app.config["TESTING"] = True
+        app.logger.setLevel(logging.CRITICAL)
+        init_db(app)
+
+    def setUp(self):
+        """ This runs before each test """
+        self.client = app.test_client()
+        self.asgi = AsyncPromotionApp(app)
+        db.session.query(Promotion).delete()
+        db.session.commit()
+        # the bulk delete records no change, so reset the caches and the snapshot like one would
+        Promotion.dispatch_changes("delete", None)
+
+    def tearDown(self):
+        """ This runs after each test """
+        db.session.remove()
+
+    def _get(self, path, query="", headers=None):
+        """Sends a GET request through the ASGI app"""
+        return asyncio.run(self._call(path, query, headers))
+
+    def _call(self, path, query="", headers=None):
+        """Returns a coroutine that sends a GET request through the ASGI app"""
+        return call_asgi(self.asgi, path, query=query, headers=headers)
+
+    def _create(self, **kwargs):
+        """Creates a Promotion that runs from yesterday until next year"""
+        now = datetime.utcnow()
+        promotion = PromotionsFactory(start_date=now - timedelta(days=1), end_date=now + timedelta(days=365), **kwargs)
+        promotion.create()
+        return promotion
+
+    def test_async_database_uri(self):
+        """It should switch a database URI to the async driver"""
+        self.assertEqual(async_database_uri("postgresql://user:pass@db:5432/promotions"),
+                         "postgresql+asyncpg://user:pass@db:5432/promotions")
+        self.assertEqual(async_database_uri("postgresql+psycopg2://db/promotions"), "postgresql+asyncpg://db/promotions")
+        self.assertEqual(async_database_uri("sqlite:////tmp/test.db"), "sqlite+aiosqlite:////tmp/test.db")
+        self.assertEqual(async_database_uri("mysql://db/promotions"), "mysql://db/promotions")
+
+    def test_wsgi_environ(self):
+        """It should expose the query and the headers of an ASGI request to werkzeug"""
+        environ = wsgi_environ({"method": "GET", "path": "/x", "query_string": b"a=1",
+                                "headers": [(b"accept", b"text/plain"), (b"accept", b"application/json"),
+                                            (b"content-type", b"application/json")]})
+        self.assertEqual(environ["QUERY_STRING"], "a=1")
+        self.assertEqual(environ["HTTP_ACCEPT"], "text/plain,application/json")
+        self.assertEqual(environ["CONTENT_TYPE"], "application/json")
+
+    def test_get_promotion(self):
+        """It should read a Promotion asynchronously exactly like the Flask resource"""
+        promotion = self._create()
+        expected = self.client.get(f"{BASE_URL}/{promotion.id}")
+        Promotion.cache.clear()
+        code, headers, body = self._get(f"{BASE_URL}/{promotion.id}")
+        self.assertEqual(code, status.HTTP_200_OK)
+        self.assertEqual(body, expected.get_data())
+        self.assertEqual(headers["etag"], expected.headers["ETag"])
+        self.assertEqual(headers["content-type"], "application/json")
+        # now served from the cache the async read filled
+        self.assertIn(promotion.id, Promotion.cache._entries)  # pylint: disable=protected-access
+        code, _, body = self._get(f"{BASE_URL}/{promotion.id}", "fields=title")
+        self.assertEqual(body, self.client.get(f"{BASE_URL}/{promotion.id}?fields=title").get_data())
+
+    def test_get_promotion_not_modified(self):
+        """It should answer 304 Not Modified to a matching If-None-Match"""
+        promotion = self._create()
+        etag = self.client.get(f"{BASE_URL}/{promotion.id}").headers["ETag"]
+        code, headers, body = self._get(f"{BASE_URL}/{promotion.id}", headers={"If-None-Match": etag})
+        self.assertEqual(code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual((headers["etag"], body), (etag, b""))
+
+    def test_errors_come_from_flask(self):
+        """It should let the Flask app answer requests that need an error response"""
+        code, _, body = self._get(f"{BASE_URL}/0")
+        self.assertEqual(code, status.HTTP_404_NOT_FOUND)
+        self.assertIn(b"was not found", body)
+        code, _, _ = self._get(f"{BASE_URL}/1", "fields=nope")
+        self.assertEqual(code, status.HTTP_400_BAD_REQUEST)
+        code, _, _ = self._get("/api/products/1/promotions/active", "at=yesterday")
+        self.assertEqual(code, status.HTTP_400_BAD_REQUEST)
+        code, _, _ = self._get(f"{BASE_URL}/codes/NOPE")
+        self.assertEqual(code, status.HTTP_404_NOT_FOUND)
+
+    def test_other_requests_go_to_flask(self):
+        """It should hand every other request, and masked reads, to the Flask app"""
+        promotion = self._create()
+        code, _, body = self._get("/health")
+        self.assertEqual((code, body), (status.HTTP_200_OK, b'{"status":"OK"}\n'))
+        code, _, body = self._get(f"{BASE_URL}/{promotion.id}", headers={"X-Fields": "title"})
+        self.assertEqual(body, self.client.get(f"{BASE_URL}/{promotion.id}", headers={"X-Fields": "title"}).get_data())
+        code, _, _ = asyncio.run(call_asgi(self.asgi, f"{BASE_URL}/{promotion.id}", method="DELETE"))
+        self.assertEqual(code, status.HTTP_204_NO_CONTENT)
+
+    def test_get_promotions_by_code(self):
+        """It should look up a promo code asynchronously"""
+        promotion = self._create(promo_code="SAVE10")
+        _, _, body = self._get(f"{BASE_URL}/codes/save10", "ignore_case=true")
+        self.assertEqual(body, self.client.get(f"{BASE_URL}/codes/SAVE10").get_data())
+        self.assertIn(str(promotion.id).encode(), body)
+        code, _, _ = self._get(f"{BASE_URL}/codes/save10")
+        self.assertEqual(code, status.HTTP_404_NOT_FOUND)
+        self.assertTrue(Promotion.missing_code_cache.get(("save10", False)))
+
+    def test_get_active_promotions(self):
+        """It should find the active Promotions from the snapshot or the database"""
+        self._create(product_id=7, is_site_wide=False)
+        self._create(is_site_wide=True)
+        self._create(product_id=8, is_site_wide=False)
+        expected = self.client.get("/api/products/7/promotions/active").get_data()
+        code, _, body = self._get("/api/products/7/promotions/active")
+        self.assertEqual((code, body), (status.HTTP_200_OK, expected))
+        app.config["SNAPSHOT_ENABLED"] = False
+        try:
+            _, _, body = self._get("/api/products/7/promotions/active")
+        finally:
+            app.config["SNAPSHOT_ENABLED"] = True
+        self.assertEqual(body, expected)
+
+    def test_compression(self):
+        """It should compress large responses like the Flask app"""
+        for _ in range(20):
+            self._create(is_site_wide=True)
+        code, headers, body = self._get("/api/products/1/promotions/active", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(code, status.HTTP_200_OK)
+        self.assertEqual(headers["content-encoding"], "gzip")
+        self.assertEqual(headers["vary"], "Accept-Encoding")
+        self.assertEqual(gzip.decompress(body), self.client.get("/api/products/1/promotions/active").get_data())
+
+    def test_lifespan(self):
+        """It should create the engine on startup and dispose of it on shutdown"""
+        messages = iter([{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}])
+        sent = []
+
+        async def receive():
+            return next(messages)
+
+        async def send(message):
+            sent.append(message["type"])
+
+        asyncio.run(self.asgi({"type": "lifespan"}, receive, send))
+        self.assertEqual(sent, ["lifespan.startup.complete", "lifespan.shutdown.complete"])
+        self.assertIsNone(self.asgi.engine)
+
+    def test_fallback_requests_overlap(self):
+        """It should run the requests handed to the Flask app on several threads at once"""
+        threads = set()
+
+        def slow_health():
+            threads.add(threading.get_ident())
+            time.sleep(0.3)
+            return {"status": "OK"}
+
+        async def call_both():
+            return await asyncio.gather(self._call("/health"), self._call("/health"))
+
+        with patch.dict(app.view_functions, {"site.health": slow_health}):
+            started = time.monotonic()
+            results = asyncio.run(call_both())
+            elapsed = time.monotonic() - started
+        self.assertEqual([code for code, _, _ in results], [status.HTTP_200_OK] * 2)
+        self.assertEqual(len(threads), 2)
+        self.assertLess(elapsed, 0.55)
+
+    def test_change_stream(self):
+        """It should stream the changes on the event loop until the client leaves"""
+        promotion = self._create()
+        sent, left = [], None
+
+        async def receive():
+            if not sent:
+                return {"type": "http.request", "body": b"", "more_body": False}
+            await left.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            sent.append(message)
+            if b"id: " in message.get("body", b""):
+                left.set()
+
+        async def stream():
+            nonlocal left
+            left = asyncio.Event()
+            scope = {"type": "http", "method": "GET", "path": "/api/promotions/changes/stream",
+                     "query_string": b"since=0", "headers": []}
+            await asyncio.wait_for(self.asgi(scope, receive, send), 5)
+            await self.asgi.dispose()
+
+        asyncio.run(stream())
+        self.assertEqual(sent[0]["status"], status.HTTP_200_OK)
+        self.assertIn((b"content-type", b"text/event-stream; charset=utf-8"), sent[0]["headers"])
+        body = b"".join(message.get("body", b"") for message in sent[1:])
+        self.assertTrue(body.startswith(b"retry: "))
+        self.assertIn(f'"promotion_id":"{promotion.id}"'.encode(), body)
+        self.assertEqual(hub.streams, 0)
+
+    def test_change_stream_bad_since(self):
+        """It should let the Flask app reject a stream with a bad since"""
+        code, _, _ = self._get("/api/promotions/changes/stream", "since=soon")
+        self.assertEqual(code, status.HTTP_400_BAD_REQUEST)
+
+    def test_change_stream_limit(self):
+        """It should answer 503 when the worker already serves as many streams as it may"""
+        max_streams = hub.max_streams
+        hub.max_streams = 0
+        try:
+            code, _, body = self._get("/api/promotions/changes/stream")
+        finally:
+            hub.max_streams = max_streams
+        self.assertEqual(code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertIn(b"change streams", body)
@@ -0,0 +1,54 @@
+"""
+Benchmark Report Test Suite
+
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+"""
+import json
+import os
+import tempfile
+from unittest import TestCase
+from scripts.benchmark import compare, make_call, summarize
+
+
+class TestBenchmarkReport(TestCase):
+    """Tests the summaries and comparisons of benchmark runs"""
+
+    def test_summarize(self):
+        """It should compute the throughput and latency percentiles"""
+        latencies = [i / 1000 for i in range(1, 101)]
+        result = summarize(latencies, errors=2, elapsed=2.0)
+        self.assertEqual(result["requests"], 100)
+        self.assertEqual(result["errors"], 2)
+        self.assertEqual(result["requests_per_second"], 50.0)
+        self.assertAlmostEqual(result["p50_ms"], 50.5, places=1)
+        self.assertAlmostEqual(result["p99_ms"], 99.01, places=1)
+
+    def test_summarize_single_request(self):
+        """It should summarize a run of one request"""
+        result = summarize([0.005], errors=0, elapsed=0.005)
+        self.assertEqual(result["p50_ms"], 5.0)
+        self.assertEqual(result["p99_ms"], 5.0)
+
+    def test_make_call(self):
+        """It should build a request for every endpoint"""
+        method, path, payload, expected = make_call("create", [7], 10)
+        self.assertEqual((method, path, expected), ("POST", "/api/promotions", 201))
+        self.assertNotIn("id", payload)
+        self.assertEqual(make_call("list", [7], 10)[1], "/api/promotions?limit=10")
+        self.assertEqual(make_call("activate", [7], 10)[1], "/api/promotions/7/activate")
+
+    def test_compare(self):
+        """It should flag an endpoint whose p95 latency regressed"""
+        baseline = {"results": {
+            "get": {"p95_ms": 10.0, "requests_per_second": 100.0},
+            "list": {"p95_ms": 10.0, "requests_per_second": 100.0},
+        }}
+        with tempfile.TemporaryDirectory() as directory:
+            baseline_file = os.path.join(directory, "baseline.json")
+            with open(baseline_file, "w", encoding="utf-8") as output:
+                json.dump(baseline, output)
+            faster = {"get": {"p95_ms": 9.0, "requests_per_second": 105.0}}
+            self.assertTrue(compare(faster, baseline_file, 10.0))
+            slower = {"list": {"p95_ms": 12.0, "requests_per_second": 100.0}}
+            self.assertFalse(compare(slower, baseline_file, 10.0))
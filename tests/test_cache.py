@@ -0,0 +1,68 @@
+"""
+Test cases for the in-process TTLCache
+"""
+from unittest import TestCase
+from unittest.mock import patch
+from service.common.cache import TTLCache
+
+
+class TestTTLCache(TestCase):
+    """TTLCache Tests"""
+
+    def test_get_and_set(self):
+        """It should return cached values and count hits and misses"""
+        cache = TTLCache(max_size=10, ttl=60)
+        self.assertIsNone(cache.get(1))
+        cache.set(1, "one")
+        self.assertEqual(cache.get(1), "one")
+        stats = cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["size"], 1)
+
+    def test_evicts_least_recently_used(self):
+        """It should evict the least recently used entry when full"""
+        cache = TTLCache(max_size=2, ttl=60)
+        cache.set(1, "one")
+        cache.set(2, "two")
+        cache.get(1)
+        cache.set(3, "three")
+        self.assertEqual(cache.get(1), "one")
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    @patch("service.common.cache.time.monotonic")
+    def test_expires_entries(self, monotonic_mock):
+        """It should expire entries after the time to live"""
+        monotonic_mock.return_value = 100.0
+        cache = TTLCache(max_size=10, ttl=5)
+        cache.set(1, "one")
+        monotonic_mock.return_value = 106.0
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.stats()["expirations"], 1)
+        self.assertEqual(len(cache), 0)
+
+    def test_invalidate_and_clear(self):
+        """It should remove invalidated and cleared entries"""
+        cache = TTLCache(max_size=10, ttl=60)
+        cache.set(1, "one")
+        cache.set(2, "two")
+        cache.invalidate(1)
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.get(2), "two")
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_set_skips_stale_generation(self):
+        """It should not cache a value read before an invalidation"""
+        cache = TTLCache(max_size=10, ttl=60)
+        generation = cache.generation
+        cache.invalidate(1)
+        cache.set(1, "stale", generation)
+        self.assertIsNone(cache.get(1))
+
+    def test_disabled_cache(self):
+        """It should not cache anything when the size is zero"""
+        cache = TTLCache(max_size=0, ttl=60)
+        cache.set(1, "one")
+        self.assertIsNone(cache.get(1))
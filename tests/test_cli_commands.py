@@ -2,10 +2,12 @@
 CLI Command Extensions for Flask
 """
 import os
+from datetime import datetime, timezone
 from unittest import TestCase
 from unittest.mock import patch, MagicMock
 from click.testing import CliRunner
-from service.common.cli_commands import db_create
+from service.common.cli_commands import archive_promotions, db_create, db_migrate, expire_promotions
+from service import app
 
 
 class TestFlaskCLI(TestCase):
@@ -21,3 +23,38 @@ class TestFlaskCLI(TestCase):
         with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
             result = self.runner.invoke(db_create)
             self.assertEqual(result.exit_code, 0)
+
+    @patch('service.common.cli_commands.Promotion')
+    @patch('service.common.cli_commands.db')
+    def test_db_migrate(self, db_mock, promotion_mock):
+        """It should call the db-migrate command"""
+        with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
+            result = self.runner.invoke(db_migrate)
+            self.assertEqual(result.exit_code, 0)
+            db_mock.create_all.assert_called_once()
+            promotion_mock.add_missing_columns.assert_called_once()
+            promotion_mock.create_indexes.assert_called_once()
+
+    @patch('service.common.cli_commands.sweeper')
+    @patch('service.common.cli_commands.Promotion')
+    def test_expire_promotions(self, promotion_mock, sweeper_mock):
+        """It should call the expire-promotions command"""
+        sweeper_mock.sweep.return_value = [1, 2]
+        with app.app_context():
+            result = self.runner.invoke(expire_promotions, ["--batch-size", "5"])
+        self.assertEqual(result.exit_code, 0)
+        promotion_mock.prepare.assert_called_once()
+        sweeper_mock.sweep.assert_called_once_with(5)
+        self.assertIn("Deactivated 2 promotions", result.output)
+
+    @patch('service.common.cli_commands.Promotion')
+    def test_archive_promotions(self, promotion_mock):
+        """It should call the archive-promotions command"""
+        promotion_mock.archive_ended.return_value = [1, 2, 3]
+        with app.app_context():
+            result = self.runner.invoke(archive_promotions, ["--older-than-days", "30", "--batch-size", "5"])
+        self.assertEqual(result.exit_code, 0)
+        before, batch_size = promotion_mock.archive_ended.call_args.args
+        self.assertAlmostEqual((datetime.now(timezone.utc) - before).days, 30)
+        self.assertEqual(batch_size, 5)
+        self.assertIn("Archived 3 promotions", result.output)
@@ -0,0 +1,49 @@
+"""
+Test cases for the TimedQueuePool
+"""
+from unittest import TestCase
+from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from service.common.db_pool import TimedQueuePool, PoolStats, pool_stats
+
+
+class TestTimedQueuePool(TestCase):
+    """TimedQueuePool Tests"""
+
+    def setUp(self):
+        self.engine = create_engine("sqlite://", poolclass=TimedQueuePool,
+                                    pool_size=1, max_overflow=0, pool_timeout=0.01)
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test_records_checkouts(self):
+        """It should count every checkout and its wait time"""
+        before = pool_stats.stats()
+        with self.engine.connect():
+            pass
+        after = pool_stats.stats()
+        self.assertEqual(after["checkouts"], before["checkouts"] + 1)
+        self.assertGreaterEqual(after["wait_seconds_total"], before["wait_seconds_total"])
+
+    def test_records_timeouts(self):
+        """It should count checkouts that timed out waiting for a connection"""
+        before = pool_stats.stats()
+        with self.engine.connect():
+            self.assertRaises(PoolTimeoutError, self.engine.connect)
+        after = pool_stats.stats()
+        self.assertEqual(after["timeouts"], before["timeouts"] + 1)
+        self.assertGreaterEqual(after["wait_seconds_max"], 0.01)
+
+
+class TestPoolStats(TestCase):
+    """PoolStats Tests"""
+
+    def test_record(self):
+        """It should sum the wait time and keep the longest wait"""
+        stats = PoolStats()
+        stats.record(0.5)
+        stats.record(1.5, timed_out=True)
+        self.assertEqual(stats.stats(), {
+            "checkouts": 2, "timeouts": 1, "wait_seconds_total": 2.0, "wait_seconds_max": 1.5
+        })
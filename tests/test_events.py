@@ -0,0 +1,53 @@
+"""
+Test cases for the ChangeHub that wakes the change streams
+"""
+import asyncio
+import threading
+from unittest import TestCase
+from service.events import ChangeHub, StreamLimitError
+
+
+class TestChangeHub(TestCase):
+    """ChangeHub Tests"""
+
+    def test_wait_for_change(self):
+        """It should wake a waiting stream when a change is committed"""
+        hub = ChangeHub()
+        generation = hub.generation
+        timer = threading.Timer(0.05, hub.on_change, args=("create", [1]))
+        timer.start()
+        self.assertTrue(hub.wait(generation, timeout=5))
+        timer.join()
+        self.assertEqual(hub.generation, generation + 1)
+
+    def test_wait_times_out(self):
+        """It should stop waiting when no change arrives"""
+        hub = ChangeHub()
+        self.assertFalse(hub.wait(hub.generation, timeout=0.01))
+
+    def test_missed_change(self):
+        """It should return at once for a change made before the wait started"""
+        hub = ChangeHub()
+        generation = hub.generation
+        hub.on_change("reset", None)
+        self.assertTrue(hub.wait(generation, timeout=0))
+
+    def test_wait_async(self):
+        """It should wake a stream waiting on the event loop when a change is committed in a thread"""
+        hub = ChangeHub()
+        generation = hub.generation
+        timer = threading.Timer(0.05, hub.on_change, args=("create", [1]))
+        timer.start()
+        self.assertTrue(asyncio.run(hub.wait_async(generation, timeout=5)))
+        timer.join()
+        self.assertFalse(asyncio.run(hub.wait_async(hub.generation, timeout=0.01)))
+        self.assertTrue(asyncio.run(hub.wait_async(generation, timeout=0)))
+
+    def test_stream_limit(self):
+        """It should refuse streams beyond max_streams"""
+        hub = ChangeHub(max_streams=1)
+        hub.open()
+        self.assertRaises(StreamLimitError, hub.open)
+        hub.close()
+        hub.open()
+        self.assertEqual(hub.stats(), {"streams": 1, "max_streams": 1, "rejected": 1})
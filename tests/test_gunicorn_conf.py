@@ -0,0 +1,75 @@
+"""
+Test cases for the Gunicorn configuration
+
+Test cases can be run with:
+    nosetests
+    coverage report -m
+"""
+import logging
+import os
+import runpy
+import tempfile
+from types import SimpleNamespace
+from unittest import TestCase
+from unittest.mock import patch
+from service import app, snapshot
+from service.models import db
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "gunicorn.conf.py")
+
+
+def load_config(**env) -> dict:
+    """Loads gunicorn.conf.py with some environment variables set"""
+    with patch.dict(os.environ, env):
+        return runpy.run_path(CONFIG_PATH)
+
+
+######################################################################
+#  G U N I C O R N   C O N F I G   T E S T   C A S E S
+######################################################################
+class TestGunicornConf(TestCase):
+    """ Tests the settings and server hooks of gunicorn.conf.py """
+
+    def test_defaults(self):
+        """It should size the workers from the CPU cores and preload the app"""
+        config = load_config()
+        self.assertEqual(config["workers"], 2 * config["cpu_count"]() + 1)
+        self.assertEqual(config["worker_class"], "gthread")
+        self.assertEqual(config["wsgi_app"], "service:app")
+        self.assertTrue(config["preload_app"])
+        self.assertGreater(config["max_requests_jitter"], 0)
+
+    def test_environment_overrides(self):
+        """It should read its settings from the environment"""
+        config = load_config(GUNICORN_WORKERS="3", GUNICORN_WORKER_CLASS="uvicorn.workers.UvicornWorker",
+                             GUNICORN_PRELOAD="false", PORT="9000")
+        self.assertEqual(config["workers"], 3)
+        self.assertEqual(config["wsgi_app"], "service.asgi:app")
+        self.assertFalse(config["preload_app"])
+        self.assertEqual(config["bind"], "0.0.0.0:9000")
+
+    def test_post_fork(self):
+        """It should give a forked worker its own connection pool and snapshot"""
+        config = load_config()
+        with app.app_context():
+            pool = db.engine.pool
+        snapshot.store.get()
+        worker = SimpleNamespace(pid=os.getpid(), log=logging.getLogger("gunicorn.error"))
+        config["post_fork"](None, worker)
+        with app.app_context():
+            self.assertIsNot(db.engine.pool, pool)
+        self.assertIsNone(snapshot.store.peek())
+
+    def test_metric_files(self):
+        """It should clear old metric files and mark exited workers dead"""
+        config = load_config()
+        with tempfile.TemporaryDirectory() as directory:
+            stale = os.path.join(directory, "counter_123.db")
+            with open(stale, "w", encoding="utf-8"):
+                pass
+            with patch.dict(os.environ, {"PROMETHEUS_MULTIPROC_DIR": directory}):
+                config["on_starting"](None)
+                self.assertFalse(os.path.exists(stale))
+                with patch("prometheus_client.multiprocess.mark_process_dead") as mark_process_dead:
+                    config["child_exit"](None, SimpleNamespace(pid=123))
+        mark_process_dead.assert_called_once_with(123)
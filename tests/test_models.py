@@ -2,12 +2,17 @@
 Test cases for Promotion Model
 
 """
-from datetime import datetime
+from datetime import datetime, timezone
 import os
 import logging
+import tempfile
+import threading
 import unittest
+from unittest.mock import Mock, patch
+from sqlalchemy.orm.exc import StaleDataError
 from werkzeug.exceptions import NotFound
-from service.models import Promotion, DataValidationError, db
+from service.models import (Promotion, PromotionArchive, PromotionChange, DataValidationError, db, change_subscribers,
+                            record_change)
 from service import app
 from tests.factories import PromotionsFactory
 
@@ -19,6 +24,7 @@ DATABASE_URI = os.getenv(
 ######################################################################
 #  P R O M O T I O N   M O D E L   T E S T   C A S E S
 ######################################################################
+# pylint: disable=R0904
 class TestPromotion(unittest.TestCase):
     """ Test Cases for Promotion Model """
 
@@ -40,6 +46,9 @@ class TestPromotion(unittest.TestCase):
         """ This runs before each test """
         db.session.query(Promotion).delete()  # clean up the last tests
         db.session.commit()
+        Promotion.cache.clear()
+        Promotion.code_cache.clear()
+        Promotion.missing_code_cache.clear()
 
     def tearDown(self):
         """ This runs after each test """
@@ -92,6 +101,41 @@ class TestPromotion(unittest.TestCase):
         self.assertEqual(updated.amount, promotion.amount)
         self.assertEqual(updated.start_date, promotion.start_date)
 
+    def test_update_bumps_version(self):
+        """It should bump the version of a Promotion on every update"""
+        promotion = PromotionsFactory(amount=10, is_site_wide=False)
+        promotion.create()
+        self.assertEqual(promotion.version, 1)
+        promotion.amount = 1
+        promotion.update()
+        self.assertEqual(promotion.version, 2)
+        promotion.activate()
+        self.assertEqual(promotion.version, 3)
+
+    def test_update_stale_promotion(self):
+        """It should not update a Promotion that changed since it was read"""
+        if db.engine.dialect.name == "sqlite":
+            self.skipTest("pysqlite cannot report the rowcount needed to verify versions")
+        promotion = PromotionsFactory()
+        promotion.create()
+        self.assertEqual(promotion.version, 1)
+        with db.engine.begin() as connection:
+            connection.execute(db.text("UPDATE promotion SET version = version + 1 WHERE id = :id"),
+                               {"id": promotion.id})
+        promotion.amount = 1
+        self.assertRaises(StaleDataError, promotion.update)
+        db.session.rollback()
+
+    def test_add_missing_columns(self):
+        """It should add new columns to an existing promotion table"""
+        with db.engine.begin() as connection:
+            connection.execute(db.text("DROP INDEX IF EXISTS ix_promotion_title"))
+            connection.execute(db.text("ALTER TABLE promotion DROP COLUMN title"))
+        Promotion.add_missing_columns()
+        Promotion.create_indexes()
+        columns = {column["name"] for column in db.inspect(db.engine).get_columns("promotion")}
+        self.assertIn("title", columns)
+
     def test_serialize_a_promotion(self):
         """It should serialize a Promotion"""
         promotion = PromotionsFactory()
@@ -146,6 +190,15 @@ class TestPromotion(unittest.TestCase):
         promotion = Promotion()
         self.assertRaises(DataValidationError, promotion.deserialize, data)
 
+    def test_deserialize_invalid_values(self):
+        """It should not deserialize values the columns cannot hold"""
+        data = PromotionsFactory().serialize()
+        for name, value in (("promo_type", "BOGUS"), ("promo_type", ["BOGO"]), ("title", "x" * 64),
+                            ("promo_code", 5), ("amount", True), ("product_id", "abc"),
+                            ("is_site_wide", "yes"), ("start_date", "yesterday")):
+            self.assertRaises(DataValidationError, Promotion().deserialize, dict(data, **{name: value}))
+        self.assertEqual(Promotion().deserialize(dict(data, amount="15", promo_code=None)).amount, 15)
+
     def test_find_or_404_found(self):
         """It should Find or return 404 not found"""
         promotions = PromotionsFactory.create_batch(3)
@@ -208,6 +261,51 @@ class TestPromotion(unittest.TestCase):
         self.assertEqual(found[0].amount, promotions[0].amount)
         self.assertEqual(found[0].product_id, promotions[0].product_id)
 
+    def test_lookup_code(self):
+        """It should look up a promo code exactly or ignoring case"""
+        promotion = PromotionsFactory(promo_code="SAVE10")
+        promotion.create()
+        PromotionsFactory(promo_code="OTHER").create()
+        rows = Promotion.lookup_code("SAVE10")
+        self.assertEqual([row.id for row in rows], [promotion.id])
+        self.assertEqual(rows[0].version, 1)
+        self.assertEqual(Promotion.lookup_code("save10"), ())
+        self.assertEqual([row.id for row in Promotion.lookup_code("save10", ignore_case=True)], [promotion.id])
+
+    def test_lookup_code_caches(self):
+        """It should cache found and unknown codes until a change"""
+        promotion = PromotionsFactory(promo_code="SAVE10")
+        promotion.create()
+        Promotion.lookup_code("SAVE10")
+        Promotion.lookup_code("NOPE")
+        Promotion.lookup_code("SAVE10")
+        Promotion.lookup_code("NOPE")
+        self.assertEqual(Promotion.code_cache.stats()["hits"], 1)
+        self.assertEqual(Promotion.missing_code_cache.stats()["hits"], 1)
+
+        # a new Promotion with the unknown code is found right away
+        PromotionsFactory(promo_code="NOPE").create()
+        self.assertEqual(len(Promotion.lookup_code("NOPE")), 1)
+        promotion.delete()
+        self.assertEqual(Promotion.lookup_code("SAVE10"), ())
+
+    def test_find_many(self):
+        """It should find several Promotions in one query, using and filling the cache"""
+        first, second = PromotionsFactory(), PromotionsFactory()
+        first.create()
+        second.create()
+        title = second.title
+        Promotion.find(first.id)
+        db.session.expunge_all()
+        hits = Promotion.cache.stats()["hits"]
+        found = Promotion.find_many([second.id, first.id, 0])
+        self.assertEqual(sorted(found), sorted([first.id, second.id]))
+        self.assertEqual(found[second.id].title, title)
+        self.assertEqual(Promotion.cache.stats()["hits"], hits + 1)
+        db.session.expunge_all()
+        Promotion.find_many([second.id])
+        self.assertEqual(Promotion.cache.stats()["hits"], hits + 2)
+
     def test_find_by_type(self):
         """It should Find a Promotions by Promotion type"""
         promotions = PromotionsFactory.create_batch(5)
@@ -219,3 +317,260 @@ class TestPromotion(unittest.TestCase):
         self.assertEqual(found.count(), count)
         for promo in found:
             self.assertEqual(promo.promo_type, promo_type)
+
+    def test_stream_all(self):
+        """It should stream all Promotions in id order"""
+        promotions = PromotionsFactory.create_batch(5)
+        for promotion in promotions:
+            promotion.create()
+        streamed = list(Promotion.stream_all(batch_size=2))
+        self.assertEqual([promo.id for promo in streamed], [promo.id for promo in promotions])
+
+    def test_paginate_columns(self):
+        """It should page through rows of selected columns"""
+        promotions = PromotionsFactory.create_batch(3)
+        for promotion in promotions:
+            promotion.create()
+        rows = Promotion.paginate(1, promotions[0].id, columns=[Promotion.id, Promotion.title])
+        self.assertEqual([tuple(row) for row in rows],
+                         [(promo.id, promo.title) for promo in promotions[1:]])
+
+    def test_record_columns(self):
+        """It should select id and version ahead of the named columns"""
+        columns = Promotion.record_columns(["amount", "id"])
+        self.assertEqual([column.key for column in columns], ["id", "version", "amount"])
+
+    def test_create_many(self):
+        """It should create many Promotions in chunks"""
+        promotions = PromotionsFactory.create_batch(5)
+        ids = Promotion.create_many(promotions, chunk_size=2)
+        self.assertEqual(len(ids), 5)
+        self.assertEqual(len(Promotion.all()), 5)
+        self.assertEqual(Promotion.find(ids[3]).title, promotions[3].title)
+
+    def test_update_many(self):
+        """It should update many Promotions and report which ones exist"""
+        promotions = PromotionsFactory.create_batch(3)
+        ids = Promotion.create_many(promotions, chunk_size=2)
+        changes = []
+        for promotion_id in ids[:2] + [0]:
+            change = PromotionsFactory(amount=4242)
+            change.id = promotion_id
+            changes.append(change)
+        updated = Promotion.update_many(changes, chunk_size=2)
+        self.assertEqual(updated, set(ids[:2]))
+        db.session.expire_all()
+        self.assertEqual(Promotion.find(ids[0]).amount, 4242)
+        self.assertEqual(Promotion.find(ids[0]).version, 2)
+        self.assertEqual(Promotion.find(ids[1]).amount, 4242)
+        self.assertNotEqual(Promotion.find(ids[2]).amount, 4242)
+
+    def test_delete_many(self):
+        """It should delete many Promotions and report which ones existed"""
+        promotions = PromotionsFactory.create_batch(3)
+        ids = Promotion.create_many(promotions, chunk_size=2)
+        deleted = Promotion.delete_many([ids[0], ids[2], 0], chunk_size=2)
+        self.assertEqual(deleted, {ids[0], ids[2]})
+        self.assertEqual([promo.id for promo in Promotion.all()], [ids[1]])
+
+    def test_find_by_filters(self):
+        """It should Find Promotions matching several filters at once"""
+        promotions = PromotionsFactory.create_batch(10)
+        for promotion in promotions:
+            promotion.create()
+        promo_type = promotions[0].promo_type
+        is_site_wide = promotions[0].is_site_wide
+        count = len([promo for promo in promotions
+                     if promo.promo_type == promo_type and promo.is_site_wide == is_site_wide])
+        found = Promotion.find_by_filters(promo_type=promo_type, is_site_wide=is_site_wide, title=None)
+        self.assertEqual(found.count(), count)
+        for promo in found:
+            self.assertEqual(promo.promo_type, promo_type)
+            self.assertEqual(promo.is_site_wide, is_site_wide)
+
+    def test_find_by_unknown_filter(self):
+        """It should not Find Promotions by a column that cannot be filtered"""
+        self.assertRaises(DataValidationError, Promotion.find_by_filters, amount=10)
+
+    def test_create_indexes(self):
+        """It should create the promotion indexes on an existing table"""
+        index = Promotion.__table__.indexes.copy().pop()
+        index.drop(bind=db.engine)
+        Promotion.create_indexes()
+        names = {idx["name"] for idx in db.inspect(db.engine).get_indexes("promotion")}
+        # not every backend reflects expression indexes, so only column indexes are compared
+        expected = {idx.name for idx in Promotion.__table__.indexes
+                    if all(isinstance(expr, db.Column) for expr in idx.expressions)}
+        self.assertTrue(expected <= names)
+        Promotion.create_indexes()
+
+    def test_find_active(self):
+        """It should Find the Promotions active for a product at a given time"""
+        start = datetime(2023, 6, 1, tzinfo=timezone.utc)
+        end = datetime(2023, 6, 30, tzinfo=timezone.utc)
+        product = PromotionsFactory(product_id=7, is_site_wide=False, start_date=start, end_date=end)
+        site_wide = PromotionsFactory(product_id=99, is_site_wide=True, start_date=start, end_date=end)
+        other_product = PromotionsFactory(product_id=8, is_site_wide=False, start_date=start, end_date=end)
+        expired = PromotionsFactory(product_id=7, is_site_wide=False, start_date=start,
+                                    end_date=datetime(2023, 6, 10, tzinfo=timezone.utc))
+        for promotion in (product, site_wide, other_product, expired):
+            promotion.create()
+
+        found = Promotion.find_active(7, datetime(2023, 6, 15, tzinfo=timezone.utc))
+        self.assertEqual([promo.id for promo in found], [product.id, site_wide.id])
+        found = Promotion.find_active(7, datetime(2023, 7, 15))
+        self.assertEqual(found.count(), 0)
+        found = Promotion.find_active_for_products([7, 8], datetime(2023, 6, 15, tzinfo=timezone.utc))
+        self.assertEqual([promo.id for promo in found], [product.id, site_wide.id, other_product.id])
+
+    def test_find_is_cached(self):
+        """It should serve repeated finds from the cache"""
+        promotion = PromotionsFactory()
+        promotion.create()
+        promo_id = promotion.id
+        Promotion.find(promo_id)
+        db.session.remove()
+        hits = Promotion.cache.stats()["hits"]
+
+        found = Promotion.find(promo_id)
+        self.assertEqual(Promotion.cache.stats()["hits"], hits + 1)
+        self.assertEqual(found.title, promotion.title)
+        self.assertEqual(found.start_date, promotion.start_date.replace(tzinfo=None))
+
+        # the cached copy is attached to the session and can be saved
+        found.amount = 4242
+        found.update()
+        db.session.remove()
+        self.assertEqual(Promotion.find(promo_id).amount, 4242)
+
+    def test_find_cache_is_invalidated(self):
+        """It should drop cached Promotions when they change"""
+        promotion = PromotionsFactory(is_site_wide=False)
+        promotion.create()
+        promo_id = promotion.id
+        Promotion.find(promo_id)
+        self.assertEqual(Promotion.cache.stats()["size"], 1)
+        promotion.activate()
+        self.assertEqual(Promotion.cache.stats()["size"], 0)
+        db.session.remove()
+        self.assertTrue(Promotion.find(promo_id).is_site_wide)
+        Promotion.find(promo_id).delete()
+        db.session.remove()
+        self.assertIsNone(Promotion.find(promo_id))
+
+    def test_find_invalid_id(self):
+        """It should not find a Promotion with a non-numeric id"""
+        self.assertIsNone(Promotion.find("abc"))
+
+    def test_change_subscribers(self):
+        """It should tell subscribers about committed changes only"""
+        changes = []
+        change_subscribers.append(lambda action, ids: changes.append((action, ids)))
+        try:
+            promotion = PromotionsFactory()
+            promotion.create()
+            promotion.amount = 1
+            record_change("update", [promotion.id])
+            db.session.rollback()
+            promotion.deactivate()
+        finally:
+            change_subscribers.pop()
+        self.assertEqual(changes, [("create", [promotion.id]), ("deactivate", [promotion.id])])
+
+    def test_archive_ended(self):
+        """It should move ended Promotions to the archive in batches and still find them"""
+        now = datetime(2025, 1, 1)
+        old = [PromotionsFactory(end_date=datetime(2024, month, 1)) for month in (1, 2, 3)]
+        for promotion in old:
+            promotion.create()
+        current = PromotionsFactory(end_date=datetime(2025, 6, 1))
+        current.create()
+        ids = [promotion.id for promotion in old]
+        titles = {promotion.id: promotion.title for promotion in old}
+        since = PromotionChange.last_seq()
+        self.assertEqual(sorted(Promotion.archive_ended(now, batch_size=2)), sorted(ids))
+        self.assertEqual(Promotion.archive_ended(now, batch_size=2), [])
+        self.assertEqual(len(Promotion.all()), 1)
+        self.assertEqual(db.session.get(PromotionArchive, ids[0]).title, titles[ids[0]])
+        self.assertEqual([change.action for change, _ in PromotionChange.since(since, limit=10)], ["archive"] * 3)
+
+        # readers still get the archived Promotions, writers do not
+        db.session.remove()
+        Promotion.cache.clear()
+        self.assertEqual(Promotion.find(ids[0]).title, titles[ids[0]])
+        self.assertIsNone(Promotion.find(ids[0], use_cache=False))
+        found = Promotion.find_many([ids[1], ids[2], 0])
+        self.assertEqual(sorted(found), sorted(ids[1:]))
+        self.assertEqual(found[ids[2]].title, titles[ids[2]])
+        self.assertIsNone(PromotionArchive.find(0))
+
+    def test_change_log(self):
+        """It should log committed changes in order and leave out rolled back ones"""
+        since = PromotionChange.last_seq()
+        promotion = PromotionsFactory()
+        promotion.create()
+        promo_id = promotion.id
+        record_change("update", [promo_id])
+        db.session.rollback()
+        promotion = Promotion.find(promo_id, use_cache=False)
+        promotion.activate()
+        Promotion.delete_many([promo_id], chunk_size=10)
+        rows = PromotionChange.since(since, limit=10)
+        self.assertEqual([(change.action, change.promotion_id) for change, _ in rows],
+                         [("create", promo_id), ("activate", promo_id), ("delete", promo_id)])
+        self.assertEqual([change.seq for change, _ in rows], sorted(change.seq for change, _ in rows))
+        self.assertEqual(PromotionChange.last_seq(), rows[-1][0].seq)
+        self.assertIsNone(rows[0][1])  # the Promotion is gone
+        self.assertEqual(len(PromotionChange.since(since, limit=1)), 2)
+
+    def test_switch_database(self):
+        """It should move the engine to the database the config names when bound again"""
+        promotion = PromotionsFactory()
+        promotion.create()
+        promo_id = promotion.id
+        with tempfile.TemporaryDirectory() as folder:
+            app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{folder}/other.db"
+            try:
+                Promotion.bind(app)
+                Promotion.prepare()
+                self.assertEqual(db.engine.url.database, f"{folder}/other.db")
+                self.assertEqual(Promotion.all(), [])
+            finally:
+                db.session.remove()
+                app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+                Promotion.bind(app)
+                Promotion.prepare()
+        self.assertEqual([found.id for found in Promotion.all()], [promo_id])
+
+    def test_change_log_commit_order(self):
+        """It should commit the changes of concurrent transactions in seq order"""
+        since = PromotionChange.last_seq()
+        paused, resume = threading.Event(), threading.Event()
+
+        def publish(session, changes):  # pylint: disable=unused-argument
+            if threading.current_thread().name == "first":
+                paused.set()
+                resume.wait(5)
+
+        def commit_change(promotion_id):
+            with app.app_context():
+                record_change("update", [promotion_id])
+                db.session.commit()
+                db.session.remove()
+
+        first = threading.Thread(target=commit_change, args=(1,), name="first")
+        second = threading.Thread(target=commit_change, args=(2,), name="second")
+        with patch.object(Promotion, "notifier", Mock(publish=publish)):
+            first.start()
+            self.assertTrue(paused.wait(5))
+            second.start()
+            second.join(0.3)
+            # the second transaction waits for the first one to commit its change
+            self.assertTrue(second.is_alive())
+            self.assertEqual(PromotionChange.since(since, limit=10), [])
+            db.session.remove()
+            resume.set()
+            first.join(5)
+            second.join(5)
+        rows = PromotionChange.since(since, limit=10)
+        self.assertEqual([change.promotion_id for change, _ in rows], [1, 2])
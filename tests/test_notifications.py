@@ -0,0 +1,43 @@
+"""
+Test cases for the LISTEN/NOTIFY ChangeNotifier
+"""
+import json
+from unittest import TestCase
+from unittest.mock import MagicMock
+from service.common.notifications import ChangeNotifier, origin, MAX_PAYLOAD_SIZE
+
+
+class TestChangeNotifier(TestCase):
+    """ChangeNotifier Tests"""
+
+    def test_publish(self):
+        """It should NOTIFY each change on the channel"""
+        session = MagicMock()
+        notifier = ChangeNotifier("promotion_changes", MagicMock())
+        notifier.publish(session, [("create", [1, 2]), ("delete", [3])])
+        self.assertEqual(session.execute.call_count, 2)
+        params = session.execute.call_args_list[0].args[1]
+        self.assertEqual(params["channel"], "promotion_changes")
+        self.assertEqual(json.loads(params["payload"]), {"origin": origin(), "action": "create", "ids": [1, 2]})
+
+    def test_publish_oversized_batch(self):
+        """It should drop the ids of a batch too large for one NOTIFY"""
+        session = MagicMock()
+        notifier = ChangeNotifier("promotion_changes", MagicMock())
+        notifier.publish(session, [("update", list(range(MAX_PAYLOAD_SIZE)))])
+        params = session.execute.call_args.args[1]
+        self.assertIsNone(json.loads(params["payload"])["ids"])
+
+    def test_handle_remote_change(self):
+        """It should relay changes made by other processes"""
+        callback = MagicMock()
+        notifier = ChangeNotifier("promotion_changes", callback)
+        notifier._handle(json.dumps({"origin": "otherhost:1", "action": "update", "ids": [4]}))  # pylint: disable=W0212
+        callback.assert_called_once_with("update", [4])
+
+    def test_ignore_own_change(self):
+        """It should ignore changes this process already dispatched"""
+        callback = MagicMock()
+        notifier = ChangeNotifier("promotion_changes", callback)
+        notifier._handle(json.dumps({"origin": origin(), "action": "update", "ids": [4]}))  # pylint: disable=W0212
+        callback.assert_not_called()
@@ -0,0 +1,97 @@
+"""
+Test cases for the Pricing Engine
+
+Test cases can be run with:
+    nosetests
+    coverage report -m
+"""
+from decimal import Decimal
+from unittest import TestCase
+from service.models import DataValidationError, PromoType
+from service.pricing import evaluate_cart, line_savings, parse_lines
+from tests.factories import PromotionsFactory
+
+
+def make_promotion(promotion_id, promo_type, amount, product_id=1, is_site_wide=False):
+    """Builds an unsaved Promotion for the pricing engine"""
+    return PromotionsFactory(id=promotion_id, promo_type=promo_type, amount=amount,
+                             product_id=product_id, is_site_wide=is_site_wide)
+
+
+######################################################################
+#  P R I C I N G   T E S T   C A S E S
+######################################################################
+class TestPricing(TestCase):
+    """ Tests the Pricing Engine """
+
+    def test_line_savings(self):
+        """It should compute what each type of Promotion takes off a line"""
+        price = Decimal("9.99")
+        self.assertEqual(line_savings(PromoType.BOGO, 0, 5, price), Decimal("19.98"))
+        self.assertEqual(line_savings(PromoType.DISCOUNT, 10, 3, price), Decimal("2.997"))
+        self.assertEqual(line_savings(PromoType.DISCOUNT, 150, 1, price), price)
+        self.assertEqual(line_savings(PromoType.FIXED, 5, 2, price), Decimal(5))
+        self.assertEqual(line_savings(PromoType.FIXED, 50, 2, price), Decimal("19.98"))
+
+    def test_parse_lines(self):
+        """It should validate the lines of a cart"""
+        lines = parse_lines([{"product_id": 1, "quantity": 2, "unit_price": 2.5},
+                             {"product_id": 2, "quantity": 1, "unit_price": "0.10"}])
+        self.assertEqual(lines, [(1, 2, Decimal("2.5")), (2, 1, Decimal("0.10"))])
+        bad_carts = [
+            None, [],
+            [{"product_id": 1, "quantity": 1}],
+            [{"product_id": "1", "quantity": 1, "unit_price": 1}],
+            [{"product_id": 1, "quantity": 0, "unit_price": 1}],
+            [{"product_id": 1, "quantity": True, "unit_price": 1}],
+            [{"product_id": 1, "quantity": 1, "unit_price": "-1"}],
+            [{"product_id": 1, "quantity": 1, "unit_price": "NaN"}],
+            [{"product_id": 1, "quantity": 1, "unit_price": "abc"}],
+            ["not a line"],
+        ]
+        for cart in bad_carts:
+            self.assertRaises(DataValidationError, parse_lines, cart)
+
+    def test_best_promotion_per_line(self):
+        """It should apply the Promotion that saves the most on each line"""
+        promotions = [
+            make_promotion(1, PromoType.DISCOUNT, 10, product_id=1),
+            make_promotion(2, PromoType.BOGO, 0, product_id=1),
+            make_promotion(3, PromoType.FIXED, 3, product_id=2),
+            make_promotion(4, PromoType.DISCOUNT, 20, product_id=99, is_site_wide=True),
+        ]
+        lines = [(1, 2, Decimal("10.00")), (2, 1, Decimal("10.00")), (3, 1, Decimal("4.00"))]
+        result = evaluate_cart(lines, promotions)
+        self.assertEqual([line["promotion"].id for line in result["lines"]], [2, 3, 4])
+        self.assertEqual([line["discount"] for line in result["lines"]],
+                         [Decimal("10.00"), Decimal("3.00"), Decimal("0.80")])
+        self.assertEqual(result["subtotal"], Decimal("34.00"))
+        self.assertEqual(result["discount"], Decimal("13.80"))
+        self.assertEqual(result["total"], Decimal("20.20"))
+        self.assertIsNone(result["cart_promotion"])
+
+    def test_no_promotion_for_line(self):
+        """It should leave a line without a matching Promotion at full price"""
+        result = evaluate_cart([(5, 3, Decimal("1.50"))], [make_promotion(1, PromoType.BOGO, 0, product_id=6)])
+        line = result["lines"][0]
+        self.assertIsNone(line["promotion"])
+        self.assertEqual(line["total"], Decimal("4.50"))
+
+    def test_tie_goes_to_lowest_id(self):
+        """It should pick the lowest id among Promotions that save the same"""
+        promotions = [make_promotion(8, PromoType.FIXED, 2), make_promotion(5, PromoType.FIXED, 2)]
+        result = evaluate_cart([(1, 1, Decimal("10"))], promotions)
+        self.assertEqual(result["lines"][0]["promotion"].id, 5)
+
+    def test_site_wide_fixed_applies_to_cart(self):
+        """It should take the best site-wide FIXED Promotion off the cart total once"""
+        promotions = [
+            make_promotion(1, PromoType.FIXED, 5, is_site_wide=True),
+            make_promotion(2, PromoType.FIXED, 8, is_site_wide=True),
+        ]
+        result = evaluate_cart([(1, 1, Decimal("3.00")), (2, 2, Decimal("1.00"))], promotions)
+        self.assertTrue(all(line["promotion"] is None for line in result["lines"]))
+        self.assertEqual(result["cart_promotion"]["promotion"].id, 2)
+        # never more than the cart costs
+        self.assertEqual(result["cart_promotion"]["discount"], Decimal("5.00"))
+        self.assertEqual(result["total"], Decimal("0.00"))
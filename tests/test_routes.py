@@ -5,13 +5,29 @@ Test cases can be run with the following:
   nosetests -v --with-spec --spec-color
   coverage report -m
 """
+import csv
+import gzip
+import io
+import json
 import os
 import logging
+import threading
+from datetime import datetime, timedelta, timezone
 from unittest import TestCase
+from unittest.mock import patch
 from urllib.parse import quote_plus
+import brotli
+import zstandard
+from flask import g
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm.exc import StaleDataError
+from flask_restx import marshal
 from service import app
 from service.common import status  # HTTP Status Codes
-from service.models import Promotion, db, init_db
+from service.events import hub
+from service.models import Promotion, PromotionChange, PromoType, db, init_db
+from service.routes import promotion_model
 from tests.factories import PromotionsFactory  # HTTP Status Codes
 
 DATABASE_URI = os.getenv(
@@ -50,6 +66,8 @@ class TestPromotionServer(TestCase):
         self.client = app.test_client()
         db.session.query(Promotion).delete()  # clean up the last tests
         db.session.commit()
+        # the bulk delete records no change, so reset the caches and the snapshot like one would
+        Promotion.dispatch_changes("delete", None)
 
     def tearDown(self):
         """ This runs after each test """
@@ -107,6 +125,295 @@ class TestPromotionServer(TestCase):
         self.assertEqual(data1[0]['id'], test_promo0.id)
         self.assertEqual(data1[1]['id'], test_promo1.id)
 
+    def test_get_promotions_paginated(self):
+        """It should page through the promotions with a cursor"""
+        promotions = self._create_promotions(5)
+
+        resp = self.client.get(BASE_URL, query_string="limit=2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([promo["id"] for promo in data], [promo.id for promo in promotions[:2]])
+        self.assertIn('rel="next"', resp.headers["Link"])
+        cursor = resp.headers["X-Next-Cursor"]
+
+        resp = self.client.get(BASE_URL, query_string={"limit": 2, "cursor": cursor})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([promo["id"] for promo in data], [promo.id for promo in promotions[2:4]])
+        cursor = resp.headers["X-Next-Cursor"]
+
+        resp = self.client.get(BASE_URL, query_string={"limit": 2, "cursor": cursor})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([promo["id"] for promo in data], [promotions[4].id])
+        self.assertNotIn("Link", resp.headers)
+        self.assertNotIn("X-Next-Cursor", resp.headers)
+
+    def test_get_promotions_page_size_is_capped(self):
+        """It should not return more promotions than the maximum page size"""
+        self._create_promotions(3)
+        max_page_size = app.config["MAX_PAGE_SIZE"]
+        app.config["MAX_PAGE_SIZE"] = 2
+        try:
+            resp = self.client.get(BASE_URL, query_string="limit=50")
+        finally:
+            app.config["MAX_PAGE_SIZE"] = max_page_size
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 2)
+        self.assertIn("X-Next-Cursor", resp.headers)
+
+    def test_get_promotions_by_ids(self):
+        """It should fetch several promotions in the requested order and report the missing ids"""
+        promotions = self._create_promotions(3)
+        ids = [promotions[2].id, 0, promotions[0].id, promotions[2].id]
+        self.client.get(f"{BASE_URL}/{promotions[0].id}")  # cached
+        resp = self.client.get(BASE_URL, query_string={"ids": ",".join(map(str, ids)), "fields": "id,title"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), [{"id": str(promotions[2].id), "title": promotions[2].title},
+                                           {"id": str(promotions[0].id), "title": promotions[0].title}])
+        self.assertEqual(resp.headers["X-Missing-Ids"], "0")
+        resp = self.client.get(BASE_URL, query_string={"ids": ",".join(map(str, ids)), "fields": "id,title"},
+                               headers={"If-None-Match": resp.headers["ETag"]})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_get_archived_promotion(self):
+        """It should read an archived Promotion but not change it"""
+        promotion = self._create_promotions(1)[0]
+        Promotion.archive_ended(datetime.now(timezone.utc), batch_size=10)
+        Promotion.dispatch_changes("archive", None)
+        resp = self.client.get(f"{BASE_URL}/{promotion.id}")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["title"], promotion.title)
+        resp = self.client.get(BASE_URL, query_string={"ids": promotion.id})
+        self.assertEqual(len(resp.get_json()), 1)
+        resp = self.client.put(f"{BASE_URL}/{promotion.id}/activate")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.get(BASE_URL).get_json(), [])
+
+    def test_delete_archived_promotion(self):
+        """It should delete archived Promotions from the archive"""
+        promotions = self._create_promotions(2)
+        Promotion.archive_ended(datetime.now(timezone.utc), batch_size=10)
+        since = PromotionChange.last_seq()
+        resp = self.client.delete(f"{BASE_URL}/{promotions[0].id}")
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.client.get(f"{BASE_URL}/{promotions[0].id}").status_code, status.HTTP_404_NOT_FOUND)
+        operations = [{"op": "delete", "id": int(promotions[1].id)}]
+        resp = self.client.post(f"{BASE_URL}/batch", json={"operations": operations})
+        self.assertEqual(resp.get_json()["results"][0]["status"], status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.client.get(f"{BASE_URL}/{promotions[1].id}").status_code, status.HTTP_404_NOT_FOUND)
+        changes = PromotionChange.since(since, limit=10)
+        self.assertEqual([(change.action, change.promotion_id) for change, _ in changes],
+                         [("delete", int(promotion.id)) for promotion in promotions])
+
+    def test_get_promotions_by_ids_invalid(self):
+        """It should not fetch malformed, mixed or too many ids"""
+        for query in ("ids=1,x", "ids=,", "ids=1&title=x", "ids=1&limit=2"):
+            resp = self.client.get(BASE_URL, query_string=query)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, query)
+        max_ids = app.config["BATCH_GET_MAX_IDS"]
+        app.config["BATCH_GET_MAX_IDS"] = 2
+        try:
+            resp = self.client.get(BASE_URL, query_string="ids=1,2,3")
+        finally:
+            app.config["BATCH_GET_MAX_IDS"] = max_ids
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_promotion_changes(self):
+        """It should return the changes after a seq with the current state of each Promotion"""
+        since = self.client.get(f"{BASE_URL}/changes").get_json()["high_water_mark"]
+        first, second = self._create_promotions(2)  # pylint: disable=unbalanced-tuple-unpacking
+        self.client.put(f"{BASE_URL}/{first.id}/activate")
+        self.client.delete(f"{BASE_URL}/{second.id}")
+        resp = self.client.get(f"{BASE_URL}/changes", query_string={"since": since, "limit": 3})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([(change["action"], change["promotion_id"]) for change in data["changes"]],
+                         [("create", first.id), ("create", second.id), ("activate", first.id)])
+        self.assertTrue(data["changes"][0]["promotion"]["is_site_wide"])
+        self.assertIsNone(data["changes"][1]["promotion"])
+        self.assertTrue(data["has_more"])
+        self.assertEqual(data["next_since"], data["changes"][-1]["seq"])
+        resp = self.client.get(f"{BASE_URL}/changes", query_string={"since": data["next_since"]})
+        data = resp.get_json()
+        self.assertEqual([change["action"] for change in data["changes"]], ["delete"])
+        self.assertFalse(data["has_more"])
+        self.assertEqual(data["next_since"], data["high_water_mark"])
+        resp = self.client.get(f"{BASE_URL}/changes", query_string="since=-1")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def _stream_changes(self, duration, **kwargs):
+        """Reads a change stream that ends after duration seconds and returns its events"""
+        settings = {name: app.config[name] for name in ("EVENTS_MAX_DURATION", "EVENTS_HEARTBEAT")}
+        app.config.update(EVENTS_MAX_DURATION=duration, EVENTS_HEARTBEAT=duration / 2)
+        try:
+            resp = self.client.get(f"{BASE_URL}/changes/stream", **kwargs)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(resp.mimetype, "text/event-stream")
+            body = resp.get_data(as_text=True)
+            resp.close()
+        finally:
+            app.config.update(settings)
+        self.assertTrue(body.startswith("retry: "))
+        events = [dict(line.split(": ", 1) for line in block.split("\n"))
+                  for block in body.split("\n\n") if block.startswith("id: ")]
+        return events, body
+
+    def test_stream_promotion_changes(self):
+        """It should stream the changes after since and resume after Last-Event-ID"""
+        since = self.client.get(f"{BASE_URL}/changes").get_json()["high_water_mark"]
+        first, second = self._create_promotions(2)  # pylint: disable=unbalanced-tuple-unpacking
+        events, body = self._stream_changes(0.05, query_string={"since": since},
+                                            headers={"Accept-Encoding": "gzip"})
+        self.assertEqual([(event["event"], json.loads(event["data"])["promotion_id"]) for event in events],
+                         [("create", first.id), ("create", second.id)])
+        self.assertIn(": keep-alive", body)
+        events, _ = self._stream_changes(0.05, query_string={"since": since}, headers={"Last-Event-ID": events[0]["id"]})
+        self.assertEqual([event["event"] for event in events], ["create"])
+        self.assertEqual(json.loads(events[0]["data"])["promotion"]["title"], second.title)
+
+    def test_stream_pushes_new_changes(self):
+        """It should push a change as soon as it is committed"""
+        self._create_promotions(1)
+        promotion = PromotionsFactory()
+        writer = threading.Timer(0.2, lambda: app.test_client().post(BASE_URL, json=promotion.serialize()))
+        writer.start()
+        try:
+            events, _ = self._stream_changes(1.5)
+        finally:
+            writer.join()
+        self.assertEqual(len(events), 1)
+        self.assertEqual(json.loads(events[0]["data"])["promotion"]["title"], promotion.title)
+
+    def test_stream_limit(self):
+        """It should answer 503 once a worker serves as many streams as it may"""
+        max_streams = app.config["EVENTS_MAX_STREAMS"]
+        with patch.object(hub, "max_streams", 0):
+            resp = self.client.get(f"{BASE_URL}/changes/stream")
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(self.client.get("/stats").get_json()["events"]["max_streams"], max_streams)
+
+    def test_export_promotions_ndjson(self):
+        """It should stream all promotions as NDJSON"""
+        promotions = self._create_promotions(3)
+        resp = self.client.get(f"{BASE_URL}/export")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        lines = resp.get_data(as_text=True).splitlines()
+        self.assertEqual(len(lines), 3)
+        data = [json.loads(line) for line in lines]
+        self.assertEqual([promo["id"] for promo in data], [int(promo.id) for promo in promotions])
+        self.assertEqual(data[0]["title"], promotions[0].title)
+
+    def test_export_promotions_csv(self):
+        """It should stream all promotions as CSV"""
+        promotions = self._create_promotions(2)
+        resp = self.client.get(f"{BASE_URL}/export", query_string="format=csv")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "text/csv")
+        rows = list(csv.DictReader(io.StringIO(resp.get_data(as_text=True))))
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[1]["id"], str(promotions[1].id))
+        self.assertEqual(rows[1]["promo_code"], promotions[1].promo_code)
+
+    def test_export_promotions_bad_format(self):
+        """It should not export promotions in an unknown format"""
+        resp = self.client.get(f"{BASE_URL}/export", query_string="format=xml")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_batch_promotions(self):
+        """It should create, update and delete promotions in one batch"""
+        existing = self._create_promotions(2)
+        new_promotion = PromotionsFactory().serialize()
+        changed = existing[0].serialize()
+        changed["title"] = "batch updated"
+        operations = [
+            {"op": "create", "data": new_promotion},
+            {"op": "update", "id": int(existing[0].id), "data": changed},
+            {"op": "delete", "id": int(existing[1].id)},
+            {"op": "delete", "id": 987654321},
+            {"op": "create", "data": {"title": "missing fields"}},
+            {"op": "rename"},
+        ]
+        resp = self.client.post(f"{BASE_URL}/batch", json={"operations": operations})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        results = resp.get_json()["results"]
+        self.assertEqual([result["status"] for result in results], [
+            status.HTTP_201_CREATED, status.HTTP_200_OK, status.HTTP_204_NO_CONTENT,
+            status.HTTP_404_NOT_FOUND, status.HTTP_400_BAD_REQUEST, status.HTTP_400_BAD_REQUEST
+        ])
+
+        created = self.client.get(f"{BASE_URL}/{results[0]['id']}").get_json()
+        self.assertEqual(created["title"], new_promotion["title"])
+        updated = self.client.get(f"{BASE_URL}/{existing[0].id}").get_json()
+        self.assertEqual(updated["title"], "batch updated")
+        resp = self.client.get(f"{BASE_URL}/{existing[1].id}")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_batch_promotions_not_a_list(self):
+        """It should not apply a batch without a list of operations"""
+        resp = self.client.post(f"{BASE_URL}/batch", json={"operations": "create"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_batch_promotions_invalid_items(self):
+        """It should reject the invalid items of a batch before writing and apply the rest"""
+        existing = self._create_promotions(1)[0]
+        valid = PromotionsFactory().serialize()
+        operations = [
+            {"op": "create", "data": dict(valid, promo_type="BOGUS")},
+            {"op": "create", "data": dict(valid, title="x" * 64)},
+            {"op": "create", "data": dict(valid, amount="ten")},
+            {"op": "update", "id": True, "data": valid},
+            {"op": "delete", "id": True},
+            {"op": "create", "data": valid},
+        ]
+        resp = self.client.post(f"{BASE_URL}/batch", json={"operations": operations})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        codes = [result["status"] for result in resp.get_json()["results"]]
+        self.assertEqual(codes, [status.HTTP_400_BAD_REQUEST] * 5 + [status.HTTP_201_CREATED])
+        self.assertEqual(self.client.get(f"{BASE_URL}/{existing.id}").get_json()["title"], existing.title)
+        cart = {"lines": [{"product_id": valid["product_id"], "quantity": 1, "unit_price": 10}]}
+        self.assertEqual(self.client.post(f"{BASE_URL}/evaluate", json=cart).status_code, status.HTTP_200_OK)
+
+    def test_batch_promotions_not_an_object(self):
+        """It should not apply a batch whose body is not an object"""
+        resp = self.client.post(f"{BASE_URL}/batch", json=[1, 2])
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_batch_promotions_failed_chunk(self):
+        """It should roll back a chunk the database rejects and still write the other chunks"""
+        create_many = Promotion.create_many
+        calls = []
+
+        def fail_second_chunk(promotions, chunk_size):
+            calls.append(len(promotions))
+            if len(calls) == 2:
+                raise OperationalError("INSERT", {}, Exception("disk full"))
+            return create_many(promotions, chunk_size)
+
+        operations = [{"op": "create", "data": PromotionsFactory().serialize()} for _ in range(3)]
+        chunk_size = app.config["BATCH_CHUNK_SIZE"]
+        app.config["BATCH_CHUNK_SIZE"] = 1
+        try:
+            with patch.object(Promotion, "create_many", side_effect=fail_second_chunk):
+                resp = self.client.post(f"{BASE_URL}/batch", json={"operations": operations})
+        finally:
+            app.config["BATCH_CHUNK_SIZE"] = chunk_size
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        codes = [result["status"] for result in resp.get_json()["results"]]
+        self.assertEqual(codes, [status.HTTP_201_CREATED, status.HTTP_500_INTERNAL_SERVER_ERROR, status.HTTP_201_CREATED])
+        self.assertEqual(len(self.client.get(BASE_URL).get_json()), 2)
+
+    def test_batch_promotions_too_many_operations(self):
+        """It should not apply a batch larger than the configured maximum"""
+        max_operations = app.config["BATCH_MAX_OPERATIONS"]
+        app.config["BATCH_MAX_OPERATIONS"] = 1
+        try:
+            resp = self.client.post(f"{BASE_URL}/batch", json={"operations": [{"op": "delete", "id": 1}] * 2})
+        finally:
+            app.config["BATCH_MAX_OPERATIONS"] = max_operations
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_get_a_promotion(self):
         """ It should return a Promotion if id of a promotion exist in database """
         # get the id of a promotion
@@ -116,6 +423,136 @@ class TestPromotionServer(TestCase):
         resp = self.client.get(f"{BASE_URL}/{test_promo.id}")
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
 
+    def test_get_a_promotion_not_modified(self):
+        """It should return 304 Not Modified for a matching ETag"""
+        test_promo = self._create_promotions(1)[0]
+        resp = self.client.get(f"{BASE_URL}/{test_promo.id}")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        etag = resp.headers["ETag"]
+
+        resp = self.client.get(f"{BASE_URL}/{test_promo.id}", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(resp.headers["ETag"], etag)
+        self.assertEqual(len(resp.data), 0)
+
+        # a change gives the promotion a new ETag
+        data = test_promo.serialize()
+        data["amount"] = test_promo.amount + 1
+        resp = self.client.put(f"{BASE_URL}/{test_promo.id}", json=data)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        resp = self.client.get(f"{BASE_URL}/{test_promo.id}", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_responses_match_marshalled_model(self):
+        """It should return exactly what marshalling with promotion_model returns"""
+        test_promos = self._create_promotions(3)
+        expected = [json.loads(json.dumps(marshal(Promotion.find(promo.id).serialize(), promotion_model)))
+                    for promo in test_promos]
+        resp = self.client.get(BASE_URL)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.content_type, "application/json")
+        self.assertEqual(resp.get_json(), expected)
+        resp = self.client.get(f"{BASE_URL}/{test_promos[0].id}")
+        self.assertEqual(resp.get_json(), expected[0])
+
+    def test_get_a_promotion_field_mask(self):
+        """It should apply an X-Fields mask like flask-restx marshalling"""
+        test_promo = self._create_promotions(1)[0]
+        resp = self.client.get(f"{BASE_URL}/{test_promo.id}", headers={"X-Fields": "id,title"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"id": str(test_promo.id), "title": test_promo.title})
+        resp = self.client.get(BASE_URL, headers={"X-Fields": "id"})
+        self.assertEqual(resp.get_json(), [{"id": str(test_promo.id)}])
+
+    def test_get_promotions_sparse_fields(self):
+        """It should only return the requested fields of each Promotion"""
+        test_promos = self._create_promotions(2)
+        resp = self.client.get(f"{BASE_URL}?fields=amount,id,end_date&limit=1")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(list(data[0]), ["id", "amount", "end_date"])
+        self.assertEqual(data[0]["id"], str(test_promos[0].id))
+        self.assertEqual(data[0]["amount"], test_promos[0].amount)
+        # the next page link keeps the same fields
+        resp = self.client.get(resp.headers["Link"].split(";")[0].strip("<>"))
+        self.assertEqual(resp.get_json(), [{"id": str(test_promos[1].id), "amount": test_promos[1].amount,
+                                            "end_date": resp.get_json()[0]["end_date"]}])
+
+    def test_get_a_promotion_sparse_fields(self):
+        """It should only return the requested fields of a Promotion with its own ETag"""
+        test_promo = self._create_promotions(1)[0]
+        full = self.client.get(f"{BASE_URL}/{test_promo.id}")
+        resp = self.client.get(f"{BASE_URL}/{test_promo.id}?fields=promo_code,amount")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"promo_code": test_promo.promo_code, "amount": test_promo.amount})
+        self.assertNotEqual(resp.headers["ETag"], full.headers["ETag"])
+        resp = self.client.get(f"{BASE_URL}/{test_promo.id}?fields=promo_code,amount",
+                               headers={"If-None-Match": full.headers["ETag"]})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_get_promotions_unknown_field(self):
+        """It should reject fields that are not part of a Promotion"""
+        resp = self.client.get(f"{BASE_URL}?fields=id,version")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("version", resp.get_json()["message"])
+        resp = self.client.get(f"{BASE_URL}/1?fields=,")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_promotions_compressed(self):
+        """It should compress large pages with the encoding the client prefers"""
+        self._create_promotions(10)
+        plain = self.client.get(BASE_URL)
+        self.assertNotIn("Content-Encoding", plain.headers)
+        self.assertIn("Accept-Encoding", plain.headers["Vary"])
+        decoders = {"gzip": gzip.decompress, "br": brotli.decompress,
+                    "zstd": lambda data: zstandard.ZstdDecompressor().decompressobj().decompress(data)}
+        for encoding, decode in decoders.items():
+            resp = self.client.get(BASE_URL, headers={"Accept-Encoding": f"identity;q=0.5, {encoding}"})
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(resp.headers["Content-Encoding"], encoding)
+            self.assertLess(len(resp.data), len(plain.data))
+            self.assertEqual(json.loads(decode(resp.data)), plain.get_json())
+            self.assertEqual(resp.headers["ETag"], "W/" + plain.headers["ETag"])
+
+        # a weak tag from a compressed page still validates the page
+        resp = self.client.get(BASE_URL, headers={"Accept-Encoding": "gzip", "If-None-Match": resp.headers["ETag"]})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_small_responses_not_compressed(self):
+        """It should not compress bodies below the size threshold"""
+        test_promo = self._create_promotions(1)[0]
+        resp = self.client.get(f"{BASE_URL}/{test_promo.id}", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotIn("Content-Encoding", resp.headers)
+
+    def test_export_promotions_compressed(self):
+        """It should compress a streamed export as it is generated"""
+        self._create_promotions(3)
+        resp = self.client.get(f"{BASE_URL}/export", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(resp.is_streamed)
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        lines = gzip.decompress(resp.data).decode("utf-8").splitlines()
+        self.assertEqual(len(lines), 3)
+
+    def test_get_promotions_not_modified(self):
+        """It should return 304 Not Modified for an unchanged page"""
+        promotions = self._create_promotions(2)
+        resp = self.client.get(BASE_URL)
+        etag = resp.headers["ETag"]
+
+        resp = self.client.get(BASE_URL, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(len(resp.data), 0)
+
+        data = promotions[1].serialize()
+        data["title"] = "changed"
+        resp = self.client.put(f"{BASE_URL}/{promotions[1].id}", json=data)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.client.get(BASE_URL, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+
     def test_delete_promotion(self):
         """It should Delete a Promotion"""
         test_promotion = self._create_promotions(1)[0]
@@ -142,6 +579,39 @@ class TestPromotionServer(TestCase):
         self.assertEqual(updated_promotion.amount, test_promotion.amount)
         self.assertEqual(updated_promotion.title, test_promotion_title)
 
+    def test_update_promotion_if_match(self):
+        """It should only update a promotion whose ETag matches If-Match"""
+        test_promotion = self._create_promotions(1)[0]
+        etag = self.client.get(f"{BASE_URL}/{test_promotion.id}").headers["ETag"]
+        data = test_promotion.serialize()
+        data["title"] = "first writer"
+        response = self.client.put(f"{BASE_URL}/{test_promotion.id}", json=data, headers={"If-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+        # a second writer holding the old ETag must not overwrite the first
+        data["title"] = "second writer"
+        response = self.client.put(f"{BASE_URL}/{test_promotion.id}", json=data, headers={"If-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        response = self.client.get(f"{BASE_URL}/{test_promotion.id}")
+        self.assertEqual(response.get_json()["title"], "first writer")
+
+    def test_activate_promotion_if_match(self):
+        """It should not activate or deactivate a promotion whose ETag does not match If-Match"""
+        test_promotion = self._create_promotions(1)[0]
+        headers = {"If-Match": '"stale"'}
+        response = self.client.put(f"{BASE_URL}/{test_promotion.id}/activate", headers=headers)
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        response = self.client.delete(f"{BASE_URL}/{test_promotion.id}/activate", headers=headers)
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+
+    def test_update_promotion_concurrent_write(self):
+        """It should return 412 when the promotion changes while it is being updated"""
+        test_promotion = self._create_promotions(1)[0]
+        with patch("service.models.Promotion.update", side_effect=StaleDataError("row changed")):
+            response = self.client.put(f"{BASE_URL}/{test_promotion.id}", json=test_promotion.serialize())
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+
     def test_health(self):
         """It should check the health endpoint"""
         resp = self.client.get("/health")
@@ -149,6 +619,60 @@ class TestPromotionServer(TestCase):
         data = resp.get_json()
         self.assertEqual(data["status"], "OK")
 
+    def test_stats(self):
+        """It should report the cache counters"""
+        test_promotion = self._create_promotions(1)[0]
+        self.client.get(f"{BASE_URL}/{test_promotion.id}")
+        resp = self.client.get("/stats")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertIn("hits", data["cache"])
+        self.assertGreaterEqual(data["cache"]["misses"], 1)
+        self.assertIn("status", data["pool"])
+        self.assertGreater(data["startup"]["create_app"], 0)
+        self.assertIn("prepare_db", data["startup"])
+
+    def test_database_unavailable(self):
+        """It should answer 503 Service Unavailable until the database can be prepared"""
+        error = OperationalError("CREATE TABLE", {}, Exception("connection refused"))
+        with patch.object(Promotion, "prepared", False), patch.object(db, "create_all", side_effect=error):
+            resp = self.client.get(BASE_URL)
+            self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertIn("connection refused", resp.get_json()["message"])
+            resp = self.client.get("/health")
+            self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            resp = self.client.get("/metrics")
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get(BASE_URL).status_code, status.HTTP_200_OK)
+
+    def test_metrics(self):
+        """It should export request, query and cache metrics for Prometheus"""
+        test_promotion = self._create_promotions(1)[0]
+        self.client.get(f"{BASE_URL}/{test_promotion.id}")
+        resp = self.client.get("/metrics")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertIn("text/plain", resp.content_type)
+        body = resp.get_data(as_text=True)
+        self.assertIn('promotions_http_requests_total{endpoint="promotion_resource"', body)
+        self.assertIn("promotions_http_request_duration_seconds_bucket", body)
+        self.assertIn("promotions_db_queries_per_request_count", body)
+        self.assertIn("promotions_serialization_duration_seconds_count", body)
+        self.assertIn('promotions_cache_events{event="hits"}', body)
+
+    def test_metrics_failed_query(self):
+        """It should time the queries that follow a failed one"""
+        with app.test_request_context("/"):
+            g.db_queries, g.db_seconds = 0, 0.0
+            connection = db.session.connection()
+            with self.assertRaises(OperationalError):
+                connection.execute(text("SELECT * FROM no_such_table"))
+            db.session.rollback()
+            connection = db.session.connection()
+            connection.execute(text("SELECT 1"))
+            self.assertEqual(g.db_queries, 1)
+            self.assertNotIn("query_start", connection.info)
+            db.session.rollback()
+
     def test_activate_promotion(self):
         """It should activate a Promotion"""
         test_promotion = self._create_promotions(1)[0]
@@ -207,6 +731,134 @@ class TestPromotionServer(TestCase):
         for promo in data:
             self.assertEqual(promo["code"], test_code)
 
+    def test_query_by_multiple_filters(self):
+        """It should Query Promotions matching every filter given"""
+        promotions = self._create_promotions(10)
+        test_type = promotions[0].promo_type
+        test_site_wide = promotions[0].is_site_wide
+        expected = [promo.id for promo in promotions
+                    if promo.promo_type == test_type and promo.is_site_wide == test_site_wide]
+        response = self.client.get(
+            BASE_URL, query_string={"promo_type": test_type.name, "is_site_wide": str(test_site_wide).lower()}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual([promo["id"] for promo in data], expected)
+
+    def test_query_by_product_id(self):
+        """It should Query Promotions by product id"""
+        promotions = self._create_promotions(5)
+        test_product = promotions[0].product_id
+        expected = [promo.id for promo in promotions if promo.product_id == test_product]
+        response = self.client.get(BASE_URL, query_string=f"product_id={test_product}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([promo["id"] for promo in response.get_json()], expected)
+
+    def test_get_promotions_by_code(self):
+        """It should return the promotions with a promo code"""
+        promotion = PromotionsFactory(promo_code="Spring23")
+        data = self.client.post(BASE_URL, json=promotion.serialize()).get_json()
+        resp = self.client.get(f"{BASE_URL}/codes/Spring23")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), [data])
+        resp = self.client.get(f"{BASE_URL}/codes/SPRING23")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.client.get(f"{BASE_URL}/codes/SPRING23", query_string="ignore_case=true")
+        self.assertEqual(resp.get_json(), [data])
+        stats = self.client.get("/stats").get_json()["codes"]
+        self.assertEqual(stats["missing"]["size"], 1)
+        self.assertEqual(stats["found"]["size"], 2)
+
+    def test_get_active_promotions_for_product(self):
+        """It should return the promotions that apply to a product at a time"""
+        promotion = PromotionsFactory(product_id=5, is_site_wide=False)
+        data = promotion.serialize()
+        data.update(start_date="2023-06-01T00:00:00", end_date="2023-06-30T00:00:00")
+        response = self.client.post(BASE_URL, json=data)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        promotion_id = response.get_json()["id"]
+
+        response = self.client.get("/api/products/5/promotions/active", query_string="at=2023-06-15T12:00:00Z")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([promo["id"] for promo in response.get_json()], [promotion_id])
+
+        response = self.client.get("/api/products/6/promotions/active", query_string="at=2023-06-15T12:00:00Z")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json(), [])
+
+    def test_active_promotions_from_snapshot(self):
+        """It should serve current lookups from the snapshot and follow changes"""
+        now = datetime.now(timezone.utc)
+        promotion = PromotionsFactory(product_id=9, is_site_wide=False, start_date=now - timedelta(days=1),
+                                      end_date=now + timedelta(days=30))
+        data = self.client.post(BASE_URL, json=promotion.serialize()).get_json()
+        resp = self.client.get("/api/products/9/promotions/active")
+        self.assertEqual([promo["id"] for promo in resp.get_json()], [data["id"]])
+        builds = self.client.get("/stats").get_json()["snapshot"]["full_builds"]
+
+        data["product_id"] = 10
+        self.client.put(f"{BASE_URL}/{data['id']}", json=data)
+        self.assertEqual(self.client.get("/api/products/9/promotions/active").get_json(), [])
+        resp = self.client.get("/api/products/10/promotions/active")
+        self.assertEqual([promo["id"] for promo in resp.get_json()], [data["id"]])
+        stats = self.client.get("/stats").get_json()["snapshot"]
+        self.assertEqual(stats["full_builds"], builds)
+        self.assertGreaterEqual(stats["incremental_updates"], 1)
+
+    def test_evaluate_cart(self):
+        """It should price a cart with the best active promotions"""
+        promos = [
+            PromotionsFactory(product_id=5, is_site_wide=False, promo_type=PromoType.DISCOUNT, amount=10),
+            PromotionsFactory(product_id=5, is_site_wide=False, promo_type=PromoType.BOGO),
+            PromotionsFactory(product_id=1, is_site_wide=True, promo_type=PromoType.FIXED, amount=2),
+        ]
+        ids = []
+        for promo in promos:
+            data = promo.serialize()
+            data.update(start_date="2023-06-01T00:00:00", end_date="2023-06-30T00:00:00")
+            ids.append(self.client.post(BASE_URL, json=data).get_json()["id"])
+
+        cart = {"at": "2023-06-15T12:00:00Z", "lines": [
+            {"product_id": 5, "quantity": 1, "unit_price": 20},
+            {"product_id": 7, "quantity": 3, "unit_price": "1.5"},
+        ]}
+        resp = self.client.post(f"{BASE_URL}/evaluate", json=cart)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["lines"][0]["promotion_id"], ids[0])
+        self.assertEqual(data["lines"][0]["promo_type"], "DISCOUNT")
+        self.assertEqual(data["lines"][0]["total"], "18.00")
+        self.assertIsNone(data["lines"][1]["promotion_id"])
+        self.assertEqual(data["lines"][1]["unit_price"], "1.50")
+        self.assertEqual(data["cart_promotion"], {"promotion_id": ids[2], "promo_code": promos[2].promo_code,
+                                                  "discount": "2.00"})
+        self.assertEqual((data["subtotal"], data["discount"], data["total"]), ("24.50", "4.00", "20.50"))
+
+        # outside the promotion dates nothing applies
+        cart["at"] = "2024-06-15T12:00:00Z"
+        data = self.client.post(f"{BASE_URL}/evaluate", json=cart).get_json()
+        self.assertEqual(data["discount"], "0.00")
+
+    def test_evaluate_bad_cart(self):
+        """It should not price an invalid or oversized cart"""
+        line = {"product_id": 1, "quantity": 1, "unit_price": 1}
+        resp = self.client.post(f"{BASE_URL}/evaluate", json={"lines": [dict(line, quantity=-1)]})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.post(f"{BASE_URL}/evaluate", json={"lines": []})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        with patch.dict(app.config, {"PRICING_MAX_LINES": 2}):
+            resp = self.client.post(f"{BASE_URL}/evaluate", json={"lines": [line] * 3})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.post(f"{BASE_URL}/evaluate", json=[line])
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.post(f"{BASE_URL}/evaluate", json={"lines": [line], "at": 5})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_active_promotions_bad_date(self):
+        """It should not look up active promotions with an invalid date"""
+        response = self.client.get("/api/products/5/promotions/active", query_string="at=yesterday")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_query_promotion_list_by_is_site_wide(self):
         """It should check for query Promotions by is_site_wide"""
         promotions = self._create_promotions(10)
@@ -291,6 +943,21 @@ class TestPromotionServer(TestCase):
         response = self.client.post(BASE_URL, json={"name": "not enough data"})
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
+    def test_query_by_unknown_type(self):
+        """It should not Query Promotions by an unknown promotion type"""
+        response = self.client.get(BASE_URL, query_string="promo_type=FREE")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_promotions_bad_cursor(self):
+        """It should not list promotions with an invalid cursor"""
+        response = self.client.get(BASE_URL, query_string="cursor=not-a-cursor")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_promotions_bad_limit(self):
+        """It should not list promotions with a page size below one"""
+        response = self.client.get(BASE_URL, query_string="limit=0")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_method_not_allowed(self):
         """It should not allow an illegal method call"""
         response = self.client.put(BASE_URL, json={"not": "today"})
@@ -0,0 +1,138 @@
+"""
+Test cases for the Promotion Snapshot
+
+Test cases can be run with:
+    nosetests
+    coverage report -m
+"""
+import logging
+from datetime import datetime, timedelta
+from unittest import TestCase
+from service import app
+from service.models import Promotion, PromoType, db, init_db
+from service.snapshot import IntervalIndex, PromotionRecord, Snapshot, SnapshotStore, init_snapshot, store
+from tests.factories import PromotionsFactory
+
+NOW = datetime(2023, 6, 15)
+
+
+def make_record(promotion_id, start_days, end_days, product_id=1, is_site_wide=False):
+    """Builds a record that runs from start_days to end_days around NOW"""
+    return PromotionRecord(promotion_id, f"promo_{promotion_id}", f"C{promotion_id}", PromoType.FIXED, 5,
+                           NOW + timedelta(days=start_days), NOW + timedelta(days=end_days),
+                           is_site_wide, product_id)
+
+
+######################################################################
+#  S N A P S H O T   T E S T   C A S E S
+######################################################################
+class TestSnapshot(TestCase):
+    """ Tests the in-memory snapshot without a database """
+
+    def test_record_is_read_only(self):
+        """It should not change a record"""
+        record = make_record(1, -1, 1)
+        self.assertEqual(record.promo_code, "C1")
+        with self.assertRaises(AttributeError):
+            record.amount = 10
+        self.assertIn("C1", repr(record))
+
+    def test_interval_index(self):
+        """It should find the records active at a time"""
+        records = [make_record(1, -30, 30), make_record(2, -5, -1), make_record(3, -2, 2),
+                   make_record(4, 1, 3), make_record(5, 0, 0)]
+        index = IntervalIndex(records)
+        self.assertEqual(index.max_span, timedelta(days=60))
+        self.assertEqual(sorted(record.id for record in index.active_at(NOW)), [1, 3, 5])
+        self.assertEqual(sorted(record.id for record in index.active_at(NOW + timedelta(days=2))), [1, 3, 4])
+        self.assertEqual(IntervalIndex([]).active_at(NOW), [])
+        self.assertEqual(IntervalIndex([make_record(6, -1, 1)]).active_at(datetime.min), [])
+
+    def test_active_for_products(self):
+        """It should return the active records of the products and the site-wide ones by id"""
+        records = [make_record(4, -1, 1, product_id=1), make_record(3, -1, 1, product_id=2),
+                   make_record(2, -1, 1, product_id=3), make_record(1, -1, 1, is_site_wide=True),
+                   make_record(5, -9, -5, product_id=1)]
+        snapshot = Snapshot.build(records, NOW - timedelta(days=2))
+        self.assertEqual(len(snapshot), 4)
+        found = snapshot.active_for_products([1, 2, 1], NOW)
+        self.assertEqual([record.id for record in found], [1, 3, 4])
+        self.assertTrue(snapshot.covers(NOW))
+        self.assertFalse(snapshot.covers(NOW - timedelta(days=3)))
+
+    def test_with_changes(self):
+        """It should replace, move and drop changed records without touching the original"""
+        records = [make_record(1, -1, 1, product_id=1), make_record(2, -1, 1, product_id=2),
+                   make_record(3, -1, 1, is_site_wide=True)]
+        snapshot = Snapshot.build(records, NOW - timedelta(days=2))
+        # 1 moves to product 2, 3 is deleted and 4 is new
+        changed = [make_record(1, -1, 1, product_id=2), make_record(4, -1, 1, is_site_wide=True)]
+        updated = snapshot.with_changes({1, 3, 4}, changed)
+        self.assertEqual([record.id for record in updated.active_for_products([1], NOW)], [4])
+        self.assertEqual([record.id for record in updated.active_for_products([2], NOW)], [1, 2, 4])
+        self.assertNotIn(1, updated.by_product)
+        self.assertEqual([record.id for record in snapshot.active_for_products([1], NOW)], [1, 3])
+
+
+class TestSnapshotStore(TestCase):
+    """ Tests keeping the snapshot up to date with the database """
+
+    @classmethod
+    def setUpClass(cls):
+        """ This runs once before the entire test suite """
+        app.config["TESTING"] = True
+        app.logger.setLevel(logging.CRITICAL)
+        init_db(app)
+
+    def setUp(self):
+        """ This runs before each test """
+        db.session.query(Promotion).delete()
+        db.session.commit()
+        self.store = SnapshotStore(max_age=300)
+        init_snapshot(app)
+
+    def tearDown(self):
+        """ This runs after each test """
+        db.session.remove()
+
+    def _create(self, **kwargs):
+        """Creates a Promotion that runs from yesterday until next year"""
+        now = datetime.utcnow()
+        promotion = PromotionsFactory(start_date=now - timedelta(days=1), end_date=now + timedelta(days=365), **kwargs)
+        promotion.create()
+        return promotion
+
+    def test_incremental_updates(self):
+        """It should reload only the changed Promotions"""
+        promotion = self._create(product_id=1, is_site_wide=False)
+        self._create(product_id=2, is_site_wide=False)
+        snapshot = self.store.get()
+        self.assertEqual(len(snapshot), 2)
+        self.assertIs(self.store.get(), snapshot)
+
+        promotion.product_id = 3
+        promotion.update()
+        self.store.on_change("update", [promotion.id])
+        updated = self.store.get()
+        self.assertIsNot(updated, snapshot)
+        self.assertEqual([record.id for record in updated.active_for_products([3], datetime.utcnow())],
+                         [promotion.id])
+        promotion.delete()
+        self.store.on_change("delete", [promotion.id])
+        self.assertEqual(len(self.store.get()), 1)
+        stats = self.store.stats()
+        self.assertEqual((stats["full_builds"], stats["incremental_updates"]), (1, 2))
+
+    def test_rebuild_when_too_old(self):
+        """It should rebuild the whole snapshot once it reaches its maximum age"""
+        self.store.get()
+        self._create()
+        self.store.max_age = 0
+        self.assertEqual(len(self.store.get()), 1)
+        self.assertEqual(self.store.stats()["full_builds"], 2)
+
+    def test_subscribed_to_changes(self):
+        """It should pick up committed changes once initialized"""
+        self.assertEqual(len(store.get()), 0)
+        promotion = self._create()
+        self.assertEqual([record.id for record in store.get().records.values()], [promotion.id])
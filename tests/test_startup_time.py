@@ -0,0 +1,69 @@
+"""
+Cold Start Report Test Suite
+
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+import service
+from scripts.startup_time import PHASES, ROOT, compare, summarize
+
+
+class TestStartupTime(TestCase):
+    """Tests the cold start measurements"""
+
+    def test_summarize(self):
+        """It should report the median and slowest time of every phase"""
+        runs = [dict.fromkeys(PHASES, seconds) for seconds in (0.1, 0.3, 0.2)]
+        result = summarize(runs)
+        self.assertEqual(result["total"], {"median_ms": 200.0, "max_ms": 300.0})
+        self.assertEqual(list(result), PHASES)
+
+    def test_compare(self):
+        """It should flag a phase whose median grew past the threshold"""
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as baseline:
+            json.dump({"results": {"create_app": {"median_ms": 100.0}, "total": {"median_ms": 0}}}, baseline)
+        try:
+            self.assertTrue(compare({"create_app": {"median_ms": 105.0}}, baseline.name, 10.0))
+            self.assertFalse(compare({"create_app": {"median_ms": 120.0}}, baseline.name, 10.0))
+        finally:
+            os.remove(baseline.name)
+
+    def test_import_is_lazy(self):
+        """It should import the models without building the app or touching the database"""
+        probe = "import sys, service.pricing; print('flask_restx' in sys.modules, 'service.routes' in sys.modules)"
+        env = dict(os.environ, DATABASE_URI="postgresql://nobody@localhost:1/unreachable")
+        completed = subprocess.run([sys.executable, "-c", probe], cwd=ROOT, env=env,
+                                   capture_output=True, text=True, check=True)
+        self.assertEqual(completed.stdout.split(), ["False", "False"])
+
+    def test_create_app_twice(self):
+        """It should build a second app that serves the same pages as the first"""
+        probe = ("from service import create_app; from service.models import DatabaseConnectionError\n"
+                 "def down():\n"
+                 "    raise DatabaseConnectionError('down')\n"
+                 "first, second = create_app(), create_app()\n"
+                 "second.add_url_rule('/down', 'down', down)\n"
+                 "for flask_app in (first, second):\n"
+                 "    client = flask_app.test_client()\n"
+                 "    print(*(client.get(path).status_code for path in ('/', '/health', '/api/promotions')))\n"
+                 "print(second.test_client().get('/down').status_code)")
+        with tempfile.TemporaryDirectory() as folder:
+            env = dict(os.environ, DATABASE_URI=f"sqlite:///{folder}/promotions.db")
+            completed = subprocess.run([sys.executable, "-c", probe], cwd=ROOT, env=env,
+                                       capture_output=True, text=True, check=True)
+        self.assertEqual(completed.stdout.split(), ["200", "200", "200", "200", "200", "200", "503"])
+
+    def test_create_app_fails(self):
+        """It should log why the app cannot be built and exit with the code that stops gunicorn"""
+        with patch("service.create_app", side_effect=RuntimeError("no config")), \
+                self.assertLogs("gunicorn.error", "CRITICAL") as logs, self.assertRaises(SystemExit) as exited:
+            service.get_app.__wrapped__()
+        self.assertEqual(exited.exception.code, 4)
+        self.assertIn("no config: Cannot continue", logs.output[0])
@@ -0,0 +1,103 @@
+"""
+Test cases for the Promotion Expiry Sweeper
+
+Test cases can be run with:
+    nosetests
+    coverage report -m
+"""
+import logging
+import time
+from datetime import datetime, timedelta
+from unittest import TestCase
+from service import app
+from service.models import Promotion, PromotionChange, db, init_db
+from service.sweeper import ExpirySweeper
+from tests.factories import PromotionsFactory
+
+
+######################################################################
+#  S W E E P E R   T E S T   C A S E S
+######################################################################
+class TestExpirySweeper(TestCase):
+    """ Tests the expiry sweeper against the database """
+
+    @classmethod
+    def setUpClass(cls):
+        """ This runs once before the entire test suite """
+        app.config["TESTING"] = True
+        app.logger.setLevel(logging.CRITICAL)
+        init_db(app)
+
+    def setUp(self):
+        """ This runs before each test """
+        self.now = datetime.utcnow().replace(microsecond=0)
+        self.sweeper = ExpirySweeper()
+        self.sweeper.app = app
+        db.session.query(Promotion).delete()
+        db.session.commit()
+        Promotion.dispatch_changes("delete", None)
+
+    def tearDown(self):
+        """ This runs after each test """
+        db.session.remove()
+
+    def _create(self, end: timedelta, is_site_wide: bool = True) -> int:
+        """Creates a Promotion that ends at self.now + end and returns its id"""
+        promotion = PromotionsFactory(start_date=self.now - timedelta(days=30), end_date=self.now + end,
+                                      is_site_wide=is_site_wide)
+        promotion.create()
+        return promotion.id
+
+    def test_expire_ended(self):
+        """It should deactivate the ended site-wide Promotions in batches and log the changes"""
+        ended = sorted(self._create(timedelta(days=-day)) for day in (1, 2, 3))
+        running = self._create(timedelta(days=1))
+        self._create(timedelta(days=-1), is_site_wide=False)
+        since = PromotionChange.last_seq()
+        self.assertEqual(sorted(Promotion.expire_ended(self.now, batch_size=2)), ended)
+        db.session.remove()
+        self.assertEqual([promotion.id for promotion in Promotion.find_by_is_site_wide(True)], [running])
+        self.assertEqual(Promotion.find(ended[0]).version, 2)
+        changes = PromotionChange.since(since, limit=10)
+        self.assertEqual([change.action for change, _ in changes], ["deactivate"] * 3)
+        self.assertEqual(Promotion.expire_ended(self.now, batch_size=2), [])
+
+    def test_schedule(self):
+        """It should keep the soonest end dates of the site-wide Promotions on a min-heap"""
+        later = self._create(timedelta(hours=2))
+        sooner = self._create(timedelta(hours=1))
+        self._create(timedelta(minutes=1), is_site_wide=False)
+        self.sweeper.schedule()
+        self.assertEqual(self.sweeper.heap[0], (self.now + timedelta(hours=1), sooner))
+        self.assertEqual(self.sweeper.next_wakeup(self.now), app.config["SWEEPER_MAX_SLEEP"])
+        self.assertAlmostEqual(self.sweeper.next_wakeup(self.now + timedelta(minutes=59, seconds=30)), 30, places=1)
+        # a committed change pushes just the Promotion it touched
+        newest = self._create(timedelta(minutes=5))
+        self.sweeper.on_change("create", [newest])
+        self.sweeper.schedule()
+        self.assertEqual([entry[1] for entry in sorted(self.sweeper.heap)], [newest, sooner, later])
+        self.assertEqual(self.sweeper.next_wakeup(self.now + timedelta(days=1)), 0)
+
+    def test_run_due(self):
+        """It should only sweep once the soonest end date has passed"""
+        promotion_id = self._create(timedelta(hours=1))
+        self.sweeper.schedule()
+        self.assertEqual(self.sweeper.run_due(self.now), [])
+        self.assertEqual(self.sweeper.run_due(self.now + timedelta(hours=2)), [promotion_id])
+        self.assertEqual(self.sweeper.heap, [])
+        self.assertEqual(self.sweeper.stats()["expired"], 1)
+        self.sweeper.schedule()  # the heap ran empty, so it was reloaded
+        self.assertEqual(self.sweeper.heap, [])
+
+    def test_sweeper_thread(self):
+        """It should deactivate a Promotion as soon as it ends"""
+        promotion_id = self._create(timedelta(seconds=1.5))
+        self.sweeper.start()
+        self.assertTrue(self.sweeper.stats()["running"])
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline and self.sweeper.stats()["expired"] == 0:
+            time.sleep(0.1)
+        db.session.remove()
+        self.assertFalse(Promotion.find(promotion_id).is_site_wide)
+        self.sweeper._pid = None  # pylint: disable=protected-access
+        self.sweeper.on_change("reset", None)  # let the thread stop